@@ -0,0 +1,572 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import logging
+import pathlib
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, TextIO, Tuple
+
+from metrics import analytics_events
+
+logger = logging.getLogger(__name__)
+
+# Conversation analytics sink: postgres, sqlite, file or none
+ANALYTICS_SINK = os.environ.get("ANALYTICS_SINK", "none").lower()
+ANALYTICS_FILE = os.environ.get("ANALYTICS_FILE", "analytics.jsonl")
+ANALYTICS_SQLITE_PATH = os.environ.get("ANALYTICS_SQLITE_PATH", "analytics.db")
+ANALYTICS_DATABASE_URL = os.environ.get("ANALYTICS_DATABASE_URL") or "postgresql://{}:{}@{}:{}/{}".format(
+    os.environ.get("POSTGRES_USER", "postgres"),
+    os.environ.get("POSTGRES_PASSWORD", "postgres"),
+    os.environ.get("POSTGRES_HOST", "localhost"),
+    os.environ.get("POSTGRES_PORT", "5432"),
+    os.environ.get("POSTGRES_DB", "glazingai"),
+)
+# Events are written in batches of up to this many, at least this often
+ANALYTICS_BATCH_SIZE = int(os.environ.get("ANALYTICS_BATCH_SIZE", "500"))
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", "1"))
+# Events waiting for the sink; beyond this they are spilled to disk (or dropped)
+ANALYTICS_QUEUE_SIZE = int(os.environ.get("ANALYTICS_QUEUE_SIZE", "10000"))
+# Where events the sink can't take are kept until it recovers (empty = drop them)
+ANALYTICS_SPILL_DIR = os.environ.get(
+    "ANALYTICS_SPILL_DIR", str(pathlib.Path(__file__).parent / "analytics-spill")
+)
+ANALYTICS_SPILL_MAX_MB = float(os.environ.get("ANALYTICS_SPILL_MAX_MB", "100"))
+# Seconds to spill instead of writing after the sink fails
+ANALYTICS_RETRY_INTERVAL = float(os.environ.get("ANALYTICS_RETRY_INTERVAL", "5"))
+
+# Spill files are closed at about this size and replayed one at a time
+SPILL_SEGMENT_BYTES = 4 * 1024 * 1024
+
+
+class ConversationEvent:
+    """One conversation turn: what was asked and answered, and how it went."""
+
+    __slots__ = (
+        "ts", "session_id", "widget_key", "model", "prompt", "response",
+        "prompt_tokens", "completion_tokens", "ttft_ms", "latency_ms", "outcome",
+    )
+
+    COLUMNS = __slots__
+
+    def __init__(
+        self,
+        session_id: str,
+        widget_key: str,
+        model: Optional[str],
+        prompt: str,
+        response: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        ttft_ms: Optional[float],
+        latency_ms: float,
+        outcome: str,
+        ts: Optional[float] = None,
+    ) -> None:
+        self.ts = time.time() if ts is None else ts
+        self.session_id = session_id
+        self.widget_key = widget_key
+        self.model = model
+        self.prompt = prompt
+        self.response = response
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.ttft_ms = ttft_ms
+        self.latency_ms = latency_ms
+        self.outcome = outcome
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    def to_row(self) -> Tuple[Any, ...]:
+        return (datetime.fromtimestamp(self.ts, timezone.utc),) + tuple(
+            getattr(self, name) for name in self.COLUMNS[1:]
+        )
+
+
+class AnalyticsSink:
+    """Interface for where conversation events are written."""
+
+    backend = "none"
+
+    async def start(self) -> None:
+        """Open connections and create the schema if needed."""
+
+    async def close(self) -> None:
+        """Release resources."""
+
+    async def write(self, events: List[ConversationEvent]) -> None:
+        """Write a batch of events, raising if it could not be stored."""
+
+
+class FileAnalyticsSink(AnalyticsSink):
+    """Events as JSON lines in a local file, for tests and development."""
+
+    backend = "file"
+
+    def __init__(self, path: str = ANALYTICS_FILE) -> None:
+        self.path = pathlib.Path(path)
+
+    def _append(self, events: List[ConversationEvent]) -> None:
+        lines = "".join(json.dumps(event.to_dict(), ensure_ascii=False) + "\n" for event in events)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def write(self, events: List[ConversationEvent]) -> None:
+        await asyncio.to_thread(self._append, events)
+
+
+class SqliteAnalyticsSink(AnalyticsSink):
+    """Events in a SQLite table, for tests and single-host installs."""
+
+    backend = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversation_events (
+            ts TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            widget_key TEXT NOT NULL,
+            model TEXT,
+            prompt TEXT,
+            response TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            ttft_ms REAL,
+            latency_ms REAL,
+            outcome TEXT NOT NULL
+        )
+    """
+
+    def __init__(self, path: str = ANALYTICS_SQLITE_PATH) -> None:
+        self.path = path
+        self.connection: Optional[sqlite3.Connection] = None
+
+    def _open(self) -> None:
+        # Only used from one writer thread at a time
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(self.SCHEMA)
+        self.connection.commit()
+
+    def _insert(self, events: List[ConversationEvent]) -> None:
+        rows = [(datetime.fromtimestamp(event.ts, timezone.utc).isoformat(),) + event.to_row()[1:] for event in events]
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO conversation_events VALUES ({', '.join('?' * len(ConversationEvent.COLUMNS))})",
+                rows,
+            )
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self._open)
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    async def write(self, events: List[ConversationEvent]) -> None:
+        await asyncio.to_thread(self._insert, events)
+
+
+class PostgresAnalyticsSink(AnalyticsSink):
+    """Events in the Postgres database from docker-compose, written with COPY."""
+
+    backend = "postgres"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversation_events (
+            ts TIMESTAMPTZ NOT NULL,
+            session_id TEXT NOT NULL,
+            widget_key TEXT NOT NULL,
+            model TEXT,
+            prompt TEXT,
+            response TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            ttft_ms DOUBLE PRECISION,
+            latency_ms DOUBLE PRECISION,
+            outcome TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversation_events_widget_ts ON conversation_events (widget_key, ts);
+    """
+
+    def __init__(self, dsn: str = ANALYTICS_DATABASE_URL) -> None:
+        self.dsn = dsn
+        self.pool: Any = None
+
+    async def start(self) -> None:
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=2)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                # Workers start together; only one creates the table
+                await connection.execute("SELECT pg_advisory_xact_lock(hashtext('conversation_events'))")
+                await connection.execute(self.SCHEMA)
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def write(self, events: List[ConversationEvent]) -> None:
+        await self.pool.copy_records_to_table(
+            "conversation_events",
+            records=[event.to_row() for event in events],
+            columns=ConversationEvent.COLUMNS,
+        )
+
+
+async def create_analytics_sink(backend: str = ANALYTICS_SINK) -> AnalyticsSink:
+    """Build and start the configured sink; without one events are not recorded."""
+    if backend == "file":
+        sink: AnalyticsSink = FileAnalyticsSink()
+    elif backend == "sqlite":
+        sink = SqliteAnalyticsSink()
+    elif backend == "postgres":
+        sink = PostgresAnalyticsSink()
+    else:
+        return AnalyticsSink()
+    try:
+        await sink.start()
+        return sink
+    except Exception as e:
+        # Spilled events are replayed once a restart can reach the sink
+        logger.error(f"Failed to open {backend} analytics sink, not recording events: {str(e)}")
+        return AnalyticsSink()
+
+
+class SpillFile:
+    """Events the sink couldn't take, kept as JSON lines until it recovers.
+
+    Appends go to an active segment that is closed at about
+    ``SPILL_SEGMENT_BYTES``; segments are replayed oldest first. Every
+    worker spills into the same directory, so segments are ``flock``ed:
+    a worker holds the lock on its active segment while appending and on a
+    segment it is replaying, and skips segments another worker holds.
+    Segments left by a worker that exited are replayed by whichever worker
+    gets to them first. Total size is capped at about ``max_bytes`` -
+    events beyond it are dropped. Methods do file I/O and are called in a
+    thread.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._active: Optional[pathlib.Path] = None
+        self._active_file: Optional[TextIO] = None
+        # Segments being replayed, locked until done()
+        self._taken: Dict[pathlib.Path, TextIO] = {}
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self.bytes = self._size()
+
+    def _segments(self) -> List[pathlib.Path]:
+        return sorted(self.directory.glob("spill-*.jsonl"))
+
+    def _size(self) -> int:
+        size = 0
+        for path in self._segments():
+            try:
+                size += path.stat().st_size
+            except FileNotFoundError:
+                # Replayed and removed by another worker meanwhile
+                pass
+        return size
+
+    def _close_active(self) -> None:
+        if self._active_file is not None:
+            # Closing releases the lock; the segment is now up for replay
+            self._active_file.close()
+        self._active = None
+        self._active_file = None
+
+    def append(self, events: List[ConversationEvent]) -> int:
+        """Append as many events as fit; returns how many were kept."""
+        with self._lock:
+            lines = []
+            size = 0
+            for event in events:
+                line = json.dumps(event.to_dict(), ensure_ascii=False) + "\n"
+                if self.bytes + size + len(line) > self.max_bytes:
+                    break
+                lines.append(line)
+                size += len(line)
+            if not lines:
+                return 0
+            if self._active_file is None or self._active_file.tell() >= SPILL_SEGMENT_BYTES:
+                self._close_active()
+                # Other workers' spills count towards the cap too
+                self.bytes = self._size()
+                name = f"spill-{time.time_ns()}-{os.getpid()}.jsonl"
+                # Locked before it's given a name other workers look for
+                self._active_file = open(self.directory / f".{name}", "a", encoding="utf-8")
+                fcntl.flock(self._active_file, fcntl.LOCK_EX)
+                self._active = self.directory / name
+                os.rename(self.directory / f".{name}", self._active)
+            self._active_file.write("".join(lines))
+            self._active_file.flush()
+            self.bytes += size
+            return len(lines)
+
+    def take(self) -> Optional[Tuple[pathlib.Path, List[ConversationEvent]]]:
+        """Lock the oldest free segment and return its events, closing it if active."""
+        with self._lock:
+            self.bytes = self._size()
+            for path in self._segments():
+                if path in self._taken:
+                    continue
+                if path == self._active:
+                    self._close_active()
+                try:
+                    f = open(path, "r+", encoding="utf-8")
+                except FileNotFoundError:
+                    continue
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another worker is appending to or replaying it
+                    f.close()
+                    continue
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    # Replayed and removed while we waited for the lock
+                    f.close()
+                    continue
+                events = [ConversationEvent(**json.loads(line)) for line in f if line.strip()]
+                self._taken[path] = f
+                return path, events
+            return None
+
+    def done(self, path: pathlib.Path, remaining: List[ConversationEvent]) -> None:
+        """Delete a replayed segment, or keep only the events not yet written."""
+        with self._lock:
+            f = self._taken.pop(path)
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if remaining:
+                    text = "".join(json.dumps(event.to_dict(), ensure_ascii=False) + "\n" for event in remaining)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(text)
+                    f.flush()
+                    self.bytes += len(text.encode("utf-8")) - size
+                else:
+                    # Unlinked while still locked, so no other worker can take it
+                    path.unlink()
+                    self.bytes -= size
+            finally:
+                f.close()
+
+    def close(self) -> None:
+        """Release every lock held, leaving unfinished segments to be replayed later."""
+        with self._lock:
+            self._close_active()
+            for f in self._taken.values():
+                f.close()
+            self._taken.clear()
+
+
+class AnalyticsWriter:
+    """Records conversation events and writes them to the sink in batches.
+
+    ``record`` is called on the message path and only appends to a bounded
+    in-memory queue. A background task writes the queue to the sink in
+    batches of ``batch_size``, or whatever has queued after
+    ``flush_interval`` seconds. When the queue is full, or the sink fails,
+    events are spilled to disk from another task and replayed once the
+    sink accepts writes again; without a spill directory they are dropped.
+    Nothing on the message path ever waits for the sink.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = ANALYTICS_BATCH_SIZE,
+        flush_interval: float = ANALYTICS_FLUSH_INTERVAL,
+        queue_size: int = ANALYTICS_QUEUE_SIZE,
+        spill_dir: str = ANALYTICS_SPILL_DIR,
+        spill_max_mb: float = ANALYTICS_SPILL_MAX_MB,
+        retry_interval: float = ANALYTICS_RETRY_INTERVAL,
+    ) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.retry_interval = retry_interval
+        self.sink = AnalyticsSink()
+        self.spill = SpillFile(spill_dir, int(spill_max_mb * 1024 * 1024)) if spill_dir else None
+        self._queue: Deque[ConversationEvent] = deque()
+        self._overflow: List[ConversationEvent] = []
+        self._flush_wanted = asyncio.Event()
+        self._spill_wanted = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._retry_at = 0.0
+        self.recorded = 0
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.write_seconds = 0.0
+        self._written = analytics_events.labels("written")
+        self._spilled = analytics_events.labels("spilled")
+        self._replayed = analytics_events.labels("replayed")
+        self._dropped = analytics_events.labels("dropped")
+
+    @property
+    def enabled(self) -> bool:
+        return self.sink.backend != "none"
+
+    async def start(self, sink: Optional[AnalyticsSink] = None) -> None:
+        """Open the sink and start the writer and spill tasks."""
+        self.sink = sink or await create_analytics_sink()
+        if not self.enabled:
+            return
+        if self.spill is not None:
+            try:
+                await asyncio.to_thread(self.spill.open)
+            except OSError as e:
+                logger.error(f"Analytics spill directory unusable, dropping events instead: {str(e)}")
+                self.spill = None
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._run_spill())]
+
+    async def close(self) -> None:
+        """Write (or spill) whatever is queued, then close the sink."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while self._queue:
+            await self._flush()
+        await self._spill_overflow()
+        if self.spill is not None:
+            await asyncio.to_thread(self.spill.close)
+        await self.sink.close()
+
+    def record(self, event: ConversationEvent) -> None:
+        """Queue an event for the sink without waiting."""
+        if not self.enabled:
+            return
+        self.recorded += 1
+        if len(self._queue) < self.queue_size:
+            self._queue.append(event)
+            if len(self._queue) >= self.batch_size:
+                self._flush_wanted.set()
+        elif self.spill is not None and len(self._overflow) < self.queue_size:
+            self._overflow.append(event)
+            self._spill_wanted.set()
+        else:
+            self.dropped += 1
+            self._dropped.inc()
+
+    async def _run(self) -> None:
+        while True:
+            if len(self._queue) < self.batch_size:
+                self._flush_wanted.clear()
+                try:
+                    await asyncio.wait_for(self._flush_wanted.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Analytics writer error: {str(e)}")
+
+    async def _flush(self) -> None:
+        """Write one batch from the queue, and a spilled segment if the sink is up."""
+        count = min(len(self._queue), self.batch_size)
+        batch = [self._queue.popleft() for _ in range(count)]
+        if batch:
+            if time.monotonic() < self._retry_at:
+                await self._spill_events(batch)
+                return
+            if not await self._write(batch):
+                await self._spill_events(batch)
+                return
+            self._written.inc(len(batch))
+        if self.spill is not None and self.spill.bytes and time.monotonic() >= self._retry_at:
+            await self._replay()
+
+    async def _write(self, batch: List[ConversationEvent]) -> bool:
+        start = time.perf_counter()
+        try:
+            await self.sink.write(batch)
+        except Exception as e:
+            self.errors += 1
+            self._retry_at = time.monotonic() + self.retry_interval
+            logger.warning(f"Analytics {self.sink.backend} write of {len(batch)} events failed: {str(e)}")
+            return False
+        self.write_seconds += time.perf_counter() - start
+        self.written += len(batch)
+        self.batches += 1
+        return True
+
+    async def _replay(self) -> None:
+        """Write the oldest spilled segment to the sink."""
+        taken = await asyncio.to_thread(self.spill.take)
+        if taken is None:
+            return
+        path, events = taken
+        sent = 0
+        while sent < len(events):
+            batch = events[sent:sent + self.batch_size]
+            if not await self._write(batch):
+                break
+            sent += len(batch)
+            self.replayed += len(batch)
+            self._replayed.inc(len(batch))
+        await asyncio.to_thread(self.spill.done, path, events[sent:])
+        if sent:
+            logger.info(f"Replayed {sent} spilled analytics events")
+
+    async def _run_spill(self) -> None:
+        while True:
+            await self._spill_wanted.wait()
+            self._spill_wanted.clear()
+            try:
+                await self._spill_overflow()
+            except Exception as e:
+                logger.error(f"Analytics spill error: {str(e)}")
+
+    async def _spill_overflow(self) -> None:
+        if self._overflow:
+            events, self._overflow = self._overflow, []
+            await self._spill_events(events)
+
+    async def _spill_events(self, events: List[ConversationEvent]) -> None:
+        kept = 0
+        if self.spill is not None:
+            try:
+                kept = await asyncio.to_thread(self.spill.append, events)
+            except OSError as e:
+                logger.error(f"Failed to spill analytics events: {str(e)}")
+        self.spilled += kept
+        self._spilled.inc(kept)
+        if kept < len(events):
+            self.dropped += len(events) - kept
+            self._dropped.inc(len(events) - kept)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sink": self.sink.backend,
+            "queued": len(self._queue),
+            "recorded": self.recorded,
+            "written": self.written,
+            "batches": self.batches,
+            "batch_ms_avg": round(self.write_seconds / self.batches * 1000, 2) if self.batches else 0,
+            "spilled": self.spilled,
+            "spill_bytes": self.spill.bytes if self.spill is not None else None,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+conversation_analytics = AnalyticsWriter()
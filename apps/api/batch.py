@@ -0,0 +1,284 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import pathlib
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from cache import cache_key
+from retrieval import knowledge_base
+from providers import UpstreamRequestError
+from scheduler import AdmissionRejected, get_admitted_llm_response
+
+logger = logging.getLogger(__name__)
+
+# Bulk prompt processing configuration
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))  # Prompts of a job generated at once
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "16"))  # Most a job may ask for
+BATCH_MAX_PROMPTS = int(os.environ.get("BATCH_MAX_PROMPTS", "5000"))
+BATCH_MAX_ATTEMPTS = int(os.environ.get("BATCH_MAX_ATTEMPTS", "5"))  # Tries per prompt when shed or failing
+# Completed results, kept per job so an interrupted job can be resumed
+BATCH_JOB_DIR = os.environ.get("BATCH_JOB_DIR") or str(pathlib.Path(__file__).parent / "data" / "batch")
+
+JOB_ID = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+# (item id, prompt)
+BatchItem = Tuple[str, str]
+
+
+class BatchInputError(ValueError):
+    """The prompts of a batch request could not be read."""
+
+
+def _item(value: Any, index: int) -> BatchItem:
+    if isinstance(value, str):
+        return str(index), value
+    if isinstance(value, dict) and isinstance(value.get("prompt"), str):
+        return str(value.get("id", index)), value["prompt"]
+    raise BatchInputError(f"Prompt {index} must be a string or an object with a \"prompt\"")
+
+
+def _check(items: List[BatchItem]) -> List[BatchItem]:
+    if not items:
+        raise BatchInputError("No prompts given")
+    if len({item_id for item_id, _ in items}) != len(items):
+        raise BatchInputError("Prompt ids must be unique")
+    return items
+
+
+def check_overrides(body: Dict[str, Any]) -> None:
+    """Reject ``system_prompt``, ``model`` or ``temperature`` overrides of the wrong type."""
+    for field in ("system_prompt", "model"):
+        if body.get(field) is not None and not isinstance(body[field], str):
+            raise BatchInputError(f"\"{field}\" must be a string")
+    temperature = body.get("temperature")
+    if temperature is not None and (
+        isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not 0 <= temperature <= 2
+    ):
+        raise BatchInputError("\"temperature\" must be a number from 0 to 2")
+
+
+def parse_json_prompts(body: Dict[str, Any]) -> List[BatchItem]:
+    """Read ``{"prompts": [...]}``; each prompt is a string or ``{"id", "prompt"}``."""
+    prompts = body.get("prompts")
+    if not isinstance(prompts, list):
+        raise BatchInputError("Body must have a \"prompts\" list")
+    if len(prompts) > BATCH_MAX_PROMPTS:
+        raise BatchInputError(f"At most {BATCH_MAX_PROMPTS} prompts per job")
+    return _check([_item(value, index) for index, value in enumerate(prompts)])
+
+
+async def parse_ndjson_prompts(chunks: AsyncIterator[bytes]) -> List[BatchItem]:
+    """Read one prompt per line as it arrives; a line is a JSON string or ``{"id", "prompt"}``."""
+    items: List[BatchItem] = []
+    buffer = b""
+
+    def add(line: bytes) -> None:
+        if not line.strip():
+            return
+        if len(items) >= BATCH_MAX_PROMPTS:
+            raise BatchInputError(f"At most {BATCH_MAX_PROMPTS} prompts per job")
+        try:
+            value = json.loads(line)
+        except ValueError:
+            raise BatchInputError(f"Line {len(items) + 1} is not JSON")
+        items.append(_item(value, len(items)))
+
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            add(line)
+    add(buffer)
+    return _check(items)
+
+
+def check_job_id(job_id: str) -> str:
+    """Return ``job_id`` if it is usable as a job's file name."""
+    if not JOB_ID.match(job_id):
+        raise BatchInputError("Job ids are 1-64 letters, digits, '.', '_' or '-'")
+    return job_id
+
+
+class BatchJobStore:
+    """Completed batch results as one JSON-lines file per job."""
+
+    def __init__(self, directory: str = BATCH_JOB_DIR) -> None:
+        self.directory = pathlib.Path(directory)
+
+    def _path(self, job_id: str) -> pathlib.Path:
+        return self.directory / f"{check_job_id(job_id)}.jsonl"
+
+    def _read(self, path: pathlib.Path) -> Dict[str, Dict[str, Any]]:
+        results: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # A write cut short by a crash; that prompt runs again
+                        continue
+                    results[result["id"]] = result
+        return results
+
+    def _append(self, path: pathlib.Path, result: Dict[str, Any]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    async def load(self, job_id: str) -> Dict[str, Dict[str, Any]]:
+        """Return the job's completed results by item id."""
+        return await asyncio.to_thread(self._read, self._path(job_id))
+
+    async def append(self, job_id: str, result: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._append, self._path(job_id), result)
+
+    async def delete(self, job_id: str) -> bool:
+        path = self._path(job_id)
+        if not path.exists():
+            return False
+        await asyncio.to_thread(path.unlink)
+        return True
+
+
+batch_jobs = BatchJobStore()
+
+
+async def _generate(
+    widget_key: str,
+    item_id: str,
+    prompt: str,
+    system_prompt: str,
+    system_prompt_tokens: Optional[int],
+    model: str,
+    temperature: float,
+) -> Dict[str, Any]:
+    """Generate one prompt's answer, retrying when shed or when upstream fails.
+
+    A request the backend refuses (a bad model or temperature) fails at
+    once. Other errors are raised, and ``run_batch`` reports them as the
+    item's failure.
+    """
+    start = time.perf_counter()
+    context, context_tokens = await knowledge_base.context(widget_key, prompt)
+    error = ""
+    for attempt in range(1, BATCH_MAX_ATTEMPTS + 1):
+        meta: Dict[str, Any] = {}
+        tokens: List[str] = []
+        try:
+            # Admitted under a key of its own, so a job shares upstream
+            # capacity fairly with the widget's live chat rather than taking it
+            async with aclosing(get_admitted_llm_response(
+                prompt=prompt,
+                system_prompt=system_prompt + context,
+                widget_key=f"batch:{widget_key}",
+                meta=meta,
+                model=model,
+                temperature=temperature,
+                system_prompt_tokens=(
+                    system_prompt_tokens + context_tokens if system_prompt_tokens is not None else None
+                ),
+            )) as stream:
+                async for token in stream:
+                    tokens.append(token)
+        except AdmissionRejected as e:
+            error = f"rejected: {e.reason}"
+            delay = e.retry_after
+        except UpstreamRequestError as e:
+            # A bad model or parameter fails the same way every time
+            return {"id": item_id, "prompt": prompt, "error": f"refused: {str(e)}", "attempts": attempt}
+        except (OSError, asyncio.TimeoutError) as e:
+            error = str(e)
+            delay = min(2 ** attempt, 30)
+        except Exception as e:
+            # An upstream failing mid-stream marks the fallback before
+            # raising; anything else is a bug that retrying won't fix
+            if not meta.get("fallback"):
+                raise
+            error = str(e)
+            delay = min(2 ** attempt, 30)
+        else:
+            if not meta.get("fallback"):
+                return {
+                    "id": item_id,
+                    "prompt": prompt,
+                    "response": "".join(tokens),
+                    "backend": meta.get("backend"),
+                    "attempts": attempt,
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+                }
+            # Every backend failed and the fake LLM answered - not a result
+            error = "upstream unavailable"
+            delay = min(2 ** attempt, 30)
+        if attempt < BATCH_MAX_ATTEMPTS:
+            logger.debug("Batch prompt %s attempt %d failed (%s), retrying in %.1fs", item_id, attempt, error, delay)
+            await asyncio.sleep(delay)
+    return {"id": item_id, "prompt": prompt, "error": error, "attempts": BATCH_MAX_ATTEMPTS}
+
+
+async def run_batch(
+    job_id: str,
+    widget_key: str,
+    items: List[BatchItem],
+    system_prompt: str,
+    model: str,
+    temperature: float,
+    system_prompt_tokens: Optional[int] = None,
+    concurrency: int = BATCH_CONCURRENCY,
+    store: BatchJobStore = batch_jobs,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Yield a result for every item, in the order they complete.
+
+    Items the job already completed with the same prompt and settings are
+    yielded from the store (marked ``resumed``) rather than generated
+    again. The rest run ``concurrency`` at a time through the admission
+    scheduler; each success is stored before it is yielded, so if the
+    caller goes away the job can be resumed where it stopped. Failures
+    are yielded with an ``error`` and not stored, so a resume retries them.
+    """
+    done = await store.load(job_id)
+    pending: List[Tuple[str, str, str]] = []
+    for item_id, prompt in items:
+        key = cache_key(system_prompt, prompt, model, temperature)
+        previous = done.get(item_id)
+        if previous is not None and previous.get("key") == key:
+            previous.pop("key")
+            yield dict(previous, resumed=True)
+        else:
+            pending.append((item_id, prompt, key))
+
+    results: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    remaining = iter(pending)
+
+    async def worker() -> None:
+        for item_id, prompt, key in remaining:
+            try:
+                result = await _generate(
+                    widget_key, item_id, prompt, system_prompt, system_prompt_tokens, model, temperature
+                )
+            except Exception as e:
+                logger.error(f"Batch job {job_id} prompt {item_id} failed: {str(e)}")
+                result = {"id": item_id, "prompt": prompt, "error": str(e), "attempts": 0}
+            if "error" not in result:
+                try:
+                    await store.append(job_id, dict(result, key=key))
+                except OSError as e:
+                    logger.error(f"Failed to store batch job {job_id} result {item_id}: {str(e)}")
+            await results.put(result)
+
+    workers = [
+        asyncio.create_task(worker())
+        for _ in range(min(max(concurrency, 1), BATCH_MAX_CONCURRENCY, len(pending)))
+    ]
+    try:
+        for _ in range(len(pending)):
+            yield await results.get()
+    finally:
+        # The caller went away: stop generating; completed results are stored
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
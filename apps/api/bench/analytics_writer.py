@@ -0,0 +1,253 @@
+"""Throughput and message-path cost of the batched analytics writer.
+
+Three measurements, each with the SQLite and file sinks in a temp dir:
+
+- ``per_message``: time the message path spends persisting one turn. The
+  baseline inserts and commits a row per message (on the event loop, and
+  awaited in a thread); the writer only queues the event.
+- ``capacity``: how fast the writer empties a full queue into the sink.
+- ``sustained``: events recorded at ``--rate`` per second for ``--seconds``
+  while a monitor task measures event-loop lag. Reports whether the
+  writer kept up, and how many events were spilled or dropped.
+- ``outage``: as ``sustained``, but the sink fails for the middle third of
+  the run. Events go to the spill directory and are replayed when it recovers;
+  reports whether every event was written.
+
+Run from ``apps/api``:
+
+    python -m bench.analytics_writer --seconds 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from analytics import AnalyticsWriter, ConversationEvent, FileAnalyticsSink, SqliteAnalyticsSink
+from bench.common import percentile, summarize_latencies
+
+PROMPT = "Hi, how much would it cost to replace three sash windows with double glazing?"
+RESPONSE = (
+    "Thanks for asking! Replacing sash windows with double-glazed units usually costs "
+    "between £800 and £1,500 per window depending on size, timber and glazing options. "
+) * 4
+
+
+def make_event(i: int) -> ConversationEvent:
+    return ConversationEvent(
+        session_id=f"session-{i % 1000}",
+        widget_key=f"widget-{i % 20}",
+        model="gpt-3.5-turbo",
+        prompt=PROMPT,
+        response=RESPONSE,
+        prompt_tokens=320,
+        completion_tokens=140,
+        ttft_ms=420.0,
+        latency_ms=2300.0,
+        outcome="completed",
+    )
+
+
+async def make_sink(kind: str, root: str) -> Any:
+    if kind == "sqlite":
+        sink: Any = SqliteAnalyticsSink(os.path.join(root, "analytics.db"))
+    else:
+        sink = FileAnalyticsSink(os.path.join(root, "analytics.jsonl"))
+    await sink.start()
+    return sink
+
+
+class FlakySink:
+    """Wraps a sink, failing every write while ``down`` is set."""
+
+    def __init__(self, sink: Any) -> None:
+        self.sink = sink
+        self.backend = sink.backend
+        self.down = False
+
+    async def start(self) -> None:
+        await self.sink.start()
+
+    async def close(self) -> None:
+        await self.sink.close()
+
+    async def write(self, events: List[ConversationEvent]) -> None:
+        if self.down:
+            raise ConnectionError("sink unavailable")
+        await self.sink.write(events)
+
+
+async def monitor_lag(lags: List[float], stop: asyncio.Event, interval: float = 0.005) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+
+async def per_message(args: argparse.Namespace, root: str) -> Dict[str, Any]:
+    # Before: a row inserted and committed for every message
+    path = os.path.join(root, "sync.db")
+    sink = SqliteAnalyticsSink(path)
+    await sink.start()
+    inline = []
+    for i in range(args.messages):
+        start = time.perf_counter()
+        sink._insert([make_event(i)])
+        inline.append((time.perf_counter() - start) * 1000)
+    threaded = []
+    for i in range(args.messages):
+        start = time.perf_counter()
+        await sink.write([make_event(i)])
+        threaded.append((time.perf_counter() - start) * 1000)
+    await sink.close()
+
+    writer = AnalyticsWriter(spill_dir=os.path.join(root, "spill-per-message"))
+    await writer.start(await make_sink("sqlite", root))
+    queued = []
+    for i in range(args.messages):
+        event = make_event(i)
+        start = time.perf_counter()
+        writer.record(event)
+        queued.append((time.perf_counter() - start) * 1_000_000)
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    await writer.close()
+    return {
+        "sqlite_insert_per_message_on_loop_ms": summarize_latencies(inline),
+        "sqlite_insert_per_message_in_thread_ms": summarize_latencies(threaded),
+        "writer_record_us": summarize_latencies(queued),
+    }
+
+
+async def capacity(kind: str, args: argparse.Namespace, root: str) -> Dict[str, Any]:
+    """Events/sec the writer gets into the sink with a full queue."""
+    writer = AnalyticsWriter(
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+        queue_size=args.capacity_events,
+        spill_dir=os.path.join(root, f"spill-capacity-{kind}"),
+    )
+    await writer.start(await make_sink(kind, root))
+    for i in range(args.capacity_events):
+        writer.record(make_event(i))
+    start = time.perf_counter()
+    while writer.written < args.capacity_events:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    await writer.close()
+    return {
+        "events": args.capacity_events,
+        "written_per_second": round(args.capacity_events / elapsed),
+        "batch_ms_avg": writer.stats()["batch_ms_avg"],
+    }
+
+
+async def sustained(kind: str, args: argparse.Namespace, root: str) -> Dict[str, Any]:
+    """A steady ``--rate`` events/sec, with the event loop's lag measured."""
+    writer = AnalyticsWriter(
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+        queue_size=args.queue_size,
+        spill_dir=os.path.join(root, f"spill-{kind}"),
+    )
+    await writer.start(await make_sink(kind, root))
+    lags: List[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_lag(lags, stop))
+
+    per_tick = max(int(args.rate / 100), 1)
+    recorded = 0
+    start = time.perf_counter()
+    for tick in range(int(args.seconds * 100)):
+        for _ in range(per_tick):
+            writer.record(make_event(recorded))
+            recorded += 1
+        # Pace to the target rate
+        await asyncio.sleep(max(start + (tick + 1) / 100 - time.perf_counter(), 0))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+    queued = len(writer._queue)
+    await writer.close()
+
+    return {
+        "recorded_per_second": round(recorded / elapsed),
+        "queued_at_end": queued,
+        "batch_ms_avg": writer.stats()["batch_ms_avg"],
+        "spilled": writer.spilled,
+        "dropped": writer.dropped,
+        "loop_lag_ms_p50": round(percentile(lags, 50), 2),
+        "loop_lag_ms_p99": round(percentile(lags, 99), 2),
+    }
+
+
+async def outage(kind: str, args: argparse.Namespace, root: str) -> Dict[str, Any]:
+    sink = FlakySink(await make_sink(kind, root))
+    writer = AnalyticsWriter(
+        batch_size=args.batch_size,
+        flush_interval=args.flush_interval,
+        queue_size=args.queue_size,
+        spill_dir=os.path.join(root, f"spill-outage-{kind}"),
+        retry_interval=0.5,
+    )
+    await writer.start(sink)
+    per_tick = max(int(args.rate / 100), 1)
+    ticks = int(args.seconds * 100)
+    for tick in range(ticks):
+        sink.down = ticks // 3 <= tick < 2 * ticks // 3
+        for j in range(per_tick):
+            writer.record(make_event(tick * per_tick + j))
+        await asyncio.sleep(0.01)
+    # Give the replay a moment after the outage, then drain
+    await asyncio.sleep(args.flush_interval * 2)
+    await writer.close()
+
+    if kind == "sqlite":
+        connection = sqlite3.connect(os.path.join(root, "analytics.db"))
+        stored = connection.execute("SELECT COUNT(*) FROM conversation_events").fetchone()[0]
+        connection.close()
+    else:
+        with open(os.path.join(root, "analytics.jsonl")) as f:
+            stored = sum(1 for _ in f)
+    return {
+        "recorded": writer.recorded,
+        "stored": stored,
+        "spilled": writer.spilled,
+        "replayed": writer.replayed,
+        "dropped": writer.dropped,
+        "sink_errors": writer.errors,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--rate", type=float, default=2000, help="Events/sec in the sustained and outage runs")
+    parser.add_argument("--capacity-events", type=int, default=50000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--flush-interval", type=float, default=1)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--sinks", default="sqlite,file")
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = {}
+    root = tempfile.mkdtemp(prefix="glazing-analytics-bench-")
+    try:
+        results["per_message"] = await per_message(args, root)
+        for kind in args.sinks.split(","):
+            results[f"capacity_{kind}"] = await capacity(kind, args, tempfile.mkdtemp(dir=root))
+            results[f"sustained_{kind}"] = await sustained(kind, args, tempfile.mkdtemp(dir=root))
+            results[f"outage_{kind}"] = await outage(kind, args, tempfile.mkdtemp(dir=root))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
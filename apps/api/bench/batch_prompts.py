@@ -0,0 +1,149 @@
+"""Throughput and resume of the bulk prompt endpoint against the OpenAI stub.
+
+Starts the stub (with a small injected error rate) and the API, then
+POSTs ``--prompts`` prompts to ``/admin/batch/{widget_key}`` at each
+``--concurrency`` and reads the NDJSON results as they stream back.
+Reports wall time, prompts per second, time to the first result, retried
+and failed prompts, and requests the stub received. The resume run drops
+the connection after ``--resume-after`` results, then POSTs the same job
+again and checks that only the unfinished prompts reach upstream.
+
+Run from ``apps/api``:
+
+    python -m bench.batch_prompts --prompts 100 --concurrency 1,4,16
+"""
+
+import argparse
+import asyncio
+import json
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from bench.common import spawn_api, spawn_stub, stop, wait_for_http
+
+ADMIN_KEY = "bench-admin"
+
+
+async def post_batch(
+    api_url: str,
+    prompts: List[str],
+    job_id: str,
+    concurrency: int,
+    stop_after: Optional[int] = None,
+) -> Dict[str, Any]:
+    start = time.perf_counter()
+    first = None
+    results: List[Dict[str, Any]] = []
+    summary: Dict[str, Any] = {}
+    async with httpx.AsyncClient(timeout=None) as client:
+        async with client.stream(
+            "POST",
+            f"{api_url}/admin/batch/bench",
+            params={"job_id": job_id, "concurrency": concurrency},
+            headers={"X-Admin-Key": ADMIN_KEY},
+            json={"prompts": prompts},
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                record = json.loads(line)
+                if record.get("done"):
+                    summary = record
+                    break
+                if first is None:
+                    first = time.perf_counter() - start
+                results.append(record)
+                if stop_after is not None and len(results) >= stop_after:
+                    break
+    wall = time.perf_counter() - start
+    return {
+        "results": results,
+        "summary": summary,
+        "wall_seconds": round(wall, 2),
+        "first_result_ms": round((first or 0) * 1000, 1),
+    }
+
+
+async def stub_requests(client: httpx.AsyncClient, stub_url: str) -> int:
+    return (await client.get(f"{stub_url}/stats")).json()["requests"]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--prompts", type=int, default=100)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--resume-after", type=int, default=30)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--api-port", type=int, default=8130)
+    parser.add_argument("--ttft-ms", type=float, default=100)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--token-delay-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--widget-tpm", type=int, default=0, help="Per-widget TPM budget (0 = none)")
+    args = parser.parse_args()
+
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    job_dir = tempfile.mkdtemp(prefix="glazing-batch-bench-")
+    stub = spawn_stub(
+        args.stub_port, "--ttft-ms", str(args.ttft_ms), "--tokens", str(args.tokens),
+        "--token-delay-ms", str(args.token_delay_ms), "--error-rate", str(args.error_rate), "--seed", "1",
+    )
+    api = spawn_api(args.api_port, {
+        "ADMIN_API_KEY": ADMIN_KEY,
+        "USE_FAKE_LLM": "false",
+        "OPENAI_API_KEY": "sk-stub",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        "BATCH_JOB_DIR": job_dir,
+        "BATCH_MAX_CONCURRENCY": "64",
+        "LLM_WIDGET_CONCURRENCY": "64",
+        "LLM_WIDGET_TPM": str(args.widget_tpm),
+        "TENANT_STORE": "none",
+    }, quiet=True)
+    prompts = [f"Write an FAQ answer about glazing topic {i}" for i in range(args.prompts)]
+    results: Dict[str, Any] = {}
+    try:
+        await wait_for_http(f"{stub_url}/stats")
+        await wait_for_http(f"{api_url}/healthz")
+        async with httpx.AsyncClient() as client:
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                before = await stub_requests(client, stub_url)
+                run = await post_batch(api_url, prompts, f"bench-c{concurrency}", concurrency)
+                retried = sum(1 for r in run["results"] if r.get("attempts", 1) > 1)
+                results[f"concurrency_{concurrency}"] = {
+                    "wall_seconds": run["wall_seconds"],
+                    "prompts_per_second": round(args.prompts / run["wall_seconds"], 1),
+                    "first_result_ms": run["first_result_ms"],
+                    "completed": run["summary"].get("completed"),
+                    "failed": run["summary"].get("failed"),
+                    "retried": retried,
+                    "upstream_requests": await stub_requests(client, stub_url) - before,
+                }
+
+            before = await stub_requests(client, stub_url)
+            first = await post_batch(api_url, prompts, "bench-resume", 4, stop_after=args.resume_after)
+            # Let cancelled generations finish closing before counting
+            await asyncio.sleep(1)
+            interrupted = await stub_requests(client, stub_url) - before
+            second = await post_batch(api_url, prompts, "bench-resume", 4)
+            results["resume"] = {
+                "results_before_disconnect": len(first["results"]),
+                "upstream_requests_before_disconnect": interrupted,
+                "resumed": second["summary"].get("resumed"),
+                "completed_on_resume": second["summary"].get("completed"),
+                "failed": second["summary"].get("failed"),
+                "upstream_requests_total": await stub_requests(client, stub_url) - before,
+            }
+    finally:
+        stop(api, stub)
+        shutil.rmtree(job_dir, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+"""Measure ping latency and wasted upstream tokens during long generations.
+
+Starts the stub upstream with a long, slow response and the API pointed at
+it, then for each run: sends a prompt, waits for a few token frames, sends
+a ping and a ``cancel`` and records how long the pong and the cancellation
+took and how many tokens the upstream kept generating after the cancel.
+Run from ``apps/api``:
+
+    python -m bench.cancellation --runs 5
+
+Pass ``--api-url`` to measure an already running server instead (e.g. an
+older checkout for a before/after comparison).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import websockets
+
+from bench.common import percentile, spawn_api, spawn_stub, stop, wait_for_http
+
+
+async def run_once(ws_url: str, stub_url: str, tokens_before_cancel: int, settle: float) -> dict:
+    async with httpx.AsyncClient() as http:
+        before = (await http.get(f"{stub_url}/stats")).json()["tokens_streamed"]
+
+    async with websockets.connect(ws_url) as ws:
+        await ws.recv()  # welcome
+        await ws.send("Tell me everything about triple glazing")
+
+        received = 0
+        while received < tokens_before_cancel:
+            frame = json.loads(await ws.recv())
+            if frame["type"] == "token":
+                received += frame.get("count", 1)
+
+        ping_sent = cancel_sent = time.perf_counter()
+        await ws.send(json.dumps({"type": "ping"}))
+        await ws.send(json.dumps({"type": "cancel"}))
+
+        pong_ms = cancelled_ms = None
+        while pong_ms is None or cancelled_ms is None:
+            frame = json.loads(await ws.recv())
+            now = time.perf_counter()
+            if frame["type"] == "pong" and pong_ms is None:
+                pong_ms = (now - ping_sent) * 1000
+            elif frame["type"] == "token":
+                received += frame.get("count", 1)
+            elif frame["type"] in ("completion", "status") and frame.get("message") != "thinking":
+                # Old servers ignore cancel and only stop at completion
+                cancelled_ms = (now - cancel_sent) * 1000
+
+    # Give the upstream a moment to notice the closed stream
+    await asyncio.sleep(settle)
+    async with httpx.AsyncClient() as http:
+        after = (await http.get(f"{stub_url}/stats")).json()["tokens_streamed"]
+
+    return {
+        "pong_ms": pong_ms,
+        "cancel_ms": cancelled_ms,
+        "upstream_tokens": after - before,
+        "tokens_at_cancel": tokens_before_cancel,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--api-url", help="ws:// URL of an already running API")
+    parser.add_argument("--api-port", type=int, default=8010)
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--tokens", type=int, default=400)
+    parser.add_argument("--token-delay-ms", type=float, default=10)
+    parser.add_argument("--cancel-after", type=int, default=20)
+    args = parser.parse_args()
+
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    processes = [spawn_stub(
+        args.stub_port, "--tokens", str(args.tokens), "--token-delay-ms", str(args.token_delay_ms),
+    )]
+    ws_url = args.api_url
+    try:
+        if ws_url is None:
+            processes.append(spawn_api(args.api_port, {
+                "USE_FAKE_LLM": "false",
+                "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "sk-stub",
+                "OPENAI_BASE_URL": f"{stub_url}/v1",
+                "CACHE_ENABLED": "false",
+            }))
+            await wait_for_http(f"http://127.0.0.1:{args.api_port}/healthz")
+            ws_url = f"ws://127.0.0.1:{args.api_port}/ws/bench-widget"
+        await wait_for_http(f"{stub_url}/stats")
+
+        results = [
+            await run_once(ws_url, stub_url, args.cancel_after, settle=0.5)
+            for _ in range(args.runs)
+        ]
+    finally:
+        stop(*processes)
+
+    pongs = [r["pong_ms"] for r in results]
+    cancels = [r["cancel_ms"] for r in results]
+    wasted = [r["upstream_tokens"] - r["tokens_at_cancel"] for r in results]
+    print(json.dumps({
+        "runs": len(results),
+        "ping_latency_ms_p50": round(percentile(pongs, 50), 2),
+        "ping_latency_ms_max": round(max(pongs), 2),
+        "cancel_latency_ms_p50": round(percentile(cancels, 50), 2),
+        "wasted_upstream_tokens_mean": round(sum(wasted) / len(wasted), 1),
+        "upstream_tokens_per_response": args.tokens,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""Benchmark per-token WebSocket framing against coalesced token frames.
+
+Run from ``apps/api``:
+
+    python -m bench.coalesce --streams 200 --tokens 300 --delay-ms 5
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from streaming import TokenCoalescer
+
+
+class FakeWebSocket:
+    """Serializes frames the way Starlette's ``send_json`` does."""
+
+    def __init__(self) -> None:
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_json(self, data: dict) -> None:
+        text = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+        self.frames += 1
+        self.bytes += len(text.encode("utf-8"))
+        # Yield like a real socket write would
+        await asyncio.sleep(0)
+
+
+async def run_stream(
+    websocket: FakeWebSocket, tokens: int, delay: float, interval_ms: float, max_bytes: int
+) -> None:
+    session_id = "00000000-0000-0000-0000-000000000000"
+
+    async def send_frame(text: str, count: int):
+        await websocket.send_json({
+            "type": "token",
+            "token": text,
+            "count": count,
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat(),
+        })
+
+    coalescer = TokenCoalescer(send_frame, flush_interval_ms=interval_ms, flush_bytes=max_bytes)
+    for i in range(tokens):
+        await coalescer.add(f"tok{i % 50} ")
+        await asyncio.sleep(delay)
+    await coalescer.aclose()
+
+
+async def run_mode(args: argparse.Namespace, interval_ms: float) -> dict:
+    sockets = [FakeWebSocket() for _ in range(args.streams)]
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    await asyncio.gather(*(
+        run_stream(ws, args.tokens, args.delay_ms / 1000, interval_ms, args.flush_bytes)
+        for ws in sockets
+    ))
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    total_tokens = args.streams * args.tokens
+    frames = sum(ws.frames for ws in sockets)
+    sent_bytes = sum(ws.bytes for ws in sockets)
+    return {
+        "flush_interval_ms": interval_ms,
+        "frames": frames,
+        "frames_per_sec": round(frames / wall, 1),
+        "bytes": sent_bytes,
+        "bytes_per_token": round(sent_bytes / total_tokens, 2),
+        "cpu_us_per_token": round(cpu / total_tokens * 1e6, 2),
+        "wall_seconds": round(wall, 3),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--delay-ms", type=float, default=5)
+    parser.add_argument("--flush-interval-ms", type=float, default=40)
+    parser.add_argument("--flush-bytes", type=int, default=512)
+    args = parser.parse_args()
+
+    before = await run_mode(args, 0)
+    after = await run_mode(args, args.flush_interval_ms)
+    print(json.dumps({"per_token": before, "coalesced": after}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""Measure cold-start time and first-message TTFT of a fresh API process.
+
+For each backend, starts a new uvicorn process per run and records how long
+``import main`` takes, how long until ``/healthz`` answers, and the
+time-to-first-token of the first and second chat message. The OpenAI
+backend is served by the local stub. Run from ``apps/api``:
+
+    python -m bench.cold_start --runs 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+import websockets
+
+from bench.common import API_DIR, git_revision, spawn_api, spawn_stub, stop, wait_for_http
+
+
+def import_time(env: Dict[str, str]) -> float:
+    """Milliseconds for a fresh interpreter to ``import main``."""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", "import main"],
+        cwd=API_DIR,
+        env={**os.environ, **env},
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+async def wait_for_ready(url: str, timeout: float = 60) -> Dict:
+    """Poll ``/healthz`` until the app has finished starting up."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                return (await client.get(url)).json()
+            except httpx.TransportError:
+                await asyncio.sleep(0.01)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def ttft(ws, prompt: str) -> float:
+    """Send ``prompt`` and return milliseconds until the first token frame."""
+    start = time.perf_counter()
+    await ws.send(prompt)
+    first = None
+    while True:
+        frame = json.loads(await asyncio.wait_for(ws.recv(), timeout=60))
+        if frame["type"] == "token" and first is None:
+            first = (time.perf_counter() - start) * 1000
+        elif frame["type"] in ("completion", "error"):
+            return first if first is not None else float("nan")
+
+
+async def run_once(port: int, env: Dict[str, str]) -> Dict[str, float]:
+    start = time.perf_counter()
+    api = spawn_api(port, env, quiet=True)
+    try:
+        health = await wait_for_ready(f"http://127.0.0.1:{port}/healthz")
+        ready_ms = (time.perf_counter() - start) * 1000
+        async with websockets.connect(f"ws://127.0.0.1:{port}/ws/bench-widget") as ws:
+            await ws.recv()  # welcome frame
+            first = await ttft(ws, "What are your opening hours?")
+            second = await ttft(ws, "Do you install triple glazing?")
+    finally:
+        stop(api)
+    return {
+        "ready_ms": ready_ms,
+        # Older revisions don't report warm-up, so they can be compared too
+        "warmup_ms": health.get("llm", {}).get("warmup_ms", 0),
+        "first_ttft_ms": first,
+        "second_ttft_ms": second,
+        "backend_ready": health.get("ready", True),
+    }
+
+
+def summarize(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    summary = {}
+    for key in ("import_ms", "ready_ms", "warmup_ms", "first_ttft_ms", "second_ttft_ms"):
+        values = sorted(run[key] for run in runs)
+        summary[f"{key}_median"] = round(values[len(values) // 2], 1)
+    summary["backend_ready"] = all(run["backend_ready"] for run in runs)
+    return summary
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--stub-port", type=int, default=9201)
+    args = parser.parse_args()
+
+    common = {"CACHE_ENABLED": "false", "LOG_LEVEL": "warning"}
+    backends = {
+        "fake": {**common, "USE_FAKE_LLM": "true", "FAKE_LLM_SEED": "1"},
+        "openai": {
+            **common,
+            "USE_FAKE_LLM": "false",
+            "OPENAI_API_KEY": "sk-stub",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{args.stub_port}/v1",
+        },
+    }
+
+    stub = spawn_stub(args.stub_port, "--ttft-ms", "20", "--tokens", "20")
+    try:
+        await wait_for_http(f"http://127.0.0.1:{args.stub_port}/stats")
+        results = {}
+        for name, env in backends.items():
+            runs = []
+            for _ in range(args.runs):
+                run = await run_once(args.port, env)
+                run["import_ms"] = import_time(env)
+                runs.append(run)
+            results[name] = summarize(runs)
+    finally:
+        stop(stub)
+
+    print(json.dumps({"revision": git_revision(), "runs": args.runs, "backends": results}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,187 @@
+"""Helpers shared by the benchmark scripts."""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def wait_for_http(url: str, timeout: float = 20) -> None:
+    """Poll ``url`` until it answers or ``timeout`` expires."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def spawn_stub(port: int, *args: str) -> subprocess.Popen:
+    """Start the OpenAI-compatible stub server on ``port``."""
+    return subprocess.Popen(
+        [sys.executable, "-m", "bench.stub_openai", "--port", str(port), *args],
+        cwd=API_DIR,
+    )
+
+
+def spawn_api(
+    port: int,
+    env: Optional[Dict[str, str]] = None,
+    extra_args: Optional[List[str]] = None,
+    quiet: bool = False,
+) -> subprocess.Popen:
+    """Start the API with uvicorn on ``port`` with extra environment variables."""
+    output = subprocess.DEVNULL if quiet else None
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+            *(extra_args or []),
+        ],
+        cwd=API_DIR,
+        env={**os.environ, **(env or {})},
+        stdout=output,
+        stderr=output,
+    )
+
+
+def stop(*processes: subprocess.Popen) -> None:
+    """Terminate spawned processes and wait for them to exit."""
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of ``values`` (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def git_revision() -> str:
+    """Short commit hash of the checkout being benchmarked, if available."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=API_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+def child_pids(pid: int) -> List[int]:
+    """PIDs of the direct children of ``pid`` (e.g. uvicorn workers)."""
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+
+class ProcessSampler:
+    """Sample RSS and CPU time of a process from /proc (Linux only).
+
+    With ``include_children`` the figures are summed over the process and
+    its direct children, for multi-worker servers.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.5, include_children: bool = False) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.include_children = include_children
+        self.rss_peak_kb = 0
+        self.rss_samples: List[int] = []
+        self._cpu_start: Optional[float] = None
+        self._wall_start = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def _pids(self) -> List[int]:
+        return [self.pid, *child_pids(self.pid)] if self.include_children else [self.pid]
+
+    def _cpu_seconds(self) -> float:
+        total = 0
+        for pid in self._pids():
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            # utime and stime are fields 14 and 15 (1-based) of /proc/pid/stat
+            total += int(fields[11]) + int(fields[12])
+        return total / os.sysconf("SC_CLK_TCK")
+
+    def _rss_kb(self) -> int:
+        total = 0
+        for pid in self._pids():
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        return total
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                rss = self._rss_kb()
+            except OSError:
+                return
+            self.rss_samples.append(rss)
+            self.rss_peak_kb = max(self.rss_peak_kb, rss)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        try:
+            self._cpu_start = self._cpu_seconds()
+        except OSError:
+            return
+        self._wall_start = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Dict[str, float]:
+        if self._task is None:
+            return {}
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        wall = time.monotonic() - self._wall_start
+        cpu = self._cpu_seconds() - (self._cpu_start or 0)
+        return {
+            "rss_mb_start": round(self.rss_samples[0] / 1024, 1) if self.rss_samples else 0,
+            "rss_mb_peak": round(self.rss_peak_kb / 1024, 1),
+            "cpu_seconds": round(cpu, 2),
+            "cpu_percent_avg": round(cpu / wall * 100, 1) if wall else 0,
+        }
+
+
+def summarize_latencies(values: List[float]) -> Dict[str, float]:
+    """p50/p90/p99/max summary of a list of millisecond latencies."""
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 2),
+        "p90": round(percentile(values, 90), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(max(values), 2) if values else 0.0,
+    }
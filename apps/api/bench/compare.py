@@ -0,0 +1,42 @@
+"""Diff two JSON benchmark reports and show the relative change per metric.
+
+    python -m bench.compare before.json after.json
+"""
+
+import argparse
+import json
+from typing import Dict, Iterator, Tuple
+
+
+def flatten(data: Dict, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    for key, value in sorted(data.items()):
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, path)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, value
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{'metric':45} {'before':>12} {'after':>12} {'change':>9}")
+    after_values = dict(flatten(after))
+    for path, old in flatten(before):
+        if path.startswith("config.") or path not in after_values:
+            continue
+        new = after_values[path]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{path:45} {old:>12} {new:>12} {change:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Compare per-connection keepalive tasks with the shared timer wheel.
+
+Registers many idle fake connections and runs keepalive for a while with
+a short interval, once with a ``keepalive_ping`` task per connection (the
+old behaviour) and once with ``KeepaliveScheduler``. Clients answer pings
+immediately and a fraction of them are chatting, sending a frame every
+second. Reports memory per connection, CPU per ping, how many pings the
+chatting clients got and the largest burst of pings in any 100ms window.
+Run from ``apps/api``:
+
+    python -m bench.keepalive --connections 20000 --interval 2 --duration 10
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from keepalive import Connection, KeepaliveScheduler
+from protocol import send_frame
+
+
+class FakeWebSocket:
+    """Counts pings and answers them like the widget does."""
+
+    client_state = application_state = 1
+
+    def __init__(self, ping_times: List[float]) -> None:
+        self.state = SimpleNamespace()
+        self.ping_times = ping_times
+        self.connection: Optional[Connection] = None
+        self.pings = 0
+
+    async def send_text(self, text: str) -> None:
+        self.pings += 1
+        self.ping_times.append(time.monotonic())
+        if self.connection is not None:
+            self.connection.touch()
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        pass
+
+
+async def keepalive_ping(websocket: FakeWebSocket, session_id: str, interval: float) -> None:
+    """The per-connection loop main.py used to run."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if websocket.client_state == websocket.application_state == 1:
+                    await send_frame(websocket, {
+                        "type": "ping",
+                        "timestamp": datetime.now().isoformat(),
+                        "session_id": session_id,
+                    })
+                else:
+                    break
+            except Exception:
+                break
+    except asyncio.CancelledError:
+        pass
+
+
+async def chat(active: List[FakeWebSocket], duration: float) -> None:
+    """Chatting clients send a frame every second."""
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for websocket in active:
+            if websocket.connection is not None:
+                websocket.connection.touch()
+        await asyncio.sleep(1)
+
+
+async def run_mode(mode: str, args: argparse.Namespace) -> Dict[str, float]:
+    ping_times: List[float] = []
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    sockets = [FakeWebSocket(ping_times) for _ in range(args.connections)]
+    sockets_memory = tracemalloc.get_traced_memory()[0] - baseline
+    tasks: List[asyncio.Task] = []
+    scheduler = None
+    if mode == "tasks":
+        tasks = [
+            asyncio.create_task(keepalive_ping(ws, f"session-{i}", args.interval))
+            for i, ws in enumerate(sockets)
+        ]
+    else:
+        scheduler = KeepaliveScheduler(interval=args.interval, timeout=args.interval, tick=args.tick)
+        for i, ws in enumerate(sockets):
+            ws.connection = scheduler.add(ws, f"session-{i}", f"widget-{i % 100}")
+        await scheduler.start()
+    # Let every task reach its first sleep before measuring
+    await asyncio.sleep(0)
+    memory = tracemalloc.get_traced_memory()[0] - baseline - sockets_memory
+    tracemalloc.stop()
+
+    active = sockets[:int(len(sockets) * args.active_fraction)]
+    cpu_start = time.process_time()
+    await chat(active, args.duration)
+    cpu = time.process_time() - cpu_start
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if scheduler is not None:
+        await scheduler.close()
+
+    pings = len(ping_times)
+    bursts = Counter(int(t * 10) for t in ping_times)
+    return {
+        "bytes_per_connection": round(memory / args.connections, 1),
+        "pings": pings,
+        "cpu_us_per_ping": round(cpu / pings * 1e6, 2) if pings else 0,
+        "cpu_ms_per_second": round(cpu / args.duration * 1000, 2),
+        "pings_to_chatting_clients": sum(ws.pings for ws in active),
+        "max_pings_per_100ms": max(bursts.values()) if bursts else 0,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=20000)
+    parser.add_argument("--interval", type=float, default=2)
+    parser.add_argument("--tick", type=float, default=0.1)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--active-fraction", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {}
+    for mode in ("tasks", "wheel"):
+        results[mode] = await run_mode(mode, args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+"""Tail latency of the LLM fallback chain with and without provider health.
+
+Streams chat completions through ``get_llm_response`` against the local
+stub server with injected faults, in two scenarios:
+
+- ``tail``: a small fraction of requests get a slow first token. Compares
+  no hedging with hedging at the TTFT percentile.
+- ``outage``: the upstream fails every request for the first half of the
+  run, then recovers. Compares the old behaviour (client retries, every
+  request tries OpenAI then LangChain before the fake LLM) with circuit
+  breakers.
+
+Reports time to first token percentiles, which backend answered and how
+many requests reached the stub. Run from ``apps/api``:
+
+    python -m bench.llm_failover --requests 400 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+import httpx
+
+from bench.common import percentile, spawn_stub, stop, wait_for_http
+
+
+async def run_requests(args: argparse.Namespace, stub_url: str, outage: bool) -> Dict[str, Any]:
+    from llm import get_llm_response
+
+    ttfts: List[float] = []
+    backends: Counter = Counter()
+    errors = 0
+    issued = 0
+    recovered = asyncio.Event()
+
+    async def one() -> None:
+        nonlocal errors
+        meta: Dict[str, Any] = {}
+        start = time.perf_counter()
+        first = None
+        try:
+            async for _ in get_llm_response(prompt="opening hours?", system_prompt="stub", meta=meta):
+                if first is None:
+                    first = (time.perf_counter() - start) * 1000
+        except Exception:
+            errors += 1
+        if first is not None:
+            ttfts.append(first)
+        backends[meta.get("backend")] += 1
+
+    async def worker() -> None:
+        nonlocal issued
+        async with httpx.AsyncClient() as client:
+            while issued < args.requests:
+                issued += 1
+                if outage and issued > args.requests // 2 and not recovered.is_set():
+                    recovered.set()
+                    await client.post(f"{stub_url}/faults", json={"error_rate": 0})
+                await one()
+                await asyncio.sleep(args.think_ms / 1000)
+
+    async with httpx.AsyncClient() as client:
+        before = (await client.get(f"{stub_url}/stats")).json()["requests"]
+        if outage:
+            await client.post(f"{stub_url}/faults", json={"error_rate": 1})
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - wall_start
+        after = (await client.get(f"{stub_url}/stats")).json()["requests"]
+
+    return {
+        "ttft_ms_p50": round(percentile(ttfts, 50), 1),
+        "ttft_ms_p95": round(percentile(ttfts, 95), 1),
+        "ttft_ms_p99": round(percentile(ttfts, 99), 1),
+        "ttft_ms_max": round(max(ttfts), 1) if ttfts else 0,
+        "backends": dict(backends),
+        "errors": errors,
+        "upstream_requests": after - before,
+        "wall_seconds": round(wall, 2),
+    }
+
+
+async def run_mode(mode: str, args: argparse.Namespace, stub_url: str) -> Dict[str, Any]:
+    import llm
+    from llm_client import llm_clients
+    from providers import ProviderHealth
+
+    outage = mode.startswith("outage")
+    if mode == "outage-old":
+        # No breakers and the OpenAI client's default retries
+        health = ProviderHealth(failure_threshold=0, hedge=False)
+        retries = 2
+    else:
+        health = ProviderHealth(
+            failure_threshold=args.breaker_failures,
+            reset_timeout=args.breaker_reset,
+            hedge=mode == "tail-hedged",
+            hedge_percentile=args.hedge_percentile,
+            hedge_min_ms=args.hedge_min_ms,
+        )
+        retries = 0
+    llm.provider_health = health
+    await llm_clients.aclose()
+    llm_clients.max_retries = retries
+
+    if not outage:
+        # Fill the TTFT window before measuring, as a running server would
+        warmup = argparse.Namespace(**{**vars(args), "requests": 50})
+        await run_requests(warmup, stub_url, outage=False)
+    result = await run_requests(args, stub_url, outage)
+    result["breakers"] = {name: breaker.stats() for name, breaker in health.breakers.items()}
+    result["hedges"] = health.hedges
+    return result
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=50)
+    parser.add_argument("--slow-rate", type=float, default=0.03)
+    parser.add_argument("--slow-ms", type=float, default=2000)
+    parser.add_argument("--error-delay-ms", type=float, default=500)
+    parser.add_argument("--hedge-percentile", type=float, default=95)
+    parser.add_argument("--hedge-min-ms", type=float, default=100)
+    parser.add_argument("--breaker-failures", type=int, default=5)
+    parser.add_argument("--breaker-reset", type=float, default=0.5)
+    parser.add_argument("--think-ms", type=float, default=200, help="Pause between a client's requests")
+    parser.add_argument("--modes", default="tail,tail-hedged,outage-old,outage")
+    args = parser.parse_args()
+
+    stub_url = f"http://127.0.0.1:{args.port}"
+    os.environ.update({
+        "USE_FAKE_LLM": "false",
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "sk-stub",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        # The fake fallback answers at once, so its latency is the chain's
+        "FAKE_LLM_SEED": "bench",
+        "FAKE_LLM_TOKENS": "5",
+    })
+
+    from llm import preload_fallback
+
+    # As warm_up() does in the server
+    await asyncio.to_thread(preload_fallback)
+
+    results: Dict[str, Any] = {}
+    for mode in args.modes.split(","):
+        # A fresh stub per mode, so random faults fall the same way each time
+        stub = spawn_stub(
+            args.port, "--ttft-ms", str(args.ttft_ms), "--tokens", "5", "--token-delay-ms", "1",
+            "--slow-rate", str(0 if mode.startswith("outage") else args.slow_rate),
+            "--slow-ms", str(args.slow_ms), "--error-delay-ms", str(args.error_delay_ms), "--seed", "1",
+        )
+        try:
+            await wait_for_http(f"{stub_url}/stats")
+            results[mode] = await run_mode(mode, args, stub_url)
+        finally:
+            from llm_client import llm_clients
+
+            await llm_clients.aclose()
+            stop(stub)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
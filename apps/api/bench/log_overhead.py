@@ -0,0 +1,131 @@
+"""Measure event-loop lag and token throughput with old vs new logging.
+
+Streams tokens through many concurrent simulated generations that log the
+way ``process_message`` and the OpenAI streaming loop do, while a monitor
+task measures how late the event loop wakes it up. Modes:
+
+- ``old``: synchronous DEBUG logging, an f-string record per chunk and
+  every per-message record (the previous configuration)
+- ``new``: queued structured logging at INFO with sampling
+- ``new-debug``: as ``new`` but at DEBUG, so sampled chunk records are written
+
+Records go to ``--log-file`` so the writes are real. Run from ``apps/api``:
+
+    python -m bench.log_overhead --streams 200 --tokens 200
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+import logs
+from bench.common import percentile
+from logs import LogSampler, setup_logging, stop_logging
+
+logger = logging.getLogger("bench.log_overhead")
+
+
+async def old_stream(session_id: str, tokens: int, delay: float) -> None:
+    message = "What are your opening hours on a bank holiday weekend?"
+    logger.info(f"Processing message: {message} from session {session_id}")
+    logger.info(f"Running with USE_FAKE_LLM=False")  # noqa: F541 - as the old code had it
+    logger.info(f"Using pooled LLM client with key length: 51, model: gpt-3.5-turbo")  # noqa: F541
+    logger.info(f"Sending to LLM: {message} (3 messages)")
+    logger.info("Starting OpenAI streaming chat completion")
+    for i in range(tokens):
+        content = f"token{i} "
+        logger.info(f"Received content chunk: {content[:10]}...")
+        await asyncio.sleep(delay)
+    logger.info("OpenAI streaming completed successfully")
+    logger.info(f"LLM response completed in 1.00s: {tokens * 7} chars")
+
+
+async def new_stream(session_id: str, tokens: int, delay: float) -> None:
+    logs.bind_session(session_id, "bench-widget")
+    message = "What are your opening hours on a bank holiday weekend?"
+    if logger.isEnabledFor(logging.INFO) and logs.message_log_sampler.allow():
+        logger.info("Processing message (%d chars)", len(message))
+    logger.debug("Running with USE_FAKE_LLM=%s", False)
+    logger.debug("Using pooled LLM client with model: %s", "gpt-3.5-turbo")
+    logger.debug("Sending to LLM: %d messages", 3)
+    logger.debug("Starting OpenAI streaming chat completion")
+    for i in range(tokens):
+        content = f"token{i} "
+        if logger.isEnabledFor(logging.DEBUG) and logs.token_log_sampler.allow():
+            logger.debug("Received content chunk: %.10s...", content)
+        await asyncio.sleep(delay)
+    logger.debug("OpenAI streaming completed successfully")
+    if logger.isEnabledFor(logging.INFO) and logs.message_log_sampler.allow():
+        logger.info("LLM response completed in %.2fs: %d chars", 1.0, tokens * 7)
+
+
+async def monitor_lag(lags: List[float], interval: float, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run_mode(mode: str, args: argparse.Namespace, log_file: str) -> Dict[str, float]:
+    with open(log_file, "w") as output:
+        if mode == "old":
+            setup_logging(level="DEBUG", fmt="text", use_queue=False, stream=output)
+            stream = old_stream
+        else:
+            level = "DEBUG" if mode == "new-debug" else "INFO"
+            setup_logging(level=level, fmt="json", use_queue=True, stream=output)
+            logs.token_log_sampler = LogSampler("token", every=logs.LOG_TOKEN_SAMPLE_EVERY)
+            logs.message_log_sampler = LogSampler("message", per_second=logs.LOG_MESSAGE_RATE)
+            stream = new_stream
+
+        lags: List[float] = []
+        stop = asyncio.Event()
+        monitor = asyncio.create_task(monitor_lag(lags, args.lag_interval_ms / 1000, stop))
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        await asyncio.gather(*(
+            stream(f"session-{i}", args.tokens, args.delay_ms / 1000) for i in range(args.streams)
+        ))
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        stop.set()
+        await monitor
+        # Count the writer thread's remaining work in the file size, not the loop
+        stop_logging()
+        output.flush()
+        log_bytes = os.path.getsize(log_file)
+
+    total_tokens = args.streams * args.tokens
+    return {
+        "tokens_per_sec": round(total_tokens / wall, 1),
+        "cpu_us_per_token": round(cpu / total_tokens * 1e6, 2),
+        "loop_lag_ms_p50": round(percentile(lags, 50) * 1000, 3),
+        "loop_lag_ms_p99": round(percentile(lags, 99) * 1000, 3),
+        "loop_lag_ms_max": round(max(lags) * 1000, 3),
+        "log_bytes": log_bytes,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--delay-ms", type=float, default=5)
+    parser.add_argument("--lag-interval-ms", type=float, default=5)
+    parser.add_argument("--log-file", default=os.path.join(tempfile.gettempdir(), "glazing-log-bench.log"))
+    parser.add_argument("--modes", default="old,new,new-debug")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes.split(","):
+        results[mode] = await run_mode(mode, args, args.log_file)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
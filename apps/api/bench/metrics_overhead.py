@@ -0,0 +1,85 @@
+"""Benchmark the per-token cost of streaming metrics and the cost of a scrape.
+
+Streams tokens through the same coalescing path ``process_message`` uses,
+with and without ``StreamTimer``, and reports CPU per token for each. Run
+from ``apps/api``:
+
+    python -m bench.metrics_overhead --streams 200 --tokens 500
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import metrics
+from bench.coalesce import FakeWebSocket
+from streaming import TokenCoalescer
+
+
+async def run_stream(websocket: FakeWebSocket, tokens: int, timed: bool) -> None:
+    async def send_frame(text: str, count: int):
+        await websocket.send_json({"type": "token", "token": text, "count": count})
+
+    coalescer = TokenCoalescer(send_frame)
+    timer = metrics.StreamTimer() if timed else None
+    full_response = ""
+    for i in range(tokens):
+        token = f"tok{i % 50} "
+        full_response += token
+        if timer:
+            timer.token()
+        await coalescer.add(token)
+        await asyncio.sleep(0)
+    await coalescer.aclose()
+    if timer:
+        timer.finish()
+
+
+async def run_mode(args: argparse.Namespace, timed: bool) -> float:
+    """Return CPU microseconds per token (best of ``--repeat`` runs)."""
+    best = float("inf")
+    for _ in range(args.repeat):
+        cpu_start = time.process_time()
+        await asyncio.gather(*(run_stream(FakeWebSocket(), args.tokens, timed) for _ in range(args.streams)))
+        cpu = time.process_time() - cpu_start
+        best = min(best, cpu / (args.streams * args.tokens) * 1e6)
+    return best
+
+
+def time_scrape(widgets: int) -> dict:
+    gauge = metrics.ws_connections
+    original = gauge.collect
+    gauge.collect = lambda: {(f"widget-{i}",): 3 for i in range(widgets)}
+    try:
+        start = time.perf_counter()
+        body = metrics.registry.render()
+        elapsed = time.perf_counter() - start
+    finally:
+        gauge.collect = original
+    return {"widgets": widgets, "render_ms": round(elapsed * 1000, 3), "bytes": len(body)}
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scrape-widgets", type=int, default=1000)
+    args = parser.parse_args()
+
+    baseline = await run_mode(args, timed=False)
+    instrumented = await run_mode(args, timed=True)
+    print(json.dumps({
+        "cpu_us_per_token": {
+            "baseline": round(baseline, 3),
+            "instrumented": round(instrumented, 3),
+            "overhead": round(instrumented - baseline, 3),
+            "overhead_percent": round((instrumented - baseline) / baseline * 100, 1),
+        },
+        "scrape": time_scrape(args.scrape_widgets),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
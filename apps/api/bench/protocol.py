@@ -0,0 +1,139 @@
+"""Compare wire size and codec cost of protocol v1 (JSON) and v2 (MessagePack).
+
+Run from ``apps/api``:
+
+    python -m bench.protocol --responses 200 --tokens 300 --tokens-per-frame 4
+
+Each simulated response is a ``thinking`` status, coalesced token frames and
+a completion, numbered like ``ResumableStream`` numbers them. Sizes are
+reported raw and with permessage-deflate emulated the way the server
+negotiates it (raw deflate, 4096-byte window, context kept across messages).
+"""
+
+import argparse
+import json
+import random
+import time
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Dict, List, Union
+
+import msgpack
+
+from protocol import JSON_CODEC, MsgpackCodec
+
+WORDS = (
+    "the window glass frame double glazing quote install energy rating seal "
+    "warranty measure installer price door pane argon coating thermal noise "
+    "replacement survey condensation bespoke we your can will be is a and to"
+).split()
+
+
+def simulate_response(rng: random.Random, session_id: str, tokens: int, per_frame: int) -> List[Dict[str, Any]]:
+    """Frames for one response, as ``process_message`` sends them."""
+    words = [rng.choice(WORDS) + " " for _ in range(tokens)]
+    frames: List[Dict[str, Any]] = [{
+        "type": "status",
+        "message": "thinking",
+        "session_id": session_id,
+        "timestamp": datetime.now().isoformat(),
+    }]
+    for i in range(0, tokens, per_frame):
+        chunk = words[i:i + per_frame]
+        frames.append({
+            "type": "token",
+            "token": "".join(chunk),
+            "count": len(chunk),
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat(),
+        })
+    frames.append({
+        "type": "completion",
+        "message": "".join(words),
+        "session_id": session_id,
+        "timestamp": datetime.now().isoformat(),
+    })
+    for seq, frame in enumerate(frames, start=1):
+        frame["seq"] = seq
+    return frames
+
+
+class DeflateStream:
+    """permessage-deflate for one connection, as negotiated by uvicorn."""
+
+    def __init__(self) -> None:
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -12)
+
+    def compress(self, payload: bytes) -> bytes:
+        data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        # The trailing empty block is stripped on the wire (RFC 7692)
+        return data[:-4]
+
+
+def measure(codec: Any, responses: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    payloads: List[List[Union[str, bytes]]] = []
+    start = time.perf_counter()
+    for frames in responses:
+        payloads.append([codec.encode(frame) for frame in frames])
+    encode = time.perf_counter() - start
+
+    encoded = [[p.encode("utf-8") if isinstance(p, str) else p for p in response] for response in payloads]
+    start = time.perf_counter()
+    for response in encoded:
+        for payload in response:
+            if codec is JSON_CODEC:
+                json.loads(payload)
+            else:
+                msgpack.unpackb(payload)
+    decode = time.perf_counter() - start
+
+    raw = 0
+    deflated = 0
+    for response in encoded:
+        # One connection per response, so deflate only sees that response's history
+        deflate = DeflateStream()
+        for payload in response:
+            raw += len(payload)
+            deflated += len(deflate.compress(payload))
+
+    frame_count = sum(len(response) for response in responses)
+    return {
+        "bytes_per_response": round(raw / len(responses), 1),
+        "deflated_bytes_per_response": round(deflated / len(responses), 1),
+        "encode_us_per_frame": round(encode / frame_count * 1e6, 3),
+        "decode_us_per_frame": round(decode / frame_count * 1e6, 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--responses", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--tokens-per-frame", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    responses = [
+        simulate_response(rng, str(uuid.UUID(int=rng.getrandbits(128))), args.tokens, args.tokens_per_frame)
+        for _ in range(args.responses)
+    ]
+
+    v1 = measure(JSON_CODEC, responses)
+    v2 = measure(MsgpackCodec(), responses)
+    print(json.dumps({
+        "frames_per_response": len(responses[0]),
+        "v1_json": v1,
+        "v2_msgpack": v2,
+        "v2_bytes_saved_percent": {
+            "raw": round((1 - v2["bytes_per_response"] / v1["bytes_per_response"]) * 100, 1),
+            "deflated": round(
+                (1 - v2["deflated_bytes_per_response"] / v1["deflated_bytes_per_response"]) * 100, 1
+            ),
+        },
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Per-check cost of the edge rate limiter, and what a flood sees.
+
+- ``per_check``: microseconds per ``EdgeRateLimits.message`` (one bucket)
+  and ``connection`` (IP and widget buckets) across ``--keys`` live keys,
+  with ``json.loads`` of a chat frame - work every message already does -
+  for scale.
+- ``churn``: every check a new key, ``--churn-keys`` of them against a
+  bucket cap of ``--max-buckets``, so buckets are evicted. Reports the
+  average and the worst single check.
+- ``redis``: with ``--redis-url``, the same message check through the Lua
+  script, round trip included.
+- ``flood``: against a spawned API with tight limits, one client opens
+  ``--connections`` sockets at once and one session sends ``--messages``
+  prompts at once. Counts what was let through and refused, and how long a
+  refused client waited to hear so.
+
+Run from ``apps/api``:
+
+    python -m bench.rate_limit --keys 10000 --checks 200000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Dict, List
+
+import websockets
+
+from bench.common import spawn_api, stop, summarize_latencies, wait_for_http
+from ratelimit import EdgeRateLimits, Limit, MemoryRateLimiter, RedisRateLimiter
+
+FRAME = json.dumps({"type": "message", "message": "How much are double glazed sash windows?"})
+
+
+def limits(limiter: Any) -> EdgeRateLimits:
+    # Generous enough that the checks measured are the common, allowed case
+    return EdgeRateLimits(
+        limiter,
+        enabled=True,
+        per_ip=Limit("ip", 1000, 1000),
+        per_widget=Limit("widget", 1000, 1000),
+        per_session=Limit("message", 1000, 1000),
+    )
+
+
+async def time_checks(check: Any, keys: List[str], checks: int) -> float:
+    """Microseconds per call of ``check(key)``, cycling through ``keys``."""
+    start = time.perf_counter()
+    for i in range(checks):
+        await check(keys[i % len(keys)])
+    return round((time.perf_counter() - start) / checks * 1_000_000, 2)
+
+
+async def per_check(args: argparse.Namespace) -> Dict[str, Any]:
+    edge = limits(MemoryRateLimiter())
+    sessions = [f"session-{i}" for i in range(args.keys)]
+    ips = [f"10.0.{i // 256 % 256}.{i % 256}" for i in range(args.keys)]
+    widgets = [f"widget-{i % 20}" for i in range(args.keys)]
+
+    async def connection(key: str) -> float:
+        i = int(key)
+        return await edge.connection(ips[i], widgets[i])
+
+    start = time.perf_counter()
+    for i in range(args.checks):
+        json.loads(FRAME)
+    parse_us = round((time.perf_counter() - start) / args.checks * 1_000_000, 2)
+    return {
+        "keys": args.keys,
+        "message_check_us": await time_checks(edge.message, sessions, args.checks),
+        "connection_check_us": await time_checks(connection, [str(i) for i in range(args.keys)], args.checks),
+        "json_parse_frame_us": parse_us,
+        "buckets": edge.stats()["buckets"],
+    }
+
+
+async def churn(args: argparse.Namespace) -> Dict[str, Any]:
+    limiter = MemoryRateLimiter(max_buckets=args.max_buckets)
+    # Slow refill, so evicted buckets are mostly not yet full
+    limit = Limit("message", 0.01, 5)
+    timings = []
+    start = time.perf_counter()
+    for i in range(args.churn_keys):
+        began = time.perf_counter()
+        limiter.take(limit, f"session-{i}")
+        timings.append((time.perf_counter() - began) * 1000)
+    elapsed = time.perf_counter() - start
+    return {
+        "checks": args.churn_keys,
+        "max_buckets": args.max_buckets,
+        "check_us_avg": round(elapsed / args.churn_keys * 1_000_000, 2),
+        "check_ms": summarize_latencies(timings),
+        "evicted": limiter.evicted,
+        "buckets_at_end": limiter.stats()["buckets"],
+    }
+
+
+async def redis(args: argparse.Namespace) -> Dict[str, Any]:
+    import redis.asyncio as aioredis
+
+    client = aioredis.from_url(args.redis_url, decode_responses=True)
+    limiter = RedisRateLimiter(client, timeout_ms=1000)
+    edge = limits(limiter)
+    sessions = [f"bench-session-{i}" for i in range(args.keys)]
+    checks = min(args.checks, 20000)
+    result = {
+        "message_check_us": await time_checks(edge.message, sessions, checks),
+        "redis_errors": limiter.errors,
+    }
+    await client.aclose()
+    return result
+
+
+async def flood(args: argparse.Namespace) -> Dict[str, Any]:
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    ws_url = f"ws://127.0.0.1:{args.api_port}/ws/bench"
+    api = spawn_api(args.api_port, {
+        "USE_FAKE_LLM": "true",
+        "TENANT_STORE": "none",
+        "RATE_LIMIT_IP_RATE": "1",
+        "RATE_LIMIT_IP_BURST": "20",
+        "RATE_LIMIT_MESSAGE_RATE": "0.5",
+        "RATE_LIMIT_MESSAGE_BURST": "5",
+    }, quiet=True)
+    try:
+        await wait_for_http(f"{api_url}/healthz")
+
+        async def connect() -> Dict[str, Any]:
+            start = time.perf_counter()
+            try:
+                async with websockets.connect(ws_url) as ws:
+                    frame = json.loads(await ws.recv())
+                    if frame.get("code") == "rate_limited":
+                        try:
+                            await ws.recv()
+                        except websockets.ConnectionClosed as e:
+                            return {
+                                "refused": True,
+                                "close_code": e.rcvd.code if e.rcvd else None,
+                                "retry_after": frame["retry_after"],
+                                "ms": (time.perf_counter() - start) * 1000,
+                            }
+                    return {"refused": False}
+            except Exception as e:
+                return {"refused": False, "error": str(e)}
+
+        connections = await asyncio.gather(*(connect() for _ in range(args.connections)))
+        refused = [c for c in connections if c.get("refused")]
+
+        # Let the IP's bucket refill before the message flood
+        await asyncio.sleep(2)
+        async with websockets.connect(ws_url) as ws:
+            await ws.recv()
+            start = time.perf_counter()
+            for i in range(args.messages):
+                await ws.send(json.dumps({"type": "message", "message": f"Question {i}"}))
+            limited: List[float] = []
+            retry_after = None
+            deadline = time.perf_counter() + 3
+            while time.perf_counter() < deadline:
+                try:
+                    frame = json.loads(await asyncio.wait_for(ws.recv(), 0.5))
+                except asyncio.TimeoutError:
+                    continue
+                if frame.get("code") == "rate_limited":
+                    limited.append((time.perf_counter() - start) * 1000)
+                    retry_after = frame["retry_after"]
+        return {
+            "connections": args.connections,
+            "connections_refused": len(refused),
+            "refused_close_codes": sorted({c["close_code"] for c in refused}),
+            "refused_retry_after": max((c["retry_after"] for c in refused), default=None),
+            "refused_connection_ms": summarize_latencies([c["ms"] for c in refused]),
+            "messages": args.messages,
+            "messages_refused": len(limited),
+            "message_retry_after": retry_after,
+            "refused_message_ms": summarize_latencies(limited),
+        }
+    finally:
+        stop(api)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--checks", type=int, default=200000)
+    parser.add_argument("--churn-keys", type=int, default=300000)
+    parser.add_argument("--max-buckets", type=int, default=100000)
+    parser.add_argument("--redis-url", default="", help="Also time the Redis backend (e.g. redis://localhost:6379/0)")
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--api-port", type=int, default=8131)
+    args = parser.parse_args()
+
+    results: Dict[str, Any] = {
+        "per_check": await per_check(args),
+        "churn": await churn(args),
+    }
+    if args.redis_url:
+        results["redis"] = await redis(args)
+    results["flood"] = await flood(args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
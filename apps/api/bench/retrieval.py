@@ -0,0 +1,142 @@
+"""Query latency and memory of the knowledge index at increasing sizes.
+
+Fills a fresh ``VectorIndex`` with synthetic unit vectors (documents of
+``--doc-chunks`` chunks) for each size, then reports:
+
+- single-query and batched top-k latency of ``VectorIndex.search``
+- end-to-end ``KnowledgeBase.search`` latency, including embedding the
+  query with the local hashing embedder
+- incremental add and delete latency on the full index
+- index size on disk and process RSS once the index has been searched
+
+Run from ``apps/api``:
+
+    python -m bench.retrieval --sizes 10000,100000,1000000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+from bench.common import summarize_latencies
+from retrieval import HashEmbedder, KnowledgeBase, VectorIndex
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def random_unit_vectors(rng: np.random.Generator, count: int, dim: int) -> np.ndarray:
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def fill(index: VectorIndex, size: int, doc_chunks: int, rng: np.random.Generator) -> None:
+    for start in range(0, size, doc_chunks):
+        count = min(doc_chunks, size - start)
+        texts = [f"chunk {start + i} of the synthetic knowledge base" for i in range(count)]
+        index.add(f"doc-{start // doc_chunks}", texts, random_unit_vectors(rng, count, index.dim), [12] * count)
+
+
+def time_ms(fn: Any, *args: Any) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+async def run_size(size: int, args: argparse.Namespace, root: str) -> Dict[str, Any]:
+    rng = np.random.default_rng(size)
+    embedder = HashEmbedder(args.dim)
+    rss_before = rss_mb()
+
+    build_start = time.perf_counter()
+    index = VectorIndex.open(root, "bench", args.dim, create=True)
+    fill(index, size, args.doc_chunks, rng)
+    build_seconds = time.perf_counter() - build_start
+    disk_mb = sum(
+        os.path.getsize(os.path.join(index.path, name)) for name in os.listdir(index.path)
+    ) / 1024 / 1024
+
+    # Queries near stored rows, so there are real nearest neighbours
+    stored = np.asarray(index._view[0][rng.integers(0, size, args.queries)])
+    queries = stored + 0.1 * random_unit_vectors(rng, args.queries, args.dim)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    index.search(queries[:1], args.k)
+    single = [time_ms(index.search, queries[i:i + 1], args.k) for i in range(args.queries)]
+    batches = [
+        time_ms(index.search, queries[i:i + args.batch], args.k)
+        for i in range(0, args.queries - args.batch + 1, args.batch)
+    ]
+    rss_after = rss_mb()
+
+    knowledge = KnowledgeBase(root=root, embedder=embedder, enabled=True)
+    knowledge.indexes["bench"] = index
+    texts = [f"synthetic knowledge chunk {i} opening hours glazing" for i in range(args.queries)]
+    end_to_end = []
+    for text in texts:
+        start = time.perf_counter()
+        await knowledge.search("bench", text)
+        end_to_end.append((time.perf_counter() - start) * 1000)
+
+    # Concurrent messages: batched into shared thread searches
+    start = time.perf_counter()
+    await asyncio.gather(*(knowledge.search("bench", text) for text in texts))
+    concurrent_ms = (time.perf_counter() - start) * 1000
+
+    add_ms = [
+        time_ms(index.add, f"new-{i}", ["new chunk"] * 10, random_unit_vectors(rng, 10, args.dim), [3] * 10)
+        for i in range(20)
+    ]
+    delete_ms = [time_ms(index.delete, f"new-{i}") for i in range(20)]
+    index.close()
+
+    return {
+        "chunks": size,
+        "build_seconds": round(build_seconds, 2),
+        "index_disk_mb": round(disk_mb, 1),
+        "rss_mb_added": round(rss_after - rss_before, 1),
+        "search_ms": summarize_latencies(single),
+        f"search_batch{args.batch}_ms_per_query": round(float(np.mean(batches)) / args.batch, 3) if batches else None,
+        "knowledge_search_ms": summarize_latencies(end_to_end),
+        "concurrent_searches_ms_per_query": round(concurrent_ms / args.queries, 3),
+        "knowledge_batches": knowledge.batches,
+        "add_10_chunks_ms": summarize_latencies(add_ms),
+        "delete_doc_ms": summarize_latencies(delete_ms),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--doc-chunks", type=int, default=1000)
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        root = tempfile.mkdtemp(prefix="glazing-rag-bench-")
+        try:
+            results.append(await run_size(size, args, root))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
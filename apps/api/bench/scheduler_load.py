@@ -0,0 +1,88 @@
+"""Load test the fair-share admission scheduler with many tenants on FakeLLM.
+
+One noisy tenant floods the API while many quiet tenants send a few
+messages each, all through ``get_admitted_llm_response`` backed by
+``FakeLLM``. Compares per-tenant queue wait with fair sharing against a
+plain global FIFO limit of the same size. Run from ``apps/api``:
+
+    python -m bench.scheduler_load --quiet-tenants 20 --noisy-requests 150
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ["USE_FAKE_LLM"] = "true"
+
+import scheduler as scheduler_module  # noqa: E402
+from bench.common import percentile  # noqa: E402
+from scheduler import AdmissionRejected, AdmissionScheduler, get_admitted_llm_response  # noqa: E402
+
+
+async def one_request(widget_key: str, results: dict) -> None:
+    start = time.perf_counter()
+    first = None
+    try:
+        async for _token in get_admitted_llm_response(prompt="do you do double glazing?", widget_key=widget_key):
+            if first is None:
+                first = time.perf_counter() - start
+        results.setdefault(widget_key, []).append(first * 1000)
+    except AdmissionRejected:
+        results.setdefault(f"{widget_key}:rejected", []).append(1)
+
+
+async def run(args: argparse.Namespace, fair: bool) -> dict:
+    scheduler_module.scheduler = AdmissionScheduler(
+        max_concurrency=args.global_cap,
+        # A FIFO baseline: no per-tenant caps, deep queues
+        widget_concurrency=args.widget_cap if fair else args.global_cap,
+        widget_tpm=args.widget_tpm if fair else 0,
+        max_queue_depth=100000,
+        widget_queue_depth=args.widget_queue if fair else 100000,
+        queue_timeout=600,
+    )
+    results: dict = {}
+    tasks = [one_request("noisy", results) for _ in range(args.noisy_requests)]
+    # Quiet tenants arrive slightly after the flood starts
+    await asyncio.sleep(0)
+
+    async def quiet(i: int) -> None:
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*(one_request(f"quiet-{i}", results) for _ in range(args.quiet_requests)))
+
+    await asyncio.gather(*tasks, *(quiet(i) for i in range(args.quiet_tenants)))
+
+    quiet_ttft = [v for key, values in results.items() if key.startswith("quiet-") and "rejected" not in key for v in values]
+    noisy_ttft = results.get("noisy", [])
+    return {
+        "mode": "fair_share" if fair else "global_fifo",
+        "quiet_ttft_ms_p50": round(percentile(quiet_ttft, 50), 1),
+        "quiet_ttft_ms_p95": round(percentile(quiet_ttft, 95), 1),
+        "noisy_ttft_ms_p50": round(percentile(noisy_ttft, 50), 1),
+        "noisy_ttft_ms_p95": round(percentile(noisy_ttft, 95), 1),
+        "noisy_rejected": len(results.get("noisy:rejected", [])),
+        "quiet_rejected": sum(len(v) for k, v in results.items() if k.startswith("quiet-") and "rejected" in k),
+        "scheduler_noisy": scheduler_module.scheduler.stats()["widgets"].get("noisy"),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--global-cap", type=int, default=16)
+    parser.add_argument("--widget-cap", type=int, default=4)
+    parser.add_argument("--widget-tpm", type=int, default=0)
+    parser.add_argument("--widget-queue", type=int, default=100)
+    parser.add_argument("--noisy-requests", type=int, default=150)
+    parser.add_argument("--quiet-tenants", type=int, default=20)
+    parser.add_argument("--quiet-requests", type=int, default=2)
+    args = parser.parse_args()
+
+    fifo = await run(args, fair=False)
+    fair = await run(args, fair=True)
+    print(json.dumps({"before": fifo, "after": fair}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
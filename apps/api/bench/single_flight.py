@@ -0,0 +1,162 @@
+"""Burst of identical opening questions with and without single-flight.
+
+Simulates a newsletter going out: ``--clients`` visitors open the widget
+within ``--spread-ms`` and ask one of a few starter questions. Every
+request goes through ``get_cached_llm_response`` and the admission
+scheduler to the local OpenAI stub, once with single-flight off (each
+cache miss calls upstream) and once with it on (identical in-flight
+requests share one upstream stream). The response cache is on in both
+runs, so only requests that arrive while an answer is still streaming
+differ. A fraction of clients disconnect after their first token to
+check that this doesn't cut the shared stream short for the others.
+
+Reports upstream requests made, time to first token, requests shed by
+the scheduler and how many clients received the complete answer. Run
+from ``apps/api``:
+
+    python -m bench.single_flight --clients 500 --questions 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter
+from contextlib import aclosing
+from typing import Any, Dict, List
+
+import httpx
+
+from bench.common import percentile, spawn_stub, stop, wait_for_http
+
+QUESTIONS = [
+    "What are your opening hours?",
+    "Do you do double glazing?",
+    "How much does a new front door cost?",
+    "Can I get a free quote?",
+    "Do you cover my area?",
+]
+
+
+async def run_mode(args: argparse.Namespace, stub_url: str, single_flight: bool) -> Dict[str, Any]:
+    import cache
+    import scheduler as scheduler_module
+    from scheduler import AdmissionRejected, AdmissionScheduler
+
+    cache.LLM_SINGLE_FLIGHT = single_flight
+    cache.response_cache = cache.ResponseCache()
+    cache.single_flight = cache.SingleFlight()
+    scheduler_module.scheduler = AdmissionScheduler(
+        max_concurrency=args.global_cap,
+        widget_concurrency=args.widget_cap,
+        widget_tpm=0,
+        max_queue_depth=args.global_queue,
+        widget_queue_depth=args.widget_queue,
+    )
+
+    rng = random.Random(1)
+    ttfts: List[float] = []
+    outcomes: Counter = Counter()
+
+    async def client(delay: float, question: str, disconnect: bool) -> None:
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+        received = 0
+        try:
+            async with aclosing(cache.get_cached_llm_response(
+                prompt=question,
+                system_prompt="You are a helpful assistant for a glazing company.",
+                widget_key="newsletter",
+                messages=[{"role": "user", "content": question}],
+            )) as stream:
+                async for _ in stream:
+                    if not received:
+                        ttfts.append((time.perf_counter() - start) * 1000)
+                    received += 1
+                    if disconnect:
+                        # Closing the stream is what a dropped WebSocket does
+                        outcomes["disconnected"] += 1
+                        return
+        except AdmissionRejected:
+            outcomes["rejected"] += 1
+            return
+        except Exception:
+            outcomes["error"] += 1
+            return
+        outcomes["complete" if received == args.tokens else "truncated"] += 1
+
+    async with httpx.AsyncClient() as http:
+        before = (await http.get(f"{stub_url}/stats")).json()["requests"]
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(
+            client(
+                rng.random() * args.spread_ms / 1000,
+                QUESTIONS[rng.randrange(args.questions)],
+                rng.random() < args.disconnect_rate,
+            )
+            for _ in range(args.clients)
+        ))
+        wall = time.perf_counter() - wall_start
+        after = (await http.get(f"{stub_url}/stats")).json()["requests"]
+
+    return {
+        "upstream_requests": after - before,
+        "clients": args.clients,
+        "outcomes": dict(outcomes),
+        "ttft_ms_p50": round(percentile(ttfts, 50), 1),
+        "ttft_ms_p95": round(percentile(ttfts, 95), 1),
+        "ttft_ms_p99": round(percentile(ttfts, 99), 1),
+        "cache": {k: cache.response_cache.stats()[k] for k in ("hits", "misses")},
+        "single_flight": cache.single_flight.stats(),
+        "wall_seconds": round(wall, 2),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--questions", type=int, default=3, help=f"Distinct starter questions (max {len(QUESTIONS)})")
+    parser.add_argument("--spread-ms", type=float, default=3000, help="Window the clients arrive in")
+    parser.add_argument("--disconnect-rate", type=float, default=0.1)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=400)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--token-delay-ms", type=float, default=20)
+    # Admission limits; the defaults are the server's. Raise them to see
+    # the upstream load without shedding
+    parser.add_argument("--global-cap", type=int, default=32)
+    parser.add_argument("--global-queue", type=int, default=200)
+    parser.add_argument("--widget-cap", type=int, default=4)
+    parser.add_argument("--widget-queue", type=int, default=20)
+    args = parser.parse_args()
+    args.questions = min(args.questions, len(QUESTIONS))
+
+    stub_url = f"http://127.0.0.1:{args.port}"
+    os.environ.update({
+        "USE_FAKE_LLM": "false",
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "sk-stub",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+    })
+
+    stub = spawn_stub(
+        args.port, "--ttft-ms", str(args.ttft_ms), "--tokens", str(args.tokens),
+        "--token-delay-ms", str(args.token_delay_ms),
+    )
+    try:
+        await wait_for_http(f"{stub_url}/stats")
+        results = {
+            "before": await run_mode(args, stub_url, single_flight=False),
+            "after": await run_mode(args, stub_url, single_flight=True),
+        }
+    finally:
+        from llm_client import llm_clients
+
+        await llm_clients.aclose()
+        stop(stub)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
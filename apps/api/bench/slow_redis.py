@@ -0,0 +1,136 @@
+"""Show that a slow Redis no longer stalls other sessions' token streams.
+
+Streams tokens for a set of already-connected sessions while new sessions
+connect and every write to the fake Redis takes ``--redis-latency-ms``.
+The blocking mode reproduces the old synchronous ``setex`` call made from
+the event loop; the async mode goes through ``RedisSessionStore``. Run from
+``apps/api``:
+
+    python -m bench.slow_redis --redis-latency-ms 200
+
+Exits non-zero if the async store lets the inter-token gap exceed the
+threshold.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from sessions import RedisSessionStore
+
+
+class SlowPipeline:
+    def __init__(self, redis: "SlowRedis") -> None:
+        self.redis = redis
+        self.ops = []
+
+    def setex(self, key, ttl, value):
+        self.ops.append(("setex", key, ttl, value))
+
+    def expire(self, key, ttl):
+        self.ops.append(("expire", key, ttl))
+
+    async def execute(self):
+        await asyncio.sleep(self.redis.latency)
+        self.redis.round_trips += 1
+        self.redis.writes += len(self.ops)
+        return [True] * len(self.ops)
+
+
+class SlowRedis:
+    """Fake asyncio Redis where every round-trip takes ``latency`` seconds."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.round_trips = 0
+        self.writes = 0
+
+    def pipeline(self, transaction: bool = True) -> SlowPipeline:
+        return SlowPipeline(self)
+
+    async def get(self, key):
+        await asyncio.sleep(self.latency)
+        return None
+
+    async def ping(self):
+        await asyncio.sleep(self.latency)
+        return True
+
+    def setex_blocking(self, key, ttl, value):
+        # What the old synchronous client did on the event loop
+        time.sleep(self.latency)
+        self.round_trips += 1
+        self.writes += 1
+
+
+async def stream_tokens(tokens: int, delay: float, gaps: list) -> None:
+    last = time.perf_counter()
+    for _ in range(tokens):
+        await asyncio.sleep(delay)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+
+async def run(mode: str, args: argparse.Namespace) -> dict:
+    redis = SlowRedis(args.redis_latency_ms / 1000)
+    store = RedisSessionStore(redis)
+    await store.start()
+
+    async def connect(i: int) -> None:
+        session_id = f"session-{i}"
+        data = {"widget_key": "bench", "created_at": time.time()}
+        if mode == "blocking":
+            redis.setex_blocking(f"session:{session_id}", 86400, json.dumps(data))
+        else:
+            await store.create(session_id, data)
+        await store.touch(session_id)
+
+    async def connect_storm() -> None:
+        for i in range(args.new_sessions):
+            await connect(i)
+            await asyncio.sleep(args.connect_interval_ms / 1000)
+
+    gaps: list = []
+    await asyncio.gather(
+        connect_storm(),
+        *(stream_tokens(args.tokens, args.token_delay_ms / 1000, gaps) for _ in range(args.streams)),
+    )
+    await store.close()
+
+    gaps.sort()
+    return {
+        "mode": mode,
+        "redis_round_trips": redis.round_trips,
+        "redis_writes": redis.writes,
+        "inter_token_ms_p50": round(gaps[len(gaps) // 2] * 1000, 2),
+        "inter_token_ms_p99": round(gaps[int(len(gaps) * 0.99) - 1] * 1000, 2),
+        "inter_token_ms_max": round(gaps[-1] * 1000, 2),
+    }
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-latency-ms", type=float, default=200)
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--token-delay-ms", type=float, default=20)
+    parser.add_argument("--new-sessions", type=int, default=20)
+    parser.add_argument("--connect-interval-ms", type=float, default=50)
+    parser.add_argument("--max-gap-ms", type=float, default=100)
+    args = parser.parse_args()
+
+    blocking = await run("blocking", args)
+    pipelined = await run("async", args)
+    print(json.dumps({"before": blocking, "after": pipelined}, indent=2))
+
+    if pipelined["inter_token_ms_max"] > args.max_gap_ms:
+        print(f"FAIL: token stream stalled for {pipelined['inter_token_ms_max']}ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
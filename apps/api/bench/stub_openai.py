@@ -0,0 +1,139 @@
+"""Local OpenAI-compatible streaming stub server.
+
+Serves ``POST /v1/chat/completions`` with ``stream=true`` as server-sent
+events so the real client path can be exercised without API costs. Run
+from ``apps/api``:
+
+    python -m bench.stub_openai --port 9100 --ttft-ms 50 --token-delay-ms 5
+
+then point the API at it with ``OPENAI_BASE_URL=http://127.0.0.1:9100/v1``.
+
+Faults can be injected to exercise failover: ``--error-rate`` answers that
+fraction of requests with HTTP 500 after ``--error-delay-ms``, and
+``--slow-rate`` adds ``--slow-ms`` to that fraction's time to first token.
+``POST /faults`` with the same names (``error_rate``, ``slow_ms``, ...)
+changes them while the stub is running, e.g. to start or end an outage.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_app(
+    ttft_ms: float = 50,
+    token_delay_ms: float = 5,
+    tokens: int = 50,
+    error_rate: float = 0,
+    error_delay_ms: float = 0,
+    slow_rate: float = 0,
+    slow_ms: float = 0,
+    seed: Optional[int] = None,
+) -> FastAPI:
+    """Build the stub app with the given timing and fault profile."""
+    app = FastAPI(title="OpenAI stub")
+    app.state.requests = 0
+    app.state.tokens_streamed = 0
+    app.state.errors = 0
+    app.state.faults = {
+        "error_rate": error_rate,
+        "error_delay_ms": error_delay_ms,
+        "slow_rate": slow_rate,
+        "slow_ms": slow_ms,
+    }
+    rng = random.Random(seed)
+
+    def chunk(completion_id: str, model: str, content: str, finish: bool = False) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "delta": {} if finish else {"content": content},
+                "finish_reason": "stop" if finish else None,
+            }],
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        completion_id = f"chatcmpl-stub-{app.state.requests}"
+        model = body.get("model", "stub")
+        faults = app.state.faults
+
+        if rng.random() < faults["error_rate"]:
+            app.state.errors += 1
+            await asyncio.sleep(faults["error_delay_ms"] / 1000)
+            return JSONResponse(
+                {"error": {"message": "Injected failure", "type": "server_error"}},
+                status_code=500,
+            )
+        delay = ttft_ms + (faults["slow_ms"] if rng.random() < faults["slow_rate"] else 0)
+
+        async def events():
+            await asyncio.sleep(delay / 1000)
+            for i in range(tokens):
+                yield chunk(completion_id, model, f"token{i} ")
+                app.state.tokens_streamed += 1
+                await asyncio.sleep(token_delay_ms / 1000)
+            yield chunk(completion_id, model, "", finish=True)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def stats():
+        return {
+            "requests": app.state.requests,
+            "tokens_streamed": app.state.tokens_streamed,
+            "errors": app.state.errors,
+            "faults": app.state.faults,
+        }
+
+    @app.post("/faults")
+    async def set_faults(request: Request):
+        updates = await request.json()
+        app.state.faults.update({k: float(v) for k, v in updates.items() if k in app.state.faults})
+        return app.state.faults
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "stub", "object": "model"}]}
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=50)
+    parser.add_argument("--token-delay-ms", type=float, default=5)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-delay-ms", type=float, default=0)
+    parser.add_argument("--slow-rate", type=float, default=0)
+    parser.add_argument("--slow-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    app = create_app(
+        args.ttft_ms, args.token_delay_ms, args.tokens,
+        args.error_rate, args.error_delay_ms, args.slow_rate, args.slow_ms, args.seed,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
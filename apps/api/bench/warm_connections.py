@@ -0,0 +1,91 @@
+"""Measure time-to-first-token with per-request vs pooled upstream clients.
+
+Starts the local stub server and streams the same chat completion through
+``get_llm_response`` once with a fresh ``openai.AsyncClient`` per request
+(the old behaviour) and once through the shared ``llm_clients`` pool. Run
+from ``apps/api``:
+
+    python -m bench.warm_connections --requests 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from bench.common import spawn_stub, stop, wait_for_http
+
+
+async def measure(requests: int) -> list:
+    from llm import get_llm_response
+
+    ttfts = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        first = None
+        async for _token in get_llm_response(prompt="opening hours?", system_prompt="stub"):
+            if first is None:
+                first = (time.perf_counter() - start) * 1000
+        ttfts.append(first)
+    return ttfts
+
+
+def summarize(ttfts: list) -> dict:
+    ordered = sorted(ttfts)
+    return {
+        "requests": len(ordered),
+        "ttft_ms_p50": round(statistics.median(ordered), 2),
+        "ttft_ms_p95": round(ordered[int(len(ordered) * 0.95) - 1], 2),
+        "ttft_ms_mean": round(statistics.mean(ordered), 2),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}/v1"
+    os.environ.update({
+        "USE_FAKE_LLM": "false",
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "sk-stub",
+        "OPENAI_BASE_URL": base_url,
+    })
+
+    stub = spawn_stub(args.port, "--ttft-ms", str(args.ttft_ms), "--tokens", "5")
+    try:
+        await wait_for_http(f"{base_url}/models")
+
+        import openai
+        from llm_client import llm_clients
+
+        # Old behaviour: a brand-new client (and connection) per message
+        async def fresh_client():
+            return openai.AsyncClient(base_url=base_url, api_key=os.environ["OPENAI_API_KEY"])
+
+        original = llm_clients.openai_client
+        llm_clients.openai_client = fresh_client
+        cold = await measure(args.requests)
+        llm_clients.openai_client = original
+
+        # New behaviour: shared pool warmed by the first request
+        await llm_clients.start()
+        warm = await measure(args.requests)
+        stats = llm_clients.stats()
+        await llm_clients.aclose()
+
+        print(json.dumps({
+            "per_request_client": summarize(cold),
+            "pooled_client": summarize(warm),
+            "pool_stats": stats,
+        }, indent=2))
+    finally:
+        stop(stub)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+"""Benchmark connection capacity as the number of uvicorn workers grows.
+
+Runs the same WebSocket load (see ``bench/ws_load.py``) against
+``run.py --prod`` with 1, 2, 4... workers and reports throughput, latency
+percentiles and total server CPU/RSS for each. Run from ``apps/api`` on a
+multi-core machine, with Redis if you want the connection bus exercised:
+
+    python -m bench.worker_scaling --workers 1 2 4 --connections 4000 --ramp 0
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from bench.common import API_DIR, stop, wait_for_http
+from bench.ws_load import add_load_args, fake_llm_env, raise_fd_limit, run_load
+
+
+def spawn_workers(port: int, workers: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "run.py", "--prod", "--workers", str(workers), "--port", str(port), "--host", "127.0.0.1"],
+        cwd=API_DIR,
+        env={**env, "LOG_LEVEL": "warning"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    add_load_args(parser)
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    runs = {}
+    for workers in args.workers:
+        server = spawn_workers(args.port, workers, {**os.environ, **fake_llm_env(args)})
+        try:
+            await wait_for_http(f"http://127.0.0.1:{args.port}/healthz", timeout=60)
+            # Give every worker time to boot before the ramp starts
+            await asyncio.sleep(1 + workers * 0.5)
+            report = await run_load(args, f"ws://127.0.0.1:{args.port}", server.pid, include_children=True)
+        finally:
+            stop(server)
+        results = report["results"]
+        runs[str(workers)] = {
+            "messages_per_sec": results["messages_per_sec"],
+            "connect_errors": results["connect_errors"],
+            "message_errors": results["message_errors"],
+            "connect_ms_p99": results["connect_ms"]["p99"],
+            "ttft_ms_p50": results["ttft_ms"]["p50"],
+            "ttft_ms_p99": results["ttft_ms"]["p99"],
+            "inter_token_ms_p99": results["inter_token_ms"]["p99"],
+            "server": report["server"],
+        }
+
+    text = json.dumps({"revision": report["revision"], "config": report["config"], "workers": runs}, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,209 @@
+"""WebSocket load test and latency benchmark for ``/ws/{widget_key}``.
+
+Opens many concurrent connections and drives a scripted conversation on
+each, recording connection setup time, time-to-first-token, inter-token
+latency and completion time, plus server RSS and CPU. By default it spawns
+the API with a deterministic FakeLLM profile so runs are repeatable. Run
+from ``apps/api``:
+
+    python -m bench.ws_load --connections 1000 --messages 3 --output load.json
+
+Results are JSON with stable keys; compare two runs with
+``python -m bench.compare before.json after.json``.
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import time
+from typing import Dict, List, Optional
+
+import websockets
+
+from bench.common import (
+    ProcessSampler,
+    git_revision,
+    spawn_api,
+    stop,
+    summarize_latencies,
+    wait_for_http,
+)
+
+SCRIPT = [
+    "Hi, do you do double glazing?",
+    "How much would three windows cost?",
+    "Can I book a free consultation?",
+    "What warranty do you offer?",
+]
+
+
+class Results:
+    def __init__(self) -> None:
+        self.connect_ms: List[float] = []
+        self.ttft_ms: List[float] = []
+        self.inter_token_ms: List[float] = []
+        self.completion_ms: List[float] = []
+        self.messages_completed = 0
+        self.connect_errors = 0
+        self.message_errors = 0
+
+
+async def run_client(
+    url: str, messages: int, think_time: float, timeout: float, results: Results
+) -> None:
+    start = time.perf_counter()
+    try:
+        ws = await asyncio.wait_for(websockets.connect(url, max_queue=None), timeout=timeout)
+    except Exception:
+        results.connect_errors += 1
+        return
+
+    try:
+        await asyncio.wait_for(ws.recv(), timeout=timeout)  # welcome frame
+        results.connect_ms.append((time.perf_counter() - start) * 1000)
+
+        for i in range(messages):
+            sent = time.perf_counter()
+            await ws.send(SCRIPT[i % len(SCRIPT)])
+            last_token: Optional[float] = None
+            while True:
+                frame = json.loads(await asyncio.wait_for(ws.recv(), timeout=timeout))
+                now = time.perf_counter()
+                if frame["type"] == "token":
+                    if last_token is None:
+                        results.ttft_ms.append((now - sent) * 1000)
+                    else:
+                        results.inter_token_ms.append((now - last_token) * 1000)
+                    last_token = now
+                elif frame["type"] == "completion":
+                    results.completion_ms.append((now - sent) * 1000)
+                    results.messages_completed += 1
+                    break
+                elif frame["type"] == "error":
+                    results.message_errors += 1
+                    break
+            if think_time:
+                await asyncio.sleep(think_time)
+    except Exception:
+        results.message_errors += 1
+    finally:
+        await ws.close()
+
+
+async def run_load(
+    args: argparse.Namespace, ws_base: str, server_pid: Optional[int], include_children: bool = False
+) -> Dict:
+    results = Results()
+    sampler = ProcessSampler(server_pid, include_children=include_children) if server_pid else None
+    if sampler:
+        sampler.start()
+
+    started = time.perf_counter()
+    clients = []
+    for i in range(args.connections):
+        url = f"{ws_base}/ws/bench-widget-{i % args.widgets}"
+        clients.append(asyncio.create_task(
+            run_client(url, args.messages, args.think_time, args.timeout, results)
+        ))
+        if args.ramp:
+            await asyncio.sleep(1 / args.ramp)
+    await asyncio.gather(*clients)
+    wall = time.perf_counter() - started
+
+    return {
+        "revision": git_revision(),
+        "config": {
+            "connections": args.connections,
+            "messages_per_connection": args.messages,
+            "widgets": args.widgets,
+            "ramp_per_sec": args.ramp,
+            "fake_llm_tokens": args.tokens,
+            "fake_llm_token_delay_ms": args.token_delay_ms,
+            "fake_llm_ttft_ms": args.ttft_ms,
+        },
+        "results": {
+            "wall_seconds": round(wall, 2),
+            "connect_errors": results.connect_errors,
+            "message_errors": results.message_errors,
+            "messages_completed": results.messages_completed,
+            "messages_per_sec": round(results.messages_completed / wall, 1),
+            "connect_ms": summarize_latencies(results.connect_ms),
+            "ttft_ms": summarize_latencies(results.ttft_ms),
+            "inter_token_ms": summarize_latencies(results.inter_token_ms),
+            "completion_ms": summarize_latencies(results.completion_ms),
+        },
+        "server": await sampler.stop() if sampler else {},
+    }
+
+
+def add_load_args(parser: argparse.ArgumentParser) -> None:
+    """Options shared by the scripts that drive ``run_load``."""
+    parser.add_argument("--port", type=int, default=8020)
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=2)
+    parser.add_argument("--widgets", type=int, default=50)
+    parser.add_argument("--ramp", type=float, default=500, help="new connections per second (0 = all at once)")
+    parser.add_argument("--think-time", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-delay-ms", type=float, default=20)
+    parser.add_argument("--ttft-ms", type=float, default=200)
+    parser.add_argument("--seed", default="1")
+    parser.add_argument("--output", help="write the JSON report here as well as stdout")
+
+
+def fake_llm_env(args: argparse.Namespace) -> Dict[str, str]:
+    """Environment for a spawned API running the deterministic FakeLLM."""
+    return {
+        "USE_FAKE_LLM": "true",
+        "FAKE_LLM_SEED": args.seed,
+        "FAKE_LLM_TOKENS": str(args.tokens),
+        "FAKE_LLM_TOKEN_DELAY_MS": str(args.token_delay_ms),
+        "FAKE_LLM_TTFT_MS": str(args.ttft_ms),
+        # Measure the streaming path, not cache hits or admission limits
+        "CACHE_ENABLED": "false",
+        "LLM_MAX_CONCURRENCY": "100000",
+        "LLM_WIDGET_CONCURRENCY": "100000",
+        "LLM_WIDGET_TPM": "0",
+    }
+
+
+def raise_fd_limit() -> None:
+    # Thousands of sockets need more than the default 1024 descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="ws:// base URL of a running API (default: spawn one)")
+    parser.add_argument("--server-pid", type=int, help="PID to sample RSS/CPU from when using --url")
+    add_load_args(parser)
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    server = None
+    ws_base = args.url
+    server_pid = args.server_pid
+    try:
+        if ws_base is None:
+            server = spawn_api(args.port, fake_llm_env(args), extra_args=["--backlog", "4096"], quiet=True)
+            await wait_for_http(f"http://127.0.0.1:{args.port}/healthz")
+            ws_base = f"ws://127.0.0.1:{args.port}"
+            server_pid = server.pid
+
+        report = await run_load(args, ws_base, server_pid)
+    finally:
+        if server:
+            stop(server)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
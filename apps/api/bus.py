@@ -0,0 +1,327 @@
+import os
+import json
+import uuid
+import socket
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Connection bus configuration
+BUS_USE_REDIS = os.environ.get("BUS_USE_REDIS", os.environ.get("USE_REDIS", "false")).lower() == "true"
+BUS_FLUSH_INTERVAL_MS = float(os.environ.get("BUS_FLUSH_INTERVAL_MS", "50"))
+# How long a session -> worker route survives if a worker dies without cleaning up
+BUS_ROUTE_TTL = int(os.environ.get("BUS_ROUTE_TTL", os.environ.get("SESSION_TTL", "86400")))
+
+# Unique per process, so each uvicorn worker gets its own channel
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+BROADCAST_CHANNEL = "bus:broadcast"
+
+# Delivers a frame to this worker's sockets: (target, ident, frame) -> sockets reached
+DeliverHandler = Callable[[str, Optional[str], Dict[str, Any]], Awaitable[int]]
+# Handles a control message broadcast to every worker: (ident, data)
+ControlHandler = Callable[[Optional[str], Dict[str, Any]], Awaitable[None]]
+
+
+class ConnectionBus:
+    """Routes frames to sessions and widget keys held by this process.
+
+    The in-memory bus only sees local connections; ``RedisConnectionBus``
+    extends it across uvicorn workers and hosts.
+    """
+
+    backend = "memory"
+
+    def __init__(self) -> None:
+        self.worker_id = WORKER_ID
+        self._handler: Optional[DeliverHandler] = None
+        self._control_handlers: Dict[str, ControlHandler] = {}
+        self._sessions: Dict[str, str] = {}
+        self._widgets: Dict[str, int] = {}
+        self.delivered = 0
+
+    def set_handler(self, handler: DeliverHandler) -> None:
+        """Set the coroutine that writes a routed frame to local sockets."""
+        self._handler = handler
+
+    def on_control(self, name: str, handler: ControlHandler) -> None:
+        """Register the coroutine run when control message ``name`` arrives."""
+        self._control_handlers[name] = handler
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def register(self, session_id: str, widget_key: str) -> None:
+        """Record that this worker holds ``session_id``'s socket."""
+        if session_id in self._sessions:
+            return
+        self._sessions[session_id] = widget_key
+        self._widgets[widget_key] = self._widgets.get(widget_key, 0) + 1
+
+    async def unregister(self, session_id: str) -> None:
+        widget_key = self._sessions.pop(session_id, None)
+        if widget_key is None:
+            return
+        remaining = self._widgets.get(widget_key, 0) - 1
+        if remaining > 0:
+            self._widgets[widget_key] = remaining
+        else:
+            self._widgets.pop(widget_key, None)
+
+    async def send_to_session(self, session_id: str, frame: Dict[str, Any]) -> int:
+        """Deliver ``frame`` to a session; returns the number of workers reached."""
+        if session_id in self._sessions:
+            await self._deliver("session", session_id, frame)
+            return 1
+        return 0
+
+    async def send_to_widget(self, widget_key: str, frame: Dict[str, Any]) -> int:
+        """Deliver ``frame`` to every connection of a widget key."""
+        if widget_key in self._widgets:
+            await self._deliver("widget", widget_key, frame)
+            return 1
+        return 0
+
+    async def broadcast(self, frame: Dict[str, Any]) -> int:
+        """Deliver ``frame`` to every connection."""
+        await self._deliver("all", None, frame)
+        return 1
+
+    async def broadcast_control(self, name: str, ident: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> int:
+        """Run control message ``name`` on every worker, this one included."""
+        await self._control(name, ident, data or {})
+        return 1
+
+    async def _control(self, name: str, ident: Optional[str], data: Dict[str, Any]) -> None:
+        handler = self._control_handlers.get(name)
+        if handler is None:
+            return
+        try:
+            await handler(ident, data)
+        except Exception as e:
+            logger.error(f"Error handling control message {name} {ident}: {str(e)}")
+
+    async def _deliver(self, target: str, ident: Optional[str], frame: Dict[str, Any]) -> int:
+        if self._handler is None:
+            return 0
+        try:
+            sent = await self._handler(target, ident, frame)
+        except Exception as e:
+            logger.error(f"Error delivering bus frame to {target} {ident}: {str(e)}")
+            return 0
+        self.delivered += sent
+        return sent
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "worker_id": self.worker_id,
+            "local_sessions": len(self._sessions),
+            "local_widgets": len(self._widgets),
+            "delivered": self.delivered,
+        }
+
+
+class RedisConnectionBus(ConnectionBus):
+    """Connection registry and message bus shared through Redis.
+
+    Each worker subscribes to its own channel plus a broadcast channel.
+    Routes are kept in Redis (``conn:session:{id}`` -> worker and
+    ``conn:widget:{key}`` -> {worker: connections}) and written behind in
+    pipelines, so connecting never waits on Redis. A frame for a session or
+    widget key is published only to the workers that hold its sockets.
+    """
+
+    backend = "redis"
+
+    def __init__(
+        self,
+        client: Any,
+        flush_interval_ms: float = BUS_FLUSH_INTERVAL_MS,
+        route_ttl: int = BUS_ROUTE_TTL,
+    ) -> None:
+        super().__init__()
+        self.client = client
+        self.flush_interval = flush_interval_ms / 1000
+        self.route_ttl = route_ttl
+        self.channel = f"bus:worker:{self.worker_id}"
+        # Pending route writes - a later op for a session replaces an earlier one
+        self._session_ops: Dict[str, Optional[str]] = {}
+        self._widget_deltas: Dict[str, int] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._listener: Optional[asyncio.Task] = None
+        self.published = 0
+        self.received = 0
+        self.stale_routes = 0
+
+    async def start(self) -> None:
+        if self._listener is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        tasks = [task for task in (self._flusher, self._listener) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._flusher = self._listener = None
+        # Drop this worker's routes so nobody publishes to a dead channel
+        for session_id in list(self._sessions):
+            await self.unregister(session_id)
+        await self.flush()
+
+    async def register(self, session_id: str, widget_key: str) -> None:
+        if session_id in self._sessions:
+            return
+        await super().register(session_id, widget_key)
+        self._session_ops[session_id] = widget_key
+        self._widget_deltas[widget_key] = self._widget_deltas.get(widget_key, 0) + 1
+
+    async def unregister(self, session_id: str) -> None:
+        widget_key = self._sessions.get(session_id)
+        await super().unregister(session_id)
+        if widget_key is None:
+            return
+        self._session_ops[session_id] = None
+        self._widget_deltas[widget_key] = self._widget_deltas.get(widget_key, 0) - 1
+
+    async def flush(self) -> None:
+        """Write pending route changes to Redis in one pipeline."""
+        if not self._session_ops and not self._widget_deltas:
+            return
+        session_ops, self._session_ops = self._session_ops, {}
+        widget_deltas, self._widget_deltas = self._widget_deltas, {}
+        try:
+            # One transaction, so a failed flush applied none of it and can
+            # be retried without counting any delta twice
+            pipe = self.client.pipeline(transaction=True)
+            for session_id, widget_key in session_ops.items():
+                if widget_key is None:
+                    pipe.delete(f"conn:session:{session_id}")
+                else:
+                    pipe.setex(f"conn:session:{session_id}", self.route_ttl, self.worker_id)
+            for widget_key, delta in widget_deltas.items():
+                if delta:
+                    pipe.hincrby(f"conn:widget:{widget_key}", self.worker_id, delta)
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error flushing {len(session_ops)} connection routes to Redis: {str(e)}")
+            # Keep them for the next flush - the widget counts are deltas, so
+            # dropping them would skew the count for good. Ops queued since
+            # are newer and win
+            for session_id, widget_key in session_ops.items():
+                self._session_ops.setdefault(session_id, widget_key)
+            for widget_key, delta in widget_deltas.items():
+                self._widget_deltas[widget_key] = self._widget_deltas.get(widget_key, 0) + delta
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _listen(self) -> None:
+        """Deliver frames published to this worker or broadcast to all."""
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel, BROADCAST_CHANNEL)
+                while True:
+                    # Poll with a timeout - the shared pool's socket timeout
+                    # would otherwise break a blocking read on a quiet channel
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    self.received += 1
+                    data = json.loads(message["data"])
+                    if "control" in data:
+                        await self._control(data["control"], data.get("id"), data.get("data") or {})
+                    else:
+                        await self._deliver(data["target"], data.get("id"), data["frame"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Connection bus subscriber failed, resubscribing: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+    async def _publish(self, worker_id: str, target: str, ident: Optional[str], frame: Dict[str, Any]) -> int:
+        payload = json.dumps({"target": target, "id": ident, "frame": frame})
+        receivers = await self.client.publish(f"bus:worker:{worker_id}", payload)
+        self.published += 1
+        return receivers
+
+    async def send_to_session(self, session_id: str, frame: Dict[str, Any]) -> int:
+        if session_id in self._sessions:
+            await self._deliver("session", session_id, frame)
+            return 1
+        worker_id = await self.client.get(f"conn:session:{session_id}")
+        if not worker_id:
+            return 0
+        if await self._publish(worker_id, "session", session_id, frame):
+            return 1
+        # Nobody listening - the worker died without cleaning up
+        self.stale_routes += 1
+        await self.client.delete(f"conn:session:{session_id}")
+        return 0
+
+    async def send_to_widget(self, widget_key: str, frame: Dict[str, Any]) -> int:
+        reached = 0
+        if widget_key in self._widgets:
+            await self._deliver("widget", widget_key, frame)
+            reached += 1
+        workers = await self.client.hgetall(f"conn:widget:{widget_key}")
+        for worker_id, count in workers.items():
+            if worker_id == self.worker_id:
+                continue
+            if int(count) <= 0:
+                await self.client.hdel(f"conn:widget:{widget_key}", worker_id)
+                continue
+            if await self._publish(worker_id, "widget", widget_key, frame):
+                reached += 1
+            else:
+                self.stale_routes += 1
+                await self.client.hdel(f"conn:widget:{widget_key}", worker_id)
+        return reached
+
+    async def broadcast(self, frame: Dict[str, Any]) -> int:
+        # Every worker, this one included, receives it through its subscription
+        payload = json.dumps({"target": "all", "id": None, "frame": frame})
+        self.published += 1
+        return await self.client.publish(BROADCAST_CHANNEL, payload)
+
+    async def broadcast_control(self, name: str, ident: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> int:
+        # Delivered back to this worker through its own subscription
+        payload = json.dumps({"control": name, "id": ident, "data": data or {}})
+        self.published += 1
+        return await self.client.publish(BROADCAST_CHANNEL, payload)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats.update({
+            "published": self.published,
+            "received": self.received,
+            "stale_routes": self.stale_routes,
+            "pending_routes": len(self._session_ops),
+        })
+        return stats
+
+
+def create_connection_bus() -> ConnectionBus:
+    """Build the configured connection bus."""
+    if BUS_USE_REDIS:
+        from redis_pool import get_redis
+
+        return RedisConnectionBus(get_redis())
+    return ConnectionBus()
+
+
+connection_bus = create_connection_bus()
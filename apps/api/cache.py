@@ -0,0 +1,362 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from metrics import llm_coalesced
+from scheduler import get_admitted_llm_response
+
+logger = logging.getLogger(__name__)
+
+# Response cache configuration
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "1000"))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", "3600"))
+CACHE_MAX_RESPONSE_CHARS = int(os.environ.get("CACHE_MAX_RESPONSE_CHARS", "8000"))
+CACHE_USE_REDIS = os.environ.get("CACHE_USE_REDIS", "false").lower() == "true"
+CACHE_REDIS_TIMEOUT_MS = float(os.environ.get("CACHE_REDIS_TIMEOUT_MS", "50"))
+# Comma-separated widget keys that never use the cache
+CACHE_DISABLED_WIDGETS = {
+    key.strip()
+    for key in os.environ.get("CACHE_DISABLED_WIDGETS", "").split(",")
+    if key.strip()
+}
+# Attach identical opening messages to a response already being generated
+LLM_SINGLE_FLIGHT = os.environ.get("LLM_SINGLE_FLIGHT", "true").lower() == "true"
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize a user prompt so trivially different questions share a key."""
+    return _WHITESPACE.sub(" ", prompt).strip().lower().rstrip("?!. ")
+
+
+def cache_key(system_prompt: Optional[str], prompt: str, model: str, temperature: float) -> str:
+    """Hash everything that determines the model's answer into a cache key."""
+    material = json.dumps(
+        [system_prompt or "", normalize_prompt(prompt), model, temperature],
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache of streamed responses.
+
+    Tier one is an in-process LRU bounded by entry count and TTL. Tier two
+    is an optional shared Redis tier; its reads are bounded by a short
+    timeout so a slow Redis degrades to a miss instead of adding latency.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        ttl: int = CACHE_TTL,
+        redis_client: Optional[Any] = None,
+        redis_timeout_ms: float = CACHE_REDIS_TIMEOUT_MS,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis = redis_client
+        self.redis_timeout = redis_timeout_ms / 1000
+        self._entries: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.redis_hits = 0
+        self.redis_errors = 0
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        """Return cached tokens for ``key``, checking the local tier first."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+            self.expirations += 1
+
+        if self.redis is not None:
+            try:
+                value = await asyncio.wait_for(
+                    self.redis.get(f"llmcache:{key}"), timeout=self.redis_timeout
+                )
+                if value:
+                    tokens = json.loads(value)
+                    self._store_local(key, tokens)
+                    self.hits += 1
+                    self.redis_hits += 1
+                    return tokens
+            except Exception as e:
+                self.redis_errors += 1
+                logger.warning(f"Response cache Redis read failed: {str(e)}")
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, tokens: List[str]) -> None:
+        """Store tokens in the local tier and, if enabled, in Redis."""
+        self._store_local(key, tokens)
+        if self.redis is not None:
+            try:
+                await asyncio.wait_for(
+                    self.redis.setex(f"llmcache:{key}", self.ttl, json.dumps(tokens)),
+                    timeout=self.redis_timeout,
+                )
+            except Exception as e:
+                self.redis_errors += 1
+                logger.warning(f"Response cache Redis write failed: {str(e)}")
+
+    def _store_local(self, key: str, tokens: List[str]) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, tokens)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss/eviction counters."""
+        return {
+            "enabled": CACHE_ENABLED,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "redis_enabled": self.redis is not None,
+            "redis_hits": self.redis_hits,
+            "redis_errors": self.redis_errors,
+        }
+
+
+def create_response_cache() -> ResponseCache:
+    """Build the response cache, attaching the Redis tier if configured."""
+    redis_client = None
+    if CACHE_USE_REDIS:
+        from redis_pool import get_redis
+
+        redis_client = get_redis()
+    return ResponseCache(redis_client=redis_client)
+
+
+response_cache = create_response_cache()
+
+
+class _Flight:
+    """An upstream response being generated, shared by identical requests."""
+
+    __slots__ = ("tokens", "done", "error", "subscribers", "task", "_changed")
+
+    def __init__(self) -> None:
+        self.tokens: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional["asyncio.Task[None]"] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, token: str) -> None:
+        self.tokens.append(token)
+        self._wake()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    """Coalesces identical in-flight upstream requests into one.
+
+    The first caller for a key starts the upstream stream in a task of its
+    own; callers arriving while it runs attach to it, get the tokens
+    emitted so far replayed and then follow the live stream. A caller
+    leaving doesn't affect the others; the upstream request is only
+    cancelled once every caller has gone.
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def stream(self, key: str, start: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Yield the tokens of the in-flight response for ``key``, starting it if needed."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._produce(key, flight, start()))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            llm_coalesced.inc()
+        flight.subscribers += 1
+
+        sent = 0
+        try:
+            while True:
+                changed = flight._changed
+                while sent < len(flight.tokens):
+                    token = flight.tokens[sent]
+                    sent += 1
+                    yield token
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                # Nobody is listening any more - stop generating
+                self._forget(key, flight)
+                flight.task.cancel()
+                await asyncio.gather(flight.task, return_exceptions=True)
+
+    async def _produce(self, key: str, flight: _Flight, stream: AsyncIterator[str]) -> None:
+        try:
+            async with aclosing(stream):
+                async for token in stream:
+                    flight.publish(token)
+        except BaseException as e:
+            flight.finish(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        else:
+            flight.finish()
+        finally:
+            # Later requests start afresh (or hit the response cache)
+            self._forget(key, flight)
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": LLM_SINGLE_FLIGHT,
+            "in_flight": len(self._flights),
+            "upstream_started": self.started,
+            "coalesced": self.coalesced,
+        }
+
+
+single_flight = SingleFlight()
+
+
+async def _emit(streaming_callback: Optional[Callable[[str], Any]], token: str) -> None:
+    if streaming_callback:
+        if asyncio.iscoroutinefunction(streaming_callback):
+            await streaming_callback(token)
+        else:
+            streaming_callback(token)
+
+
+async def _fetch(key: str, **kwargs: Any) -> AsyncIterator[str]:
+    """Stream a response upstream, storing it in the response cache if enabled."""
+    collected: List[str] = []
+    size = 0
+    meta: Dict[str, Any] = {}
+    async with aclosing(get_admitted_llm_response(meta=meta, **kwargs)) as stream:
+        async for token in stream:
+            size += len(token)
+            if size <= CACHE_MAX_RESPONSE_CHARS:
+                collected.append(token)
+            yield token
+
+    # Only cache complete, genuine responses - never an error fallback
+    if CACHE_ENABLED and collected and size <= CACHE_MAX_RESPONSE_CHARS and not meta.get("fallback"):
+        await response_cache.set(key, collected)
+
+
+async def get_cached_llm_response(
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    streaming_callback: Optional[Callable[[str], Any]] = None,
+    widget_key: Optional[str] = None,
+    messages: Optional[List[Dict[str, str]]] = None,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    system_prompt_tokens: Optional[int] = None,
+) -> AsyncIterator[str]:
+    """Serve ``get_llm_response`` through the response cache.
+
+    Misses go upstream through the admission scheduler. Hits replay the
+    stored tokens through ``streaming_callback`` so callers see the same
+    token stream as a live response. Only opening messages are cached -
+    once there is conversation history the answer depends on it. A miss
+    for a question that is already being answered joins that response
+    rather than making another upstream call.
+
+    ``model`` and ``temperature`` default to the environment settings.
+    """
+    if model is None:
+        model = os.environ.get("MODEL_NAME", "gpt-3.5-turbo")
+    if temperature is None:
+        temperature = float(os.environ.get("TEMPERATURE", "0.7"))
+    widget_key = widget_key or "default"
+
+    has_history = messages is not None and len(messages) > 1
+    if (
+        not (CACHE_ENABLED or LLM_SINGLE_FLIGHT)
+        or has_history
+        or widget_key in CACHE_DISABLED_WIDGETS
+    ):
+        async with aclosing(get_admitted_llm_response(
+            prompt=prompt,
+            system_prompt=system_prompt,
+            streaming_callback=streaming_callback,
+            widget_key=widget_key,
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            system_prompt_tokens=system_prompt_tokens,
+        )) as stream:
+            async for token in stream:
+                yield token
+        return
+
+    key = cache_key(system_prompt, prompt, model, temperature)
+
+    if CACHE_ENABLED:
+        tokens = await response_cache.get(key)
+        if tokens is not None:
+            logger.debug("Response cache hit for widget %s", widget_key)
+            for token in tokens:
+                await _emit(streaming_callback, token)
+                yield token
+            return
+
+    def fetch() -> AsyncIterator[str]:
+        return _fetch(
+            key,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            widget_key=widget_key,
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            system_prompt_tokens=system_prompt_tokens,
+        )
+
+    # Shared responses are keyed per widget too, so each tenant's requests
+    # are admitted and budgeted against its own limits
+    upstream = single_flight.stream(f"{widget_key}:{key}", fetch) if LLM_SINGLE_FLIGHT else fetch()
+    async with aclosing(upstream) as stream:
+        async for token in stream:
+            await _emit(streaming_callback, token)
+            yield token
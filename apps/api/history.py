@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Conversation history configuration
+HISTORY_MAX_TOKENS = int(os.environ.get("HISTORY_MAX_TOKENS", "2000"))
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", "50"))
+HISTORY_SUMMARY = os.environ.get("HISTORY_SUMMARY", "false").lower() == "true"
+HISTORY_SUMMARY_TOKENS = int(os.environ.get("HISTORY_SUMMARY_TOKENS", "200"))
+HISTORY_MAX_SESSIONS = int(os.environ.get("HISTORY_MAX_SESSIONS", "10000"))
+HISTORY_TTL = int(os.environ.get("HISTORY_TTL", os.environ.get("SESSION_TTL", "86400")))
+HISTORY_USE_REDIS = os.environ.get(
+    "HISTORY_USE_REDIS", os.environ.get("USE_REDIS", "false")
+).lower() == "true"
+
+# Tokens OpenAI adds per chat message for role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenCounter:
+    """Count tokens with tiktoken, falling back to an estimate if unavailable."""
+
+    def __init__(self, model: Optional[str] = None) -> None:
+        self.model = model or os.environ.get("MODEL_NAME", "gpt-3.5-turbo")
+        self._encoding: Any = None
+        self._loaded = False
+
+    def load(self) -> None:
+        """Load the encoding; may hit the network, so call it off the event loop."""
+        self._loaded = True
+        try:
+            import tiktoken
+
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # tiktoken missing or its encoding files can't be fetched offline
+            logger.warning(f"tiktoken unavailable, estimating token counts: {str(e)}")
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens in ``text``."""
+        if not self._loaded:
+            self.load()
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return max(len(text) // 4, 1)
+
+    def count_message(self, content: str) -> int:
+        """Return the tokens a chat message with ``content`` costs."""
+        return self.count(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+token_counter = TokenCounter()
+
+
+def summarize_turns(summary: str, dropped: List[Tuple[str, str]], max_tokens: int) -> str:
+    """Fold dropped turns into the running summary.
+
+    A deterministic, extractive summary: each dropped turn contributes its
+    first sentence, and the oldest material is cut once the summary exceeds
+    ``max_tokens``. Swap in an LLM-backed summarizer via ``HistoryStore``.
+    """
+    lines = [summary] if summary else []
+    for role, content in dropped:
+        first_sentence = content.strip().split(". ")[0][:200]
+        lines.append(f"{'User' if role == 'user' else 'Assistant'}: {first_sentence}")
+    text = "\n".join(lines)
+    while lines and token_counter.count(text) > max_tokens:
+        lines.pop(0)
+        text = "\n".join(lines)
+    return text
+
+
+class _Conversation:
+    __slots__ = ("turns", "tokens", "summary", "summary_tokens", "updated")
+
+    def __init__(self) -> None:
+        self.turns: Deque[Tuple[str, str, int]] = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.updated = time.monotonic()
+
+
+class HistoryStore:
+    """Per-session conversation history trimmed to a token budget.
+
+    Token counts are computed once per turn when it is appended and kept as
+    a running total, so trimming never re-tokenizes the conversation. Turns
+    beyond the budget fall out of a sliding window, optionally folded into
+    a summary.
+    """
+
+    backend = "memory"
+
+    def __init__(
+        self,
+        max_tokens: int = HISTORY_MAX_TOKENS,
+        max_turns: int = HISTORY_MAX_TURNS,
+        summarize: bool = HISTORY_SUMMARY,
+        summary_tokens: int = HISTORY_SUMMARY_TOKENS,
+        summarizer: Callable[[str, List[Tuple[str, str]], int], str] = summarize_turns,
+        max_sessions: int = HISTORY_MAX_SESSIONS,
+        ttl: int = HISTORY_TTL,
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._conversations: "OrderedDict[str, _Conversation]" = OrderedDict()
+
+    async def get_messages(self, session_id: str) -> List[Dict[str, str]]:
+        """Return the session's history as chat messages, oldest first."""
+        conversation = self._conversations.get(session_id)
+        if conversation is None:
+            return []
+        if time.monotonic() - conversation.updated > self.ttl:
+            del self._conversations[session_id]
+            return []
+        return self._to_messages(conversation.summary, [(role, content) for role, content, _ in conversation.turns])
+
+    async def append(self, session_id: str, role: str, content: str) -> None:
+        """Add a turn and trim the session back under its budget."""
+        conversation = self._conversations.get(session_id)
+        if conversation is None:
+            conversation = _Conversation()
+            self._conversations[session_id] = conversation
+            self._evict_sessions()
+        self._conversations.move_to_end(session_id)
+        conversation.updated = time.monotonic()
+
+        tokens = token_counter.count_message(content)
+        conversation.turns.append((role, content, tokens))
+        conversation.tokens += tokens
+
+        dropped: List[Tuple[str, str]] = []
+        # Always keep the newest turn, even if it alone exceeds the budget
+        while len(conversation.turns) > 1 and (
+            conversation.tokens + conversation.summary_tokens > self.max_tokens
+            or len(conversation.turns) > self.max_turns
+        ):
+            old_role, old_content, old_tokens = conversation.turns.popleft()
+            conversation.tokens -= old_tokens
+            dropped.append((old_role, old_content))
+
+        if dropped and self.summarize:
+            conversation.summary = self.summarizer(conversation.summary, dropped, self.summary_tokens)
+            conversation.summary_tokens = token_counter.count_message(conversation.summary)
+
+    async def remove_last(self, session_id: str, role: str, content: str) -> None:
+        """Take back the newest turn if it is ``content`` from ``role``.
+
+        Used for a prompt whose turn ended without a reply, so it doesn't
+        linger in the conversation.
+        """
+        conversation = self._conversations.get(session_id)
+        if conversation is not None and conversation.turns and conversation.turns[-1][:2] == (role, content):
+            _, _, tokens = conversation.turns.pop()
+            conversation.tokens -= tokens
+
+    async def clear(self, session_id: str) -> None:
+        """Forget a session's history."""
+        self._conversations.pop(session_id, None)
+
+    def _evict_sessions(self) -> None:
+        while len(self._conversations) > self.max_sessions:
+            self._conversations.popitem(last=False)
+
+    @staticmethod
+    def _to_messages(summary: str, turns: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        messages.extend({"role": role, "content": content} for role, content in turns)
+        return messages
+
+    def stats(self) -> Dict[str, Any]:
+        """Return session count and total buffered tokens."""
+        return {
+            "backend": self.backend,
+            "sessions": len(self._conversations),
+            "tokens": sum(c.tokens + c.summary_tokens for c in self._conversations.values()),
+            "max_tokens_per_session": self.max_tokens,
+        }
+
+
+class RedisHistoryStore(HistoryStore):
+    """History kept in Redis so it survives reconnects to another worker.
+
+    Each session is a list of JSON turns (with their token counts) plus a
+    running token total, updated incrementally in one pipeline per append.
+    History is a nicety: if Redis fails mid-conversation the turn goes
+    ahead without it rather than failing.
+    """
+
+    backend = "redis"
+
+    def __init__(self, client: Any, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.client = client
+        self.errors = 0
+
+    def _keys(self, session_id: str) -> Tuple[str, str, str, str]:
+        prefix = f"history:{session_id}"
+        return f"{prefix}:turns", f"{prefix}:tokens", f"{prefix}:summary", f"{prefix}:summary_tokens"
+
+    def _failed(self, action: str, session_id: str, error: Exception) -> None:
+        self.errors += 1
+        logger.warning(f"Failed to {action} history for session {session_id} in Redis: {str(error)}")
+
+    async def get_messages(self, session_id: str) -> List[Dict[str, str]]:
+        turns_key, _, summary_key, _ = self._keys(session_id)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.lrange(turns_key, 0, -1)
+            pipe.get(summary_key)
+            raw_turns, summary = await pipe.execute()
+        except Exception as e:
+            self._failed("read", session_id, e)
+            return []
+        turns = [json.loads(raw) for raw in raw_turns]
+        return self._to_messages(summary or "", [(turn["role"], turn["content"]) for turn in turns])
+
+    async def append(self, session_id: str, role: str, content: str) -> None:
+        try:
+            await self._append(session_id, role, content)
+        except Exception as e:
+            self._failed("append to", session_id, e)
+
+    async def _append(self, session_id: str, role: str, content: str) -> None:
+        turns_key, tokens_key, summary_key, summary_tokens_key = self._keys(session_id)
+        tokens = token_counter.count_message(content)
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(turns_key, json.dumps({"role": role, "content": content, "tokens": tokens}))
+        pipe.incrby(tokens_key, tokens)
+        pipe.llen(turns_key)
+        pipe.get(summary_tokens_key)
+        for key in self._keys(session_id):
+            pipe.expire(key, self.ttl)
+        _, total, length, summary_tokens, *_ = await pipe.execute()
+        summary_tokens = int(summary_tokens or 0)
+
+        dropped: List[Tuple[str, str]] = []
+        # The same budget as the in-memory store: turns plus the summary
+        while length > 1 and (total + summary_tokens > self.max_tokens or length > self.max_turns):
+            raw = await self.client.lpop(turns_key)
+            if raw is None:
+                break
+            turn = json.loads(raw)
+            total = await self.client.decrby(tokens_key, turn["tokens"])
+            length -= 1
+            dropped.append((turn["role"], turn["content"]))
+
+        if dropped and self.summarize:
+            summary = await self.client.get(summary_key) or ""
+            summary = self.summarizer(summary, dropped, self.summary_tokens)
+            pipe = self.client.pipeline(transaction=True)
+            pipe.setex(summary_key, self.ttl, summary)
+            pipe.setex(summary_tokens_key, self.ttl, token_counter.count_message(summary))
+            await pipe.execute()
+
+    async def remove_last(self, session_id: str, role: str, content: str) -> None:
+        turns_key, tokens_key, _, _ = self._keys(session_id)
+        try:
+            raw = await self.client.lindex(turns_key, -1)
+            if raw is None:
+                return
+            turn = json.loads(raw)
+            if (turn["role"], turn["content"]) != (role, content):
+                return
+            # A session runs one turn at a time, so nothing was appended since
+            pipe = self.client.pipeline(transaction=True)
+            pipe.rpop(turns_key)
+            pipe.decrby(tokens_key, turn["tokens"])
+            await pipe.execute()
+        except Exception as e:
+            self._failed("update", session_id, e)
+
+    async def clear(self, session_id: str) -> None:
+        await self.client.delete(*self._keys(session_id))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "max_tokens_per_session": self.max_tokens, "errors": self.errors}
+
+
+async def create_history_store(use_redis: bool = HISTORY_USE_REDIS) -> HistoryStore:
+    """Build the configured history store, falling back to memory if Redis is down."""
+    if use_redis:
+        try:
+            from redis_pool import get_redis
+
+            client = get_redis()
+            await asyncio.wait_for(client.ping(), timeout=2)
+            return RedisHistoryStore(client)
+        except Exception as e:
+            logger.error(f"Failed to connect to Redis for history, keeping it in memory: {str(e)}")
+    return HistoryStore()
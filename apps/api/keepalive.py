@@ -0,0 +1,257 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+
+from metrics import keepalive_failures, keepalive_pings, keepalive_reaped
+from protocol import send_frame
+
+logger = logging.getLogger(__name__)
+
+# Keepalive configuration
+KEEPALIVE_INTERVAL = float(os.environ.get("KEEPALIVE_INTERVAL", "30"))  # Silence before a ping
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", "30"))  # Wait for any reply to a ping
+KEEPALIVE_JITTER = float(os.environ.get("KEEPALIVE_JITTER", "0.1"))  # +/- fraction of the interval
+KEEPALIVE_IDLE_TIMEOUT = float(os.environ.get("KEEPALIVE_IDLE_TIMEOUT", "0"))  # No prompts for this long (0 = never)
+KEEPALIVE_TICK = float(os.environ.get("KEEPALIVE_TICK", "1"))  # Timer wheel resolution
+KEEPALIVE_BATCH_SIZE = int(os.environ.get("KEEPALIVE_BATCH_SIZE", "500"))
+KEEPALIVE_SEND_TIMEOUT = float(os.environ.get("KEEPALIVE_SEND_TIMEOUT", "5"))
+
+# Close code for sockets reaped by the scheduler; clients reconnect and resume
+KEEPALIVE_CLOSE_CODE = 4002
+
+
+class Connection:
+    """A registered socket and its keepalive state."""
+
+    __slots__ = (
+        "websocket", "session_id", "widget_key",
+        "last_activity", "last_message", "ping_sent_at", "slot",
+    )
+
+    def __init__(self, websocket: WebSocket, session_id: str, widget_key: str, now: float) -> None:
+        self.websocket = websocket
+        self.session_id = session_id
+        self.widget_key = widget_key
+        self.last_activity = now
+        self.last_message = now
+        self.ping_sent_at: Optional[float] = None
+        self.slot: Optional[int] = None
+
+    def touch(self) -> None:
+        """Record a frame from the client; any frame answers an outstanding ping."""
+        self.last_activity = time.monotonic()
+        self.ping_sent_at = None
+
+    def message_received(self) -> None:
+        """Record a chat prompt, for the idle timeout."""
+        self.last_message = self.last_activity
+
+
+class KeepaliveScheduler:
+    """One hashed timer wheel driving keepalive for every connection.
+
+    Each connection sits in the wheel slot of its next deadline. Client
+    activity only updates a timestamp; when the slot comes round, a
+    connection that heard from its client recently is simply rescheduled,
+    so active chats are never pinged. Silent ones are pinged in batches
+    and reaped if nothing comes back within ``timeout``. Deadlines are
+    jittered so connections opened together don't ping together.
+
+    Also the registry of this process's sockets by widget key, with O(1)
+    add and remove.
+    """
+
+    def __init__(
+        self,
+        interval: float = KEEPALIVE_INTERVAL,
+        timeout: float = KEEPALIVE_TIMEOUT,
+        jitter: float = KEEPALIVE_JITTER,
+        idle_timeout: float = KEEPALIVE_IDLE_TIMEOUT,
+        tick: float = KEEPALIVE_TICK,
+        batch_size: int = KEEPALIVE_BATCH_SIZE,
+        send_timeout: float = KEEPALIVE_SEND_TIMEOUT,
+    ) -> None:
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.batch_size = batch_size
+        self.send_timeout = send_timeout
+        # Enough slots that no deadline wraps around the wheel more than once
+        self._slots: List[Set[Connection]] = [
+            set() for _ in range(int(max(interval * (1 + jitter), timeout) / tick) + 2)
+        ]
+        self._current_tick = int(time.monotonic() / tick)
+        # widget key -> {connection: None}, insertion ordered
+        self.connections: Dict[str, Dict[Connection, None]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.count = 0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def add(self, websocket: WebSocket, session_id: str, widget_key: str) -> Connection:
+        """Register a socket and schedule its first keepalive check."""
+        now = time.monotonic()
+        conn = Connection(websocket, session_id, widget_key, now)
+        self.connections.setdefault(widget_key, {})[conn] = None
+        self.count += 1
+        self._schedule(conn, now + self._jittered(self.interval))
+        return conn
+
+    def remove(self, conn: Connection) -> None:
+        """Forget a socket; safe to call more than once."""
+        widget_connections = self.connections.get(conn.widget_key)
+        if widget_connections is None or conn not in widget_connections:
+            return
+        del widget_connections[conn]
+        if not widget_connections:
+            del self.connections[conn.widget_key]
+        self.count -= 1
+        self._unschedule(conn)
+
+    def sockets(self, widget_key: Optional[str] = None) -> List[WebSocket]:
+        """Sockets of one widget key, or of every connection."""
+        if widget_key is not None:
+            return [conn.websocket for conn in self.connections.get(widget_key, ())]
+        return [conn.websocket for conns in self.connections.values() for conn in conns]
+
+    def _jittered(self, delay: float) -> float:
+        if not self.jitter:
+            return delay
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _schedule(self, conn: Connection, deadline: float) -> None:
+        self._unschedule(conn)
+        # Never schedule into a slot that has already been processed
+        tick = max(int(deadline / self.tick), self._current_tick + 1)
+        conn.slot = tick % len(self._slots)
+        self._slots[conn.slot].add(conn)
+
+    def _unschedule(self, conn: Connection) -> None:
+        if conn.slot is not None:
+            self._slots[conn.slot].discard(conn)
+            conn.slot = None
+
+    async def _run(self) -> None:
+        while True:
+            next_tick = (self._current_tick + 1) * self.tick
+            await asyncio.sleep(max(next_tick - time.monotonic(), 0))
+            try:
+                await self._advance(time.monotonic())
+            except Exception as e:
+                logger.error(f"Error running keepalive: {str(e)}")
+
+    async def _advance(self, now: float) -> None:
+        """Process every slot up to ``now``, catching up if the loop lagged."""
+        pings: List[Connection] = []
+        reaps: List[Tuple[Connection, str]] = []
+        target = int(now / self.tick)
+        # One revolution visits every slot; checks go by timestamps, so
+        # processing a slot early just reschedules its connections
+        self._current_tick = max(self._current_tick, target - len(self._slots))
+        while self._current_tick < target:
+            self._current_tick += 1
+            slot = self._slots[self._current_tick % len(self._slots)]
+            due = list(slot)
+            slot.clear()
+            for conn in due:
+                conn.slot = None
+                self._check(conn, now, pings, reaps)
+
+        for conn, reason in reaps:
+            await self._reap(conn, reason)
+        # Pings go out in batches, yielding in between so a burst of due
+        # connections can't hog the loop
+        for start in range(0, len(pings), self.batch_size):
+            await self._ping_batch(pings[start:start + self.batch_size])
+            await asyncio.sleep(0)
+
+    def _check(self, conn: Connection, now: float, pings: List[Connection], reaps: List[Tuple[Connection, str]]) -> None:
+        if conn.ping_sent_at is not None:
+            if now - conn.ping_sent_at >= self.timeout:
+                reaps.append((conn, "timeout"))
+            else:
+                self._schedule(conn, conn.ping_sent_at + self.timeout)
+        elif self.idle_timeout and now - conn.last_message >= self.idle_timeout:
+            reaps.append((conn, "idle"))
+        elif now - conn.last_activity < self.interval * (1 - self.jitter):
+            # Heard from the client recently - check again later, no ping
+            self._schedule(conn, conn.last_activity + self._jittered(self.interval))
+        else:
+            pings.append(conn)
+
+    async def _ping_batch(self, batch: List[Connection]) -> None:
+        """Ping ``batch`` in turn; a send stuck for ``send_timeout`` is reaped.
+
+        Healthy sends complete without waiting, so one timer covers the
+        whole batch instead of one per ping.
+        """
+        index = 0
+
+        async def ping_rest() -> None:
+            nonlocal index
+            while index < len(batch):
+                index += 1
+                await self._ping(batch[index - 1])
+
+        while index < len(batch):
+            try:
+                await asyncio.wait_for(ping_rest(), self.send_timeout)
+            except asyncio.TimeoutError:
+                keepalive_failures.inc()
+                await self._reap(batch[index - 1], "send_timeout")
+
+    async def _ping(self, conn: Connection) -> None:
+        conn.ping_sent_at = time.monotonic()
+        self._schedule(conn, conn.ping_sent_at + self.timeout)
+        try:
+            await send_frame(conn.websocket, {
+                "type": "ping",
+                "timestamp": datetime.now().isoformat(),
+                "session_id": conn.session_id,
+            })
+            keepalive_pings.inc()
+        except Exception as e:
+            logger.debug("Keepalive ping to session %s failed: %s", conn.session_id, e)
+            keepalive_failures.inc()
+            await self._reap(conn, "send_failed")
+
+    async def _reap(self, conn: Connection, reason: str) -> None:
+        """Drop a dead or idle socket; its endpoint finishes the cleanup."""
+        self.remove(conn)
+        keepalive_reaped.labels(reason).inc()
+        logger.info(f"Closing {reason} connection for session {conn.session_id}")
+        try:
+            await asyncio.wait_for(
+                conn.websocket.close(code=KEEPALIVE_CLOSE_CODE, reason=f"keepalive {reason}"),
+                self.send_timeout,
+            )
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connections": self.count,
+            "widget_keys": len(self.connections),
+            "scheduled": sum(len(slot) for slot in self._slots),
+            "interval": self.interval,
+            "timeout": self.timeout,
+        }
+
+
+keepalive_scheduler = KeepaliveScheduler()
@@ -1,21 +1,23 @@
 # Temporary file for fixing the API
 
 import os
+import time
 import logging
 import asyncio
+from functools import partial
 from typing import (
     AsyncIterator,
     Any,
     Optional,
     Callable,
+    Dict,
+    List,
 )
-from langchain.callbacks.base import BaseCallbackHandler
 import random
-from dotenv import load_dotenv
-
-# Load environment variables from all possible locations
-load_dotenv()  # From .env in current directory
-load_dotenv("/app/.env")  # Explicitly from /app/.env (Docker container path)
+from llm_client import llm_clients
+from logs import token_log_sampler
+from metrics import llm_errors, llm_fallbacks, llm_requests
+from providers import UpstreamRequestError, is_request_error, provider_health
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -25,33 +27,31 @@ os.environ.setdefault("USE_FAKE_LLM", "true")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
 USE_FAKE_LLM = os.environ.get("USE_FAKE_LLM", "true").lower() == "true"
 
-# For debugging - log the environment variables
-logger.info(f"USE_FAKE_LLM set to: {USE_FAKE_LLM}")
-logger.info(f"OPENAI_API_KEY available: {bool(OPENAI_API_KEY)}")
-
-
-class StreamingCallbackHandler(BaseCallbackHandler):
-    """Callback handler for streaming LLM responses."""
-
-    def __init__(self, streaming_callback: Callable[[str], Any]) -> None:
-        """Initialize with callback to handle each token."""
-        self.streaming_callback = streaming_callback
-
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        """Run on new LLM token. Only available when streaming is enabled."""
-        if self.streaming_callback:
-            # Handle both coroutine and regular functions
-            if asyncio.iscoroutinefunction(self.streaming_callback):
-                # Don't await here - it's awaited in the LangChain internals
-                self.streaming_callback(token)
-            else:
-                self.streaming_callback(token)
+# Fake LLM profile - setting FAKE_LLM_SEED makes responses and timing
+# deterministic for repeatable benchmarks
+FAKE_LLM_SEED = os.environ.get("FAKE_LLM_SEED") or None
+FAKE_LLM_TOKENS = int(os.environ.get("FAKE_LLM_TOKENS", "0"))
+FAKE_LLM_TOKEN_DELAY_MS = float(os.environ.get("FAKE_LLM_TOKEN_DELAY_MS", "0"))
+FAKE_LLM_TTFT_MS = float(os.environ.get("FAKE_LLM_TTFT_MS", "0"))
 
 
 class FakeLLM:
-    """Fake LLM implementation for testing without API costs."""
-
-    def __init__(self) -> None:
+    """Fake LLM implementation for testing without API costs.
+
+    Without a seed it picks a random canned response and sleeps a random
+    100-300 ms between words. With ``seed`` set the response depends only on
+    the seed and prompt, and timing comes from ``ttft_ms`` and
+    ``token_delay_ms``, so benchmark runs are repeatable. ``tokens`` sets the
+    response length (canned words are repeated as needed).
+    """
+
+    def __init__(
+        self,
+        seed: Optional[str] = FAKE_LLM_SEED,
+        tokens: int = FAKE_LLM_TOKENS,
+        token_delay_ms: float = FAKE_LLM_TOKEN_DELAY_MS,
+        ttft_ms: float = FAKE_LLM_TTFT_MS,
+    ) -> None:
         self.responses = [
             "Hello! I'm a simulated AI assistant for testing purposes.",
             "I can help answer your questions about our products and services.",
@@ -59,177 +59,268 @@ class FakeLLM:
             "In production, this would be replaced with a real LLM API call.",
             "To test the system properly, I'll simulate thinking and response delays.",
         ]
+        self.seed = seed
+        self.tokens = tokens
+        self.token_delay = token_delay_ms / 1000
+        self.ttft = ttft_ms / 1000
 
     async def astream(self, prompt: str, **kwargs: Any) -> AsyncIterator[str]:
         """Stream a fake response token by token."""
-        # Pick a random response
-        response = random.choice(self.responses)
+        if self.seed is None:
+            # Pick a random response
+            response = random.choice(self.responses)
+            words = response.split()
+        else:
+            # Same seed and prompt always give the same response
+            rng = random.Random(f"{self.seed}:{prompt}")
+            words = rng.choice(self.responses).split()
+
+        if self.tokens:
+            words = [words[i % len(words)] for i in range(self.tokens)]
+
+        if self.ttft:
+            await asyncio.sleep(self.ttft)
 
         # Stream it token by token with realistic delays
-        words = response.split()
-        for word in words:
+        for i, word in enumerate(words):
             # Add the word and space
             yield word + " "
-            # Random delay between words to simulate thinking
-            await asyncio.sleep(random.uniform(0.1, 0.3))
+            if self.seed is None:
+                # Random delay between words to simulate thinking
+                await asyncio.sleep(random.uniform(0.1, 0.3))
+            elif i < len(words) - 1:
+                await asyncio.sleep(self.token_delay)
+
+
+# Readiness of the configured backend, filled in by warm_up() at startup
+llm_status: Dict[str, Any] = {"backend": None, "ready": False}
+_preload_task: Optional[asyncio.Task] = None
+
+
+def preload_fallback() -> None:
+    """Import the LangChain fallback; takes seconds, so run it in a thread."""
+    try:
+        import langchain_openai  # noqa: F401
+        from langchain_core.messages import HumanMessage  # noqa: F401
+    except Exception as e:
+        logger.warning(f"LangChain fallback unavailable: {str(e)}")
+
+
+async def warm_up() -> Dict[str, Any]:
+    """Load what the configured backend needs before the first message.
+
+    The fake backend needs nothing beyond this module. The OpenAI backend
+    gets its pooled client created and its lazily loaded resources
+    resolved, so the first chat after a deploy doesn't pay for imports.
+    """
+    global _preload_task
+    start = time.perf_counter()
+    use_fake = os.environ.get("USE_FAKE_LLM", "true").lower() == "true"
+    # For debugging - log the environment variables (here rather than at
+    # import, which happens before logging is set up)
+    logger.info(f"USE_FAKE_LLM set to: {use_fake}")
+    logger.info(f"OPENAI_API_KEY available: {bool(os.environ.get('OPENAI_API_KEY', ''))}")
+    llm_status["backend"] = "fake" if use_fake else "openai"
+    try:
+        if use_fake:
+            FakeLLM()
+        else:
+            client = await llm_clients.openai_client()
+            client.chat.completions
+            # Failing over mid-incident must not stall the event loop on
+            # imports, but startup shouldn't wait for them either
+            if _preload_task is None:
+                _preload_task = asyncio.create_task(asyncio.to_thread(preload_fallback))
+        llm_status["ready"] = True
+        llm_status.pop("error", None)
+    except Exception as e:
+        # Requests still fall back to the fake LLM; /healthz reports the error
+        logger.error(f"Error warming up {llm_status['backend']} LLM backend: {str(e)}")
+        llm_status["ready"] = False
+        llm_status["error"] = str(e)
+    llm_status["warmup_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(f"LLM backend {llm_status['backend']} warmed up in {llm_status['warmup_ms']}ms")
+    return llm_status
+
+
+async def _emit(streaming_callback: Optional[Callable[[str], Any]], token: str) -> None:
+    if streaming_callback:
+        # Properly await coroutine callbacks
+        if asyncio.iscoroutinefunction(streaming_callback):
+            await streaming_callback(token)
+        else:
+            streaming_callback(token)
+
+
+async def _openai_stream(messages: List[Dict[str, str]], model: str, temperature: float) -> AsyncIterator[str]:
+    """Stream a chat completion through the shared, pooled OpenAI client."""
+    client = await llm_clients.openai_client()
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+    )
+    try:
+        async for chunk in stream:
+            if (
+                chunk.choices
+                and hasattr(chunk.choices[0], "delta")
+                and chunk.choices[0].delta.content
+            ):
+                content = chunk.choices[0].delta.content
+                if logger.isEnabledFor(logging.DEBUG) and token_log_sampler.allow():
+                    logger.debug("Received content chunk: %.10s...", content)
+                yield content
+    finally:
+        # Close the upstream stream promptly if the caller stops early
+        # (e.g. the generation was cancelled or lost a hedge)
+        await stream.close()
+
+
+async def _langchain_stream(messages: List[Dict[str, str]], model: str, temperature: float) -> AsyncIterator[str]:
+    """Stream a chat completion through the shared LangChain ChatOpenAI."""
+    # LangChain is only imported once the fallback is needed
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+    message_types = {"system": SystemMessage, "assistant": AIMessage, "user": HumanMessage}
+    lc_messages = [
+        message_types.get(m["role"], HumanMessage)(content=m["content"])
+        for m in messages
+    ]
+    llm = llm_clients.langchain_chat(model, temperature)
+    async for chunk in llm.astream(lc_messages):
+        if chunk.content:
+            yield chunk.content
+
+
+# Upstream backends in fallback order; the fake LLM is the last resort
+BACKENDS: Dict[str, Callable[[List[Dict[str, str]], str, float], AsyncIterator[str]]] = {
+    "openai": _openai_stream,
+    "langchain": _langchain_stream,
+}
 
 
 async def get_llm_response(
-    prompt: str,
+    prompt: Optional[str] = None,
     system_prompt: Optional[str] = None,
     streaming_callback: Optional[Callable[[str], Any]] = None,
+    messages: Optional[List[Dict[str, str]]] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
 ) -> AsyncIterator[str]:
-    """Get response from LLM, either real or fake based on configuration."""
+    """Get response from LLM, either real or fake based on configuration.
+
+    ``messages`` is the conversation as a list of ``{"role", "content"}``
+    dicts, oldest first and ending with the user's latest message; a bare
+    ``prompt`` is shorthand for a single user message.
+
+    The real backends are tried in ``BACKENDS`` order, skipping any whose
+    circuit is open, until one streams a first token within the TTFT
+    timeout (see ``providers``); if none does, the fake LLM answers. A
+    backend refusing the request itself (an unknown model, a bad
+    temperature) raises ``UpstreamRequestError`` instead.
+    Once tokens have been streamed a failure can't move to another
+    backend, so it is raised to the caller.
+
+    If ``meta`` is given it is filled in with the backend that produced the
+    response and whether an error forced a fallback to the fake LLM.
+
+    ``model`` and ``temperature`` default to ``MODEL_NAME`` and
+    ``TEMPERATURE`` from the environment.
+    """
+    if meta is None:
+        meta = {}
+    meta["fallback"] = False
+    if model is None:
+        model = os.environ.get("MODEL_NAME", "gpt-3.5-turbo")
+    if temperature is None:
+        temperature = float(os.environ.get("TEMPERATURE", "0.7"))
+
+    if messages is None:
+        messages = [{"role": "user", "content": prompt or ""}]
+    prompt = next(
+        (m["content"] for m in reversed(messages) if m["role"] == "user"), ""
+    )
 
     # Re-check the environment variable to ensure it's up to date
     use_fake = os.environ.get("USE_FAKE_LLM", "true").lower() == "true"
-    logger.info(f"Running with USE_FAKE_LLM={use_fake}")
+    logger.debug("Running with USE_FAKE_LLM=%s", use_fake)
 
     if use_fake:
-        logger.info("Using fake LLM for response")
-        fake_llm = FakeLLM()
-
-        # Always stream tokens, regardless of streaming_callback
-        async for token in fake_llm.astream(prompt):
-            if streaming_callback:
-                # Properly await coroutine callbacks
-                if asyncio.iscoroutinefunction(streaming_callback):
-                    await streaming_callback(token)
-                else:
-                    streaming_callback(token)
+        logger.debug("Using fake LLM for response")
+        meta["backend"] = "fake"
+        llm_requests.labels("fake").inc()
+        async for token in FakeLLM().astream(prompt):
+            await _emit(streaming_callback, token)
             yield token
-    else:
-        # Use real OpenAI/LangChain implementation
+        return
+
+    backends = list(BACKENDS)
+    if not os.environ.get("OPENAI_API_KEY", ""):
+        logger.error("OpenAI API key not found. Set OPENAI_API_KEY in environment or .env file.")
+        backends = []
+
+    # Build the messages list in OpenAI format
+    upstream_messages = []
+    if system_prompt:
+        upstream_messages.append({"role": "system", "content": system_prompt})
+    upstream_messages.extend({"role": m["role"], "content": m["content"]} for m in messages)
+
+    for index, backend in enumerate(backends):
+        breaker = provider_health.breaker(backend)
+        if not breaker.allow():
+            logger.debug("Skipping LLM backend %s: circuit open", backend)
+            continue
+        if index > 0:
+            llm_fallbacks.labels(backend).inc()
+        meta["backend"] = backend
+        llm_requests.labels(backend).inc()
+        logger.debug("Starting %s streaming chat completion with model: %s", backend, model)
+
+        start = partial(BACKENDS[backend], upstream_messages, model, temperature)
         try:
-            from langchain_openai import ChatOpenAI
-
-            # Update imports for the correct message types
-            from langchain_core.messages import HumanMessage, SystemMessage
-
-            # Get the latest API key from environment
-            api_key = os.environ.get("OPENAI_API_KEY", "")
-            if not api_key:
-                logger.error("OpenAI API key not found")
-                raise ValueError(
-                    "OpenAI API key not found. Set OPENAI_API_KEY in environment or .env file."
-                )
-
-            # Create messages
-            messages = []
-            if system_prompt:
-                messages.append(SystemMessage(content=system_prompt))
-            messages.append(HumanMessage(content=prompt))
-
-            # Create OpenAI client with streaming enabled and a callback handler
-            logger.info(
-                f"Creating ChatOpenAI with key length: {len(api_key)}, "
-                f"model: {os.environ.get('MODEL_NAME', 'gpt-3.5-turbo')}"
-            )
-
-            # Use a direct approach with OpenAI API
-            try:
-                # Import the OpenAI client
-                import openai
-
-                # Configure the OpenAI client
-                openai.api_key = api_key
-
-                # Create the chat completion with streaming
-                logger.info("Starting direct OpenAI API call with streaming")
-
-                # Build the messages list in OpenAI format
-                openai_messages = []
-                if system_prompt:
-                    openai_messages.append({"role": "system", "content": system_prompt})
-                openai_messages.append({"role": "user", "content": prompt})
-
-                # Use the AsyncClient for streaming
-                client = openai.AsyncClient(api_key=api_key)
-
-                # Create a streaming response
-                logger.info("Starting OpenAI streaming chat completion")
-                stream = await client.chat.completions.create(
-                    model=os.environ.get("MODEL_NAME", "gpt-3.5-turbo"),
-                    messages=openai_messages,
-                    temperature=float(os.environ.get("TEMPERATURE", "0.7")),
-                    stream=True,
-                )
-
-                logger.info("Processing OpenAI streaming response")
-                async for chunk in stream:
-                    if (
-                        hasattr(chunk.choices[0], "delta")
-                        and hasattr(chunk.choices[0].delta, "content")
-                        and chunk.choices[0].delta.content
-                    ):
-                        content = chunk.choices[0].delta.content
-                        logger.info(f"Received content chunk: {content[:10]}...")
-
-                        if streaming_callback:
-                            # Properly await coroutine callbacks
-                            if asyncio.iscoroutinefunction(streaming_callback):
-                                await streaming_callback(content)
-                            else:
-                                streaming_callback(content)
-
-                        yield content
-
-                logger.info("OpenAI streaming completed successfully")
-
-            # If direct OpenAI approach fails, try LangChain
-            except (ImportError, Exception) as direct_api_error:
-                logger.warning(
-                    f"Direct OpenAI API approach failed: {str(direct_api_error)}, "
-                    "trying LangChain"
-                )
-
-                # Create LangChain ChatOpenAI with streaming
-                callback_handler = (
-                    StreamingCallbackHandler(streaming_callback)
-                    if streaming_callback
-                    else None
-                )
-
-                llm = ChatOpenAI(
-                    openai_api_key=api_key,
-                    model_name=os.environ.get("MODEL_NAME", "gpt-3.5-turbo"),
-                    temperature=float(os.environ.get("TEMPERATURE", "0.7")),
-                    streaming=True,
-                    callbacks=[callback_handler] if callback_handler else None,
-                )
-
-                # Use the simple astream method instead of astream_events
-                logger.info("Starting to stream tokens from LangChain ChatOpenAI")
-                response = await llm.agenerate([messages])
-                content = response.generations[0][0].text
-
-                # If we got here, we couldn't stream, so send the entire content at once
-                logger.info(f"Got complete response: {content[:30]}...")
-                if streaming_callback:
-                    # Send the full content through the callback to simulate streaming
-                    if asyncio.iscoroutinefunction(streaming_callback):
-                        await streaming_callback(content)
-                    else:
-                        streaming_callback(content)
-
-                # Yield the entire content
-                yield content
-
-        except ImportError as e:
-            logger.error(f"LangChain/OpenAI module not installed: {str(e)}")
-            raise ImportError(
-                "Required packages not installed. Run: pip install langchain-openai openai"
-            )
+            stream, first = await provider_health.open_stream(backend, start)
         except Exception as e:
-            logger.error(f"Error calling OpenAI API: {str(e)}")
-            # Fall back to fake LLM in case of error
-            logger.info("Falling back to fake LLM due to error")
-            fake_llm = FakeLLM()
-            async for token in fake_llm.astream(prompt):
-                if streaming_callback:
-                    # Properly await coroutine callbacks
-                    if asyncio.iscoroutinefunction(streaming_callback):
-                        await streaming_callback(token)
-                    else:
-                        streaming_callback(token)
+            llm_errors.labels(backend).inc()
+            if is_request_error(e):
+                # A bad model or parameter - not the backend's failure, and
+                # no other backend or the fake LLM should answer it instead
+                logger.warning(f"LLM backend {backend} refused the request: {str(e)}")
+                breaker.record_request_error()
+                raise UpstreamRequestError(backend, e.status_code, str(e)) from e
+            logger.warning(f"LLM backend {backend} failed before its first token: {str(e)}")
+            breaker.record_failure()
+            continue
+
+        breaker.record_success()
+        try:
+            if first is not None:
+                await _emit(streaming_callback, first)
+                yield first
+            async for token in stream:
+                await _emit(streaming_callback, token)
                 yield token
+        except Exception as e:
+            # Tokens have already reached the client; don't splice in
+            # another backend's answer
+            logger.error(f"LLM backend {backend} failed mid-stream: {str(e)}")
+            llm_errors.labels(backend).inc()
+            breaker.record_failure()
+            meta["fallback"] = True
+            raise
+        finally:
+            await stream.aclose()
+        logger.debug("%s streaming completed successfully", backend)
+        return
+
+    # Every backend failed or has its circuit open
+    logger.info("Falling back to fake LLM")
+    llm_fallbacks.labels("fake").inc()
+    meta["backend"] = "fake"
+    meta["fallback"] = True
+    llm_requests.labels("fake").inc()
+    async for token in FakeLLM().astream(prompt):
+        await _emit(streaming_callback, token)
+        yield token
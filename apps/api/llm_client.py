@@ -0,0 +1,176 @@
+import os
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upstream connection pool configuration
+LLM_POOL_MAX_CONNECTIONS = int(os.environ.get("LLM_POOL_MAX_CONNECTIONS", "100"))
+LLM_POOL_MAX_KEEPALIVE = int(os.environ.get("LLM_POOL_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "60"))
+# Client-side retries; failed backends are handled by the fallback chain
+# and circuit breakers in providers.py, so retrying here only adds latency
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "0"))
+# ChatOpenAI instances kept for distinct model/temperature pairs; the least
+# recently used is dropped beyond this
+LLM_LANGCHAIN_MAX_MODELS = int(os.environ.get("LLM_LANGCHAIN_MAX_MODELS", "32"))
+
+
+class LLMClientManager:
+    """Process-wide owner of the pooled upstream LLM clients.
+
+    Created once at app startup and closed on shutdown, so every chat turn
+    reuses warm keep-alive connections instead of paying for connection
+    setup and a TLS handshake.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = LLM_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections: int = LLM_POOL_MAX_KEEPALIVE,
+        keepalive_expiry: float = LLM_KEEPALIVE_EXPIRY,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        read_timeout: float = LLM_READ_TIMEOUT,
+        max_retries: int = LLM_MAX_RETRIES,
+        base_url: Optional[str] = None,
+        max_langchain_models: int = LLM_LANGCHAIN_MAX_MODELS,
+    ) -> None:
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.base_url = base_url
+        self._http_client: Any = None
+        self._openai_client: Any = None
+        self.max_langchain_models = max(max_langchain_models, 1)
+        self._langchain_models: "OrderedDict[Tuple[str, float], Any]" = OrderedDict()
+        self._requests_total = 0
+        self._started_at: Optional[float] = None
+
+    async def start(self) -> None:
+        """Create the shared HTTP connection pool and OpenAI client."""
+        if self._http_client is not None:
+            return
+
+        import httpx
+        import openai
+
+        async def count_request(request: Any) -> None:
+            self._requests_total += 1
+
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                self.read_timeout, connect=self.connect_timeout
+            ),
+            event_hooks={"request": [count_request]},
+        )
+
+        api_key = os.environ.get("OPENAI_API_KEY", "")
+        if api_key:
+            self._openai_client = openai.AsyncClient(
+                api_key=api_key,
+                base_url=self.base_url or os.environ.get("OPENAI_BASE_URL") or None,
+                http_client=self._http_client,
+                max_retries=self.max_retries,
+            )
+        else:
+            logger.warning("OPENAI_API_KEY not set, OpenAI client not created")
+
+        self._started_at = time.time()
+        logger.info(
+            f"LLM client pool started: max_connections={self.max_connections}, "
+            f"max_keepalive={self.max_keepalive_connections}"
+        )
+
+    async def openai_client(self) -> Any:
+        """Return the shared OpenAI client, starting the pool if needed."""
+        if self._http_client is None:
+            await self.start()
+        if self._openai_client is None:
+            raise ValueError(
+                "OpenAI API key not found. Set OPENAI_API_KEY in environment or .env file."
+            )
+        return self._openai_client
+
+    def langchain_chat(self, model: str, temperature: float) -> Any:
+        """Return a cached streaming ChatOpenAI for the model/temperature.
+
+        Callbacks are passed per call, so a single instance (and its
+        connection pool) is shared by every request. Model and temperature
+        can come from tenant configs and batch requests, so the cache is
+        bounded: temperatures are rounded to two places and only the most
+        recently used ``max_langchain_models`` instances are kept.
+        """
+        temperature = round(float(temperature), 2)
+        key = (model, temperature)
+        llm = self._langchain_models.get(key)
+        if llm is not None:
+            self._langchain_models.move_to_end(key)
+        else:
+            from langchain_openai import ChatOpenAI
+
+            llm = ChatOpenAI(
+                openai_api_key=os.environ.get("OPENAI_API_KEY", ""),
+                openai_api_base=self.base_url or os.environ.get("OPENAI_BASE_URL") or None,
+                model_name=model,
+                temperature=temperature,
+                streaming=True,
+                timeout=self.read_timeout,
+                max_retries=self.max_retries,
+            )
+            self._langchain_models[key] = llm
+            if len(self._langchain_models) > self.max_langchain_models:
+                self._langchain_models.popitem(last=False)
+        return llm
+
+    def stats(self) -> Dict[str, Any]:
+        """Return pool configuration and live connection counts."""
+        stats: Dict[str, Any] = {
+            "started": self._http_client is not None,
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": self.max_keepalive_connections,
+            "keepalive_expiry": self.keepalive_expiry,
+            "requests_total": self._requests_total,
+            "langchain_models": len(self._langchain_models),
+            "uptime_seconds": (
+                round(time.time() - self._started_at, 1) if self._started_at else 0
+            ),
+        }
+
+        # httpx does not expose pool state publicly, so read it best-effort
+        try:
+            connections = self._http_client._transport._pool.connections
+            idle = sum(1 for conn in connections if conn.is_idle())
+            stats["connections"] = len(connections)
+            stats["idle_connections"] = idle
+            stats["active_connections"] = len(connections) - idle
+        except Exception:
+            pass
+
+        return stats
+
+    async def aclose(self) -> None:
+        """Close the shared connection pool."""
+        if self._openai_client is not None:
+            await self._openai_client.close()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+        self._openai_client = None
+        self._http_client = None
+        self._langchain_models.clear()
+        logger.info("LLM client pool closed")
+
+
+# Shared instance used by the app
+llm_clients = LLMClientManager()
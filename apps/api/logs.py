@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional, TextIO
+
+from metrics import log_records_dropped, log_records_sampled_out
+
+# Logging configuration
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "info").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()  # text or json
+# Hand records to a background thread instead of writing on the event loop
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Per-token records: one in N is logged
+LOG_TOKEN_SAMPLE_EVERY = int(os.environ.get("LOG_TOKEN_SAMPLE_EVERY", "100"))
+# Per-message records: at most N per second per process (0 = unlimited)
+LOG_MESSAGE_RATE = float(os.environ.get("LOG_MESSAGE_RATE", "20"))
+
+# Correlation ids, set per connection and inherited by the tasks it starts
+session_id_var: ContextVar[Optional[str]] = ContextVar("session_id", default=None)
+widget_key_var: ContextVar[Optional[str]] = ContextVar("widget_key", default=None)
+
+# Extra record attributes copied into structured output
+RECORD_FIELDS = ("session_id", "widget_key", "event")
+
+_listener: Optional[QueueListener] = None
+
+
+def bind_session(session_id: str, widget_key: Optional[str] = None) -> None:
+    """Tag every record logged from the current task (and tasks it starts)."""
+    session_id_var.set(session_id)
+    if widget_key is not None:
+        widget_key_var.set(widget_key)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the correlation ids onto each record where it is logged."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "session_id", None) is None:
+            record.session_id = session_id_var.get()
+        if getattr(record, "widget_key", None) is None:
+            record.widget_key = widget_key_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines with the session id when there is one."""
+
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s%(correlation)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        session_id = getattr(record, "session_id", None)
+        record.correlation = f" [{session_id}]" if session_id else ""
+        return super().format(record)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records rather than block when the queue is full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Queue the record as it is, leaving all formatting to the listener's thread.
+
+        ``QueueHandler.prepare`` merges the arguments and formats the record
+        here, on the event loop, and folds the exception into the message, so
+        the JSON formatter never sees ``exc_info``. The correlation ids are
+        already on the record; arguments are rendered when it is written.
+        """
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+class LogSampler:
+    """Decides whether a high-volume log record is emitted.
+
+    Lets through one in ``every`` events and at most ``per_second`` per
+    second. Only called from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, name: str, every: int = 1, per_second: float = 0) -> None:
+        self.every = max(every, 1)
+        self.per_second = per_second
+        self._count = 0
+        self._window = 0
+        self._in_window = 0
+        self._sampled_out = log_records_sampled_out.labels(name)
+
+    def allow(self) -> bool:
+        self._count += 1
+        if self._count % self.every:
+            self._sampled_out.inc()
+            return False
+        if self.per_second:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window = window
+                self._in_window = 0
+            if self._in_window >= self.per_second:
+                self._sampled_out.inc()
+                return False
+            self._in_window += 1
+        return True
+
+
+# Shared samplers for the per-token and per-message paths
+token_log_sampler = LogSampler("token", every=LOG_TOKEN_SAMPLE_EVERY)
+message_log_sampler = LogSampler("message", per_second=LOG_MESSAGE_RATE)
+
+
+def setup_logging(
+    level: str = LOG_LEVEL,
+    fmt: str = LOG_FORMAT,
+    use_queue: bool = LOG_ASYNC,
+    stream: Optional[TextIO] = None,
+) -> None:
+    """Configure the root logger.
+
+    Records are tagged with correlation ids where they are logged; with
+    ``use_queue`` they are then formatted and written by a background
+    thread, so a slow stderr never stalls the event loop.
+    """
+    global _listener
+
+    stop_logging()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    if use_queue:
+        handler: logging.Handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _listener = QueueListener(handler.queue, output)
+        _listener.start()
+    else:
+        handler = output
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the background writer.
+
+    Records logged afterwards are written directly.
+    """
+    global _listener
+
+    if _listener is None:
+        return
+    _listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, DroppingQueueHandler):
+            root.removeHandler(handler)
+            for output in _listener.handlers:
+                output.addFilter(ContextFilter())
+                root.addHandler(output)
+    _listener = None
+
+
+atexit.register(stop_logging)
@@ -1,21 +1,102 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Header, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
 import uuid
 import json
 import logging
 import traceback
-from typing import Dict, List, Any, Optional
+from typing import Dict, Any, Optional
 from datetime import datetime
 import asyncio
 import os
-import pathlib
+import secrets
+from contextlib import asynccontextmanager, aclosing
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Loads .env - must come before the app's own modules, which read their
+# settings on import
+import env  # noqa: F401
+from logs import bind_session, message_log_sampler, setup_logging, stop_logging
+from llm_client import llm_clients
+from redis_pool import USE_REDIS, close_redis
+from sessions import SessionStore, InMemorySessionStore, create_session_store
+from history import HistoryStore, create_history_store, token_counter
+from llm import llm_status, warm_up
+from providers import provider_health
+from cache import get_cached_llm_response, response_cache, single_flight
+from scheduler import AdmissionRejected, estimate_tokens, scheduler
+from streaming import TokenCoalescer
+from pipeline import SessionPipeline
+from resume import ResumableStream, resume_registry
+from protocol import negotiate, send_frame
+from bus import connection_bus
+from keepalive import Connection, keepalive_scheduler
+from tenants import tenant_configs
+from retrieval import knowledge_base
+from analytics import ConversationEvent, conversation_analytics
+from ratelimit import RATE_LIMIT_CLOSE_CODE, edge_limits
+from batch import (
+    BATCH_CONCURRENCY,
+    BatchInputError,
+    batch_jobs,
+    check_job_id,
+    check_overrides,
+    parse_json_prompts,
+    parse_ndjson_prompts,
+    run_batch,
+)
+from metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    StreamTimer,
+    keepalive_pongs,
+    messages_in_flight,
+    messages_total,
+    registry,
+    ws_connections,
+)
+
+# Structured records, written off the event loop - DEBUG logs every frame,
+# so it is opt-in via LOG_LEVEL
+setup_logging()
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources at startup and release them on shutdown."""
+    global session_store, history_store
+    session_store = await create_session_store(USE_REDIS)
+    history_store = await create_history_store()
+    # Load only what the configured LLM backend needs, now rather than on
+    # the first message
+    await warm_up()
+    # tiktoken may download its encoding - keep that off the event loop
+    await asyncio.to_thread(token_counter.load)
+    # Every tenant's prompt and model, loaded (and token-counted) up front
+    await tenant_configs.start()
+    connection_bus.on_control(TENANT_INVALIDATE, tenant_configs.invalidate)
+    # Map every widget's knowledge index so retrieval does no setup per message
+    await knowledge_base.start()
+    connection_bus.on_control(KNOWLEDGE_RELOAD, knowledge_base.reload)
+    await conversation_analytics.start()
+    await resume_registry.start()
+    await keepalive_scheduler.start()
+    connection_bus.set_handler(deliver_local)
+    await connection_bus.start()
+    yield
+    await connection_bus.close()
+    await keepalive_scheduler.close()
+    await resume_registry.close()
+    await tenant_configs.close()
+    await knowledge_base.close()
+    # Write (or spill) the analytics events still queued
+    await conversation_analytics.close()
+    await llm_clients.aclose()
+    await session_store.close()
+    await close_redis()
+    stop_logging()
+
 # Initialize FastAPI app
-app = FastAPI(title="GlazingAI API", version="0.1.0")
+app = FastAPI(title="GlazingAI API", version="0.1.0", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -37,234 +118,617 @@ async def add_cors_headers(request, call_next):
     response.headers["Access-Control-Allow-Headers"] = "*"
     return response
 
-# Redis connection - optional for local development
-use_redis = os.environ.get("USE_REDIS", "false").lower() == "true"
-redis_client = None
-
-if use_redis:
-    try:
-        import redis
-        # Use connection pool for better stability
-        redis_connection_pool = redis.ConnectionPool(
-            host=os.environ.get("REDIS_HOST", "redis"),
-            port=int(os.environ.get("REDIS_PORT", 6379)),
-            db=0,
-            decode_responses=True
-        )
-        def get_redis_client():
-            return redis.Redis(connection_pool=redis_connection_pool)
-        # Test connection
-        redis_client = get_redis_client()
-        redis_client.ping()
-        logger.info("Connected to Redis successfully")
-    except Exception as e:
-        logger.error(f"Failed to connect to Redis: {str(e)}")
-        use_redis = False
-else:
-    logger.info("Redis is disabled for local development")
-
-# Store active WebSocket connections
-active_connections: Dict[str, List[WebSocket]] = {}
-
-# Load system prompt
-SYSTEM_PROMPT_PATH = pathlib.Path(__file__).parent / "prompts" / "system.txt"
-system_prompt = ""
-try:
-    if SYSTEM_PROMPT_PATH.exists():
-        with open(SYSTEM_PROMPT_PATH, "r") as f:
-            system_prompt = f.read().strip()
-        logger.info(f"Loaded system prompt: {len(system_prompt)} chars")
-    else:
-        logger.warning(f"System prompt file not found at {SYSTEM_PROMPT_PATH}")
-except Exception as e:
-    logger.error(f"Error loading system prompt: {str(e)}")
+# Session persistence - replaced with the configured store at startup
+session_store: SessionStore = InMemorySessionStore()
+# Conversation history - likewise replaced at startup
+history_store: HistoryStore = HistoryStore()
 
-# Keepalive ping task
-async def keepalive_ping(websocket: WebSocket, session_id: str):
-    """Send ping messages to keep connection alive."""
-    try:
-        while True:
-            await asyncio.sleep(30)  # Send ping every 30 seconds
-            try:
-                if websocket.client_state == websocket.application_state == 1:  # WebSocket.CONNECTED
-                    logger.debug(f"Sending keepalive ping to session {session_id}")
-                    await websocket.send_json({
-                        "type": "ping",
-                        "timestamp": datetime.now().isoformat(),
-                        "session_id": session_id
-                    })
-                else:
-                    logger.debug(f"WebSocket for session {session_id} not connected, stopping keepalive")
-                    break
-            except Exception as e:
-                logger.error(f"Error sending keepalive: {str(e)}")
-                break
-    except asyncio.CancelledError:
-        logger.debug(f"Keepalive task cancelled for session {session_id}")
-    except Exception as e:
-        logger.error(f"Unexpected error in keepalive task: {str(e)}")
 
 @app.get("/healthz")
 async def health_check():
     """Health check endpoint for the API."""
     # Check Redis connection if enabled
-    redis_status = "disabled"
-    if use_redis:
-        try:
-            redis_client = get_redis_client()
-            redis_client.ping()
-            redis_status = "healthy"
-        except Exception as e:
-            redis_status = f"unhealthy: {str(e)}"
+    redis_status = await session_store.ping()
         
     return {
-        "status": "healthy", 
+        # Degraded when the configured LLM backend failed to warm up and
+        # responses fall back to the fake LLM
+        "status": "healthy" if llm_status["ready"] else "degraded",
+        "ready": llm_status["ready"],
         "service": "glazing-ai-api",
         "redis": redis_status,
+        "session_store": session_store.backend,
+        "llm": llm_status,
+        "llm_pool": llm_clients.stats(),
+        "llm_providers": provider_health.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "scheduler": scheduler.stats(),
+        "history": history_store.stats(),
+        "resume": resume_registry.stats(),
+        "bus": connection_bus.stats(),
+        "keepalive": keepalive_scheduler.stats(),
+        "tenants": tenant_configs.stats(),
+        "knowledge": knowledge_base.stats(),
+        "analytics": conversation_analytics.stats(),
+        "rate_limits": edge_limits.stats(),
         "timestamp": datetime.now().isoformat()
     }
 
-# Import LLM helper - after app initialization to avoid circular imports
-from llm import get_llm_response
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics for streaming latency and connection health."""
+    return Response(registry.render(), media_type=METRICS_CONTENT_TYPE)
 
-async def process_message(websocket: WebSocket, session_id: str, message: str):
-    """Process incoming WebSocket messages."""
-    logger.info(f"Processing message: {message} from session {session_id}")
-    
+# Connection counts are read at scrape time rather than tracked per event
+ws_connections.collect = lambda: {
+    (widget_key,): len(conns) for widget_key, conns in keepalive_scheduler.connections.items()
+}
+
+async def handle_client_message(
+    stream: ResumableStream,
+    session_id: str,
+    message: str,
+    pipeline: SessionPipeline,
+    connection: Optional[Connection] = None,
+):
+    """Dispatch a raw client frame from the receive loop.
+
+    Control messages (ping, pong, cancel) are answered immediately, even
+    while a response is streaming; prompts are queued on the session
+    pipeline.
+    """
+    prompt = message
     try:
-        # Try to parse as JSON
-        try:
-            data = json.loads(message)
-            message_type = data.get("type", "text")
-            
-            if message_type == "ping":
-                # Handle ping messages
-                logger.info(f"Ping received from session {session_id}")
-                await websocket.send_json({
-                    "type": "pong",
-                    "timestamp": datetime.now().isoformat(),
-                    "session_id": session_id
-                })
-                return
-        except json.JSONDecodeError:
-            # Not JSON, treat as plain text
-            pass
-        
-        # Process with LLM and stream response
-        # Initialize streaming to track complete response
-        full_response = ""
-        stream_start_time = datetime.now()
+        data = json.loads(message)
+        message_type = data.get("type", "text") if isinstance(data, dict) else "text"
         
+        if message_type == "ping":
+            # Handle ping messages
+            logger.debug("Ping received")
+            await stream.send_json({
+                "type": "pong",
+                "timestamp": datetime.now().isoformat(),
+                "session_id": session_id
+            })
+            return
+        if message_type == "pong":
+            # Reply to our keepalive - the receive loop already recorded it
+            keepalive_pongs.inc()
+            return
+        if message_type == "cancel":
+            logger.info(f"Cancel requested by session {session_id}")
+            if not pipeline.cancel():
+                # Nothing in flight - still confirm so the client can reset
+                await stream.send_json({
+                    "type": "status",
+                    "message": "cancelled",
+                    "session_id": session_id,
+                    "timestamp": datetime.now().isoformat()
+                })
+            return
+        if message_type == "message" and isinstance(data.get("message"), str):
+            prompt = data["message"]
+    except json.JSONDecodeError:
+        # Not JSON, treat as plain text
+        pass
+    
+    if connection is not None:
+        connection.message_received()
+    # Checked before the prompt is queued, so a flooding client costs no
+    # generation, history or retrieval work
+    retry_after = await edge_limits.message(session_id)
+    if retry_after:
+        await stream.send_json({
+            "type": "error",
+            "code": "rate_limited",
+            "message": "You're sending messages too quickly, please wait a moment",
+            "retry_after": retry_after,
+            "session_id": session_id
+        })
+        return
+    if not pipeline.submit(prompt):
+        await stream.send_json({
+            "type": "error",
+            "message": "Too many messages in progress, please wait for the current response",
+            "session_id": session_id
+        })
+
+async def process_message(stream: ResumableStream, session_id: str, message: str, widget_key: str):
+    """Generate and stream the response to a user prompt.
+
+    Frames go through the session's resumable stream, so the generation
+    carries on (buffered) if the client drops and reconnects.
+    """
+    if logger.isEnabledFor(logging.INFO) and message_log_sampler.allow():
+        logger.info("Processing message (%d chars)", len(message))
+    
+    # Initialize streaming to track complete response
+    full_response = ""
+    stream_start_time = datetime.now()
+    
+    # Send a batch of coalesced tokens as one frame for streaming UI
+    async def send_frame(text: str, count: int):
+        await stream.send_json({
+            "type": "token",
+            "token": text,
+            "count": count,
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat()
+        })
+    
+    coalescer = TokenCoalescer(send_frame)
+    timer = StreamTimer()
+    # Recorded for analytics however the turn ends
+    outcome = "error"
+    prompt_tokens = 0
+    completion_tokens = 0
+    ttft_ms: Optional[float] = None
+    # Whether the prompt's reply made it into the history
+    answered = False
+    
+    # Define token callback for streaming
+    async def send_token(token: str):
+        nonlocal full_response, completion_tokens, ttft_ms
+        full_response += token
+        completion_tokens += 1
+        if ttft_ms is None:
+            ttft_ms = (datetime.now() - stream_start_time).total_seconds() * 1000
+        timer.token()
+        await coalescer.add(token)
+    
+    messages_in_flight.inc()
+    try:
         # Send "thinking" status message
-        await websocket.send_json({
+        await stream.send_json({
             "type": "status",
             "message": "thinking",
             "session_id": session_id,
             "timestamp": datetime.now().isoformat()
         })
         
-        # Define token callback for streaming
-        async def send_token(token: str):
-            nonlocal full_response
-            full_response += token
-            # Send token as separate message for streaming UI
-            await websocket.send_json({
-                "type": "token",
-                "token": token,
-                "session_id": session_id,
-                "timestamp": datetime.now().isoformat()
-            })
+        # Add the message to the session's history, which trims itself to
+        # the token budget, and send the whole conversation
+        await history_store.append(session_id, "user", message)
+        messages = await history_store.get_messages(session_id)
+        if not messages or messages[-1] != {"role": "user", "content": message}:
+            # History is unavailable - answer the prompt on its own
+            messages = [{"role": "user", "content": message}]
         
         # Process with LLM
-        logger.info(f"Sending to LLM: {message}")
+        logger.debug("Sending to LLM: %d messages", len(messages))
         
-        # Stream tokens from LLM
-        async for _ in get_llm_response(
+        # Stream tokens from LLM (or replay them from the response cache).
+        # aclosing() makes cancellation close the upstream stream promptly.
+        # The widget's prompt and model come from the in-process tenant
+        # cache, so this is a dict lookup rather than a database read
+        tenant = tenant_configs.get(widget_key)
+        # Passages from the widget's knowledge documents, searched in process
+        context, context_tokens = await knowledge_base.context(widget_key, message)
+        system_prompt_tokens = tenant.prompt_tokens + context_tokens
+        prompt_tokens = system_prompt_tokens + estimate_tokens("".join(m["content"] for m in messages))
+        async with aclosing(get_cached_llm_response(
             prompt=message,
-            system_prompt=system_prompt,
-            streaming_callback=send_token
-        ):
-            # Each token is handled by the callback
-            pass
+            system_prompt=tenant.system_prompt + context,
+            streaming_callback=send_token,
+            widget_key=widget_key,
+            messages=messages,
+            model=tenant.model,
+            temperature=tenant.temperature,
+            system_prompt_tokens=system_prompt_tokens,
+        )) as response_stream:
+            async for _ in response_stream:
+                # Each token is handled by the callback
+                pass
+        
+        # Flush any tokens still buffered before completing
+        await coalescer.aclose()
+        await history_store.append(session_id, "assistant", full_response)
+        answered = True
         
         # Calculate time taken
         time_taken = (datetime.now() - stream_start_time).total_seconds()
-        logger.info(f"LLM response completed in {time_taken:.2f}s: {len(full_response)} chars")
+        if logger.isEnabledFor(logging.INFO) and message_log_sampler.allow():
+            logger.info("LLM response completed in %.2fs: %d chars", time_taken, len(full_response))
+        timer.finish()
+        messages_total.labels("completed").inc()
+        outcome = "completed"
         
         # Send completion message
-        await websocket.send_json({
+        await stream.send_json({
             "type": "completion",
             "message": full_response,
             "session_id": session_id,
             "timestamp": datetime.now().isoformat()
         })
+    
+    except asyncio.CancelledError:
+        logger.info(f"Generation cancelled for session {session_id} after {len(full_response)} chars")
+        timer.finish(completed=False)
+        messages_total.labels("cancelled").inc()
+        outcome = "cancelled"
+        try:
+            # Deliver what was already generated, then mark the turn as over
+            await coalescer.aclose()
+            if full_response:
+                await history_store.append(session_id, "assistant", full_response)
+                answered = True
+            await stream.send_json({
+                "type": "status",
+                "message": "cancelled",
+                "session_id": session_id,
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception:
+            pass
+        raise
+    
+    except AdmissionRejected as e:
+        # Shed load - tell the client clearly when to try again
+        logger.warning(f"LLM request for widget {widget_key} rejected: {e.reason}")
+        messages_total.labels("rejected").inc()
+        outcome = "rejected"
+        try:
+            await stream.send_json({
+                "type": "error",
+                "code": "overloaded",
+                "message": "We're handling a lot of conversations right now, please try again shortly",
+                "retry_after": e.retry_after,
+                "session_id": session_id
+            })
+        except Exception:
+            pass
         
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
         logger.error(traceback.format_exc())
+        timer.finish(completed=False)
+        messages_total.labels("error").inc()
         try:
             # Send error message to client
             error_msg = f"Error processing your message: {str(e)}"
-            await websocket.send_json({
+            await stream.send_json({
                 "type": "error",
                 "message": error_msg,
                 "session_id": session_id
             })
         except Exception:
             pass
+    
+    finally:
+        # A flush timer left by a failed or cancelled turn must not fire
+        # after the stream is gone
+        coalescer.cancel()
+        messages_in_flight.dec()
+        if not answered:
+            # A rejected, failed or empty-cancelled turn leaves no orphan prompt
+            try:
+                await history_store.remove_last(session_id, "user", message)
+            except Exception as e:
+                logger.error(f"Failed to remove unanswered prompt from history: {str(e)}")
+        # Queued for the batched analytics writer - never waits on the sink
+        if conversation_analytics.enabled:
+            conversation_analytics.record(ConversationEvent(
+                session_id=session_id,
+                widget_key=widget_key,
+                model=tenant_configs.get(widget_key).model,
+                prompt=message,
+                response=full_response,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                ttft_ms=ttft_ms,
+                latency_ms=(datetime.now() - stream_start_time).total_seconds() * 1000,
+                outcome=outcome,
+            ))
+
+async def deliver_local(target: str, ident: Optional[str], frame: Dict[str, Any]) -> int:
+    """Write a frame routed by the connection bus to this worker's sockets."""
+    if target == "session":
+        stream = resume_registry.find(ident)
+        if stream is None or stream.websocket is None:
+            return 0
+        await stream.send_json(dict(frame, session_id=ident))
+        return 1
+    
+    sockets = keepalive_scheduler.sockets(ident if target == "widget" else None)
+    sent = 0
+    for websocket in sockets:
+        try:
+            await send_frame(websocket, frame)
+            sent += 1
+        except Exception:
+            # Closed sockets are cleaned up by their own endpoint
+            pass
+    return sent
+
+# Admin pushes are disabled unless a key is configured
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY", "")
+
+class PushRequest(BaseModel):
+    message: str
+    session_id: Optional[str] = None
+    widget_key: Optional[str] = None
+
+@app.post("/admin/push")
+async def admin_push(push: PushRequest, x_admin_key: Optional[str] = Header(None)):
+    """Push a notification to a session, a widget key's sessions, or everyone.
+
+    Delivered through the connection bus, so it reaches sockets held by any
+    worker or host.
+    """
+    if not ADMIN_API_KEY or not secrets.compare_digest(x_admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    
+    frame = {
+        "type": "notification",
+        "message": push.message,
+        "timestamp": datetime.now().isoformat()
+    }
+    if push.session_id:
+        workers = await connection_bus.send_to_session(push.session_id, frame)
+    elif push.widget_key:
+        workers = await connection_bus.send_to_widget(push.widget_key, frame)
+    else:
+        workers = await connection_bus.broadcast(frame)
+    return {"workers_reached": workers}
+
+# Bus control message that makes every worker reload a tenant's configuration
+TENANT_INVALIDATE = "tenant_invalidate"
+
+@app.post("/admin/tenants/invalidate")
+@app.post("/admin/tenants/{widget_key}/invalidate")
+async def admin_invalidate_tenant(widget_key: Optional[str] = None, x_admin_key: Optional[str] = Header(None)):
+    """Reload a widget key's configuration (or every one) on all workers.
+
+    Call after editing the tenant store; Postgres changes are pushed
+    automatically.
+    """
+    if not ADMIN_API_KEY or not secrets.compare_digest(x_admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    workers = await connection_bus.broadcast_control(TENANT_INVALIDATE, widget_key)
+    return {"widget_key": widget_key, "workers_reached": workers}
+
+# Bus control message that makes every worker remap a widget's knowledge index
+KNOWLEDGE_RELOAD = "knowledge_reload"
+
+class KnowledgeDocument(BaseModel):
+    text: str
+
+@app.put("/admin/knowledge/{widget_key}/documents/{doc_id}")
+async def admin_put_document(widget_key: str, doc_id: str, document: KnowledgeDocument, x_admin_key: Optional[str] = Header(None)):
+    """Add or replace a knowledge document used to ground a widget's answers."""
+    if not ADMIN_API_KEY or not secrets.compare_digest(x_admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    chunks = await knowledge_base.add_document(widget_key, doc_id, document.text)
+    await connection_bus.broadcast_control(KNOWLEDGE_RELOAD, widget_key)
+    return {"widget_key": widget_key, "doc_id": doc_id, "chunks": chunks}
+
+@app.delete("/admin/knowledge/{widget_key}/documents/{doc_id}")
+async def admin_delete_document(widget_key: str, doc_id: str, x_admin_key: Optional[str] = Header(None)):
+    """Remove a widget's knowledge document."""
+    if not ADMIN_API_KEY or not secrets.compare_digest(x_admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    chunks = await knowledge_base.delete_document(widget_key, doc_id)
+    await connection_bus.broadcast_control(KNOWLEDGE_RELOAD, widget_key)
+    return {"widget_key": widget_key, "doc_id": doc_id, "chunks_deleted": chunks}
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/ndjson")
+
+@app.post("/admin/batch/{widget_key}")
+async def admin_batch(
+    widget_key: str,
+    request: Request,
+    job_id: Optional[str] = None,
+    concurrency: int = BATCH_CONCURRENCY,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    x_admin_key: Optional[str] = Header(None),
+):
+    """Run many prompts through a widget's prompt and model, streaming NDJSON results.
+
+    The body is ``{"prompts": [...]}`` (optionally with ``system_prompt``,
+    ``model`` and ``temperature`` overrides) or, sent as NDJSON, one prompt
+    per line. A prompt is a string or ``{"id": ..., "prompt": ...}``.
+    Results are written one per line as they complete, then a summary
+    line. POST the same prompts with the ``job_id`` from the
+    ``X-Batch-Job-Id`` header to resume an interrupted job.
+    """
+    if not ADMIN_API_KEY or not secrets.compare_digest(x_admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    tenant = tenant_configs.get(widget_key)
+    system_prompt = None
+    try:
+        job_id = check_job_id(job_id or uuid.uuid4().hex)
+        check_overrides({"model": model, "temperature": temperature})
+        if request.headers.get("content-type", "").startswith(NDJSON_TYPES):
+            items = await parse_ndjson_prompts(request.stream())
+        else:
+            try:
+                body = await request.json()
+            except ValueError:
+                raise BatchInputError("Body must be JSON, or NDJSON with an NDJSON content type")
+            if not isinstance(body, dict):
+                raise BatchInputError("Body must be a JSON object")
+            items = parse_json_prompts(body)
+            check_overrides(body)
+            system_prompt = body.get("system_prompt")
+            model = body.get("model", model)
+            temperature = body.get("temperature", temperature)
+    except BatchInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def results():
+        counts = {"completed": 0, "resumed": 0, "failed": 0}
+        async with aclosing(run_batch(
+            job_id,
+            widget_key,
+            items,
+            system_prompt=system_prompt or tenant.system_prompt,
+            model=model or tenant.model,
+            temperature=tenant.temperature if temperature is None else float(temperature),
+            # Precounted unless the job overrides the prompt
+            system_prompt_tokens=None if system_prompt else tenant.prompt_tokens,
+            concurrency=concurrency,
+        )) as stream:
+            async for result in stream:
+                if "error" in result:
+                    counts["failed"] += 1
+                elif result.get("resumed"):
+                    counts["resumed"] += 1
+                else:
+                    counts["completed"] += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        yield json.dumps({"job_id": job_id, "done": True, "total": len(items), **counts}) + "\n"
+
+    logger.info(f"Batch job {job_id} for widget {widget_key}: {len(items)} prompts")
+    return StreamingResponse(results(), media_type="application/x-ndjson", headers={"X-Batch-Job-Id": job_id})
+
+@app.get("/admin/batch/jobs/{job_id}")
+async def admin_batch_results(job_id: str, x_admin_key: Optional[str] = Header(None)):
+    """Return a batch job's stored results as NDJSON."""
+    if not ADMIN_API_KEY or not secrets.compare_digest(x_admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    try:
+        results = await batch_jobs.load(job_id)
+    except BatchInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not results:
+        raise HTTPException(status_code=404, detail="Job not found")
+    lines = "".join(
+        json.dumps({k: v for k, v in result.items() if k != "key"}, ensure_ascii=False) + "\n"
+        for result in results.values()
+    )
+    return Response(lines, media_type="application/x-ndjson")
+
+@app.delete("/admin/batch/jobs/{job_id}")
+async def admin_batch_delete(job_id: str, x_admin_key: Optional[str] = Header(None)):
+    """Delete a batch job's stored results."""
+    if not ADMIN_API_KEY or not secrets.compare_digest(x_admin_key or "", ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    try:
+        deleted = await batch_jobs.delete(job_id)
+    except BatchInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": job_id, "deleted": deleted}
 
 @app.websocket("/ws/{widget_key}")
 async def websocket_endpoint(websocket: WebSocket, widget_key: str):
     """WebSocket endpoint for real-time chat."""
     # Log connection attempt
-    logger.debug(f"WebSocket connection attempt with widget_key={widget_key}, client={websocket.client}")
+    logger.debug("WebSocket connection attempt with widget_key=%s, client=%s", widget_key, websocket.client)
+    
+    # Negotiate the wire protocol - clients offering the v2 subprotocol get
+    # compact binary frames, everyone else the original JSON
+    codec = negotiate(websocket)
+    websocket.state.codec = codec
+    
+    # Refuse connection floods before any session state is set up. The
+    # socket is still accepted, so the client gets the reason and when to
+    # retry rather than a bare handshake failure. Behind a proxy the client
+    # address is already the one uvicorn took from X-Forwarded-For, trusting
+    # only the hops in FORWARDED_ALLOW_IPS
+    client_ip = websocket.client.host if websocket.client else None
+    retry_after = await edge_limits.connection(client_ip, widget_key)
+    if retry_after:
+        logger.debug("Connection rate limited: widget_key=%s, client=%s", widget_key, websocket.client)
+        await websocket.accept(subprotocol=codec.subprotocol)
+        try:
+            await send_frame(websocket, {
+                "type": "error",
+                "code": "rate_limited",
+                "message": "Too many connections, please try again shortly",
+                "retry_after": retry_after,
+                "timestamp": datetime.now().isoformat()
+            })
+            await websocket.close(code=RATE_LIMIT_CLOSE_CODE)
+        except Exception:
+            pass
+        return
     
     # Accept the connection
-    await websocket.accept()
-    logger.debug(f"Connection accepted for client={websocket.client}")
+    await websocket.accept(subprotocol=codec.subprotocol)
+    logger.debug("Connection accepted for client=%s, protocol=%s", websocket.client, codec.name)
     
-    # Generate a unique session ID
-    session_id = str(uuid.uuid4())
-    logger.info(f"New WebSocket connection: widget_key={widget_key}, session_id={session_id}")
+    # A reconnecting client presents its session id and the last sequence
+    # number it saw, to resume the session instead of starting over
+    requested_session_id = websocket.query_params.get("session_id")
+    try:
+        last_seq = int(websocket.query_params.get("last_seq", "0"))
+    except ValueError:
+        last_seq = 0
+    stream = resume_registry.get(requested_session_id, widget_key, codec) if requested_session_id else None
+    resumed = stream is not None
+    
+    if stream is None:
+        # Generate a unique session ID
+        session_id = str(uuid.uuid4())
+        logger.info(f"New WebSocket connection: widget_key={widget_key}, session_id={session_id}")
+        stream = resume_registry.create(session_id, widget_key, codec)
+        # Prompts are generated off the receive loop so it keeps reading
+        stream.pipeline = SessionPipeline(
+            lambda prompt: process_message(stream, session_id, prompt, widget_key)
+        )
+    else:
+        session_id = stream.session_id
+        logger.info(f"Resuming session {session_id} from seq {last_seq}: widget_key={widget_key}")
+    pipeline = stream.pipeline
+    # Correlate everything this connection (and its generations) logs
+    bind_session(session_id, widget_key)
     
-    # Start keepalive task
-    keepalive_task = None
+    connection: Optional[Connection] = None
     
     try:
-        # Store session in Redis if available
-        if use_redis and redis_client:
-            try:
-                redis_client.setex(
-                    f"session:{session_id}", 
-                    86400,  # 24 hours in seconds
-                    json.dumps({"widget_key": widget_key, "created_at": datetime.now().isoformat()})
-                )
-            except Exception as e:
-                logger.error(f"Error storing session in Redis: {str(e)}")
+        # Store session - writes are batched and never block the loop
+        if resumed:
+            await session_store.touch(session_id)
+        else:
+            await session_store.create(
+                session_id,
+                {"widget_key": widget_key, "created_at": datetime.now().isoformat()}
+            )
         
-        # Add connection to active connections
-        if widget_key not in active_connections:
-            active_connections[widget_key] = []
-        active_connections[widget_key].append(websocket)
+        # Register the connection - one shared scheduler keeps it alive
+        connection = keepalive_scheduler.add(websocket, session_id, widget_key)
+        # Let other workers route pushes for this session here
+        await connection_bus.register(session_id, widget_key)
         
         # Send welcome message
         welcome_message = {
             "type": "system",
             "message": f"Connected successfully with widget key: {widget_key}",
             "session_id": session_id,
+            "resumed": resumed,
             "timestamp": datetime.now().isoformat()
         }
-        await websocket.send_json(welcome_message)
+        if resumed:
+            welcome_message["message"] = f"Resumed session with widget key: {widget_key}"
+            welcome_message["generating"] = pipeline.busy
+            # Frames the client missed were evicted - it should drop its partial response
+            welcome_message["replay_gap"] = stream.buffer.since(last_seq) is None
+        await send_frame(websocket, welcome_message)
+        
+        # Replay missed frames, then stream live to this socket
+        replayed = await resume_registry.attach(stream, websocket, last_seq if resumed else None)
+        if resumed:
+            logger.info(f"Replayed {replayed} frames to session {session_id}")
         
-        # Start keepalive task
-        keepalive_task = asyncio.create_task(keepalive_ping(websocket, session_id))
+        pipeline.start()
         
         # Main communication loop
         try:
             while True:
                 # Receive message from client
                 data = await websocket.receive_text()
-                await process_message(websocket, session_id, data)
+                # Any frame from the client counts as a keepalive reply
+                connection.touch()
+                await session_store.touch(session_id)
+                await handle_client_message(stream, session_id, data, pipeline, connection)
                 
         except WebSocketDisconnect:
             logger.info(f"WebSocket disconnected gracefully: session_id={session_id}")
@@ -277,16 +741,18 @@ async def websocket_endpoint(websocket: WebSocket, widget_key: str):
         logger.error(traceback.format_exc())
     
     finally:
-        # Cancel keepalive task if it exists
-        if keepalive_task:
-            keepalive_task.cancel()
+        # Keep the session resumable for a while; an in-flight generation is
+        # cancelled if the client doesn't come back within the grace period
+        await resume_registry.release(stream, websocket)
+        if stream.websocket is None:
+            # Unless a newer connection has already taken the session over
+            await connection_bus.unregister(session_id)
             
         # Always clean up the connection
         try:
-            if widget_key in active_connections and websocket in active_connections[widget_key]:
-                active_connections[widget_key].remove(websocket)
-                if not active_connections[widget_key]:
-                    del active_connections[widget_key]
+            await session_store.expire(session_id)
+            if connection is not None:
+                keepalive_scheduler.remove(connection)
             logger.info(f"WebSocket connection cleaned up: session_id={session_id}")
         except Exception as cleanup_error:
             logger.error(f"Error during connection cleanup: {str(cleanup_error)}")
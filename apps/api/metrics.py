@@ -0,0 +1,348 @@
+import os
+from time import perf_counter
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+# Metrics configuration - per-token timing can be switched off on its own
+METRICS_TOKEN_TIMING = os.environ.get("METRICS_TOKEN_TIMING", "true").lower() == "true"
+
+# Latency buckets in seconds, tuned for streaming chat
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    """Base for metrics with optional labels.
+
+    Labelled children are created once and cached, so the hot path is a dict
+    lookup plus an attribute update - no locks are needed on the event loop.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self) -> object:
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Return the child for ``values``, creating it on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def remove(self, *values: str) -> None:
+        """Drop a labelled child (e.g. a widget key that went away)."""
+        self._children.pop(values, None)
+
+    def _samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    kind = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self._children[()].value += amount
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield "_total", self.labelnames, values, child.value
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down.
+
+    ``collect`` may be given instead of updating the gauge on the hot path:
+    it is called at scrape time and returns ``{label_values: value}``.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self._children[()].value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self._children[()].value -= amount
+
+    def set(self, value: float) -> None:
+        self._children[()].value = value
+
+    def _samples(self):
+        if self.collect is not None:
+            for values, value in self.collect().items():
+                yield "", self.labelnames, values, value
+            return
+        for values, child in self._children.items():
+            yield "", self.labelnames, values, child.value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        # One slot per bucket plus +Inf; made cumulative only at scrape time
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    """Bucketed distribution of observations (e.g. latencies in seconds)."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = TTFT_BUCKETS
+    ) -> None:
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float) -> None:
+        self._children[()].observe(value)
+
+    def _samples(self):
+        bucket_names = self.labelnames + ("le",)
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", bucket_names, values + (_format_value(bound),), cumulative
+            yield "_sum", self.labelnames, values, child.sum
+            yield "_count", self.labelnames, values, child.count
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class Registry:
+    """A set of metrics rendered together in Prometheus text format."""
+
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Connections and messages
+ws_connections = registry.register(
+    Gauge("glazing_ws_connections", "Open WebSocket connections by widget key", ["widget_key"])
+)
+messages_in_flight = registry.register(
+    Gauge("glazing_messages_in_flight", "Responses currently being generated")
+)
+messages_total = registry.register(
+    Counter("glazing_messages", "Prompts processed, by outcome", ["outcome"])
+)
+keepalive_failures = registry.register(
+    Counter("glazing_keepalive_failures", "Keepalive pings that could not be sent")
+)
+keepalive_pings = registry.register(
+    Counter("glazing_keepalive_pings", "Keepalive pings sent to silent connections")
+)
+keepalive_pongs = registry.register(
+    Counter("glazing_keepalive_pongs", "Keepalive pongs received from clients")
+)
+keepalive_reaped = registry.register(
+    Counter("glazing_keepalive_reaped", "Connections closed by the keepalive scheduler, by reason", ["reason"])
+)
+
+# Streaming latency
+ttft_seconds = registry.register(
+    Histogram("glazing_ttft_seconds", "Time from prompt to first streamed token", buckets=TTFT_BUCKETS)
+)
+inter_token_seconds = registry.register(
+    Histogram("glazing_inter_token_seconds", "Gap between consecutive streamed tokens", buckets=INTER_TOKEN_BUCKETS)
+)
+tokens_total = registry.register(
+    Counter("glazing_tokens_streamed", "Tokens streamed to clients")
+)
+tokens_per_second = registry.register(
+    Histogram(
+        "glazing_tokens_per_second",
+        "Streaming throughput of each completed response",
+        buckets=TOKENS_PER_SECOND_BUCKETS,
+    )
+)
+
+# Upstream LLM backends (openai, langchain, fake)
+llm_requests = registry.register(
+    Counter("glazing_llm_requests", "LLM generations started, by backend", ["backend"])
+)
+llm_errors = registry.register(
+    Counter("glazing_llm_errors", "LLM backend failures, by backend", ["backend"])
+)
+llm_fallbacks = registry.register(
+    Counter("glazing_llm_fallbacks", "Generations that fell back to another backend, by fallback backend", ["backend"])
+)
+llm_breaker_state = registry.register(
+    Gauge("glazing_llm_breaker_state", "Circuit breaker state by backend (0 closed, 1 half-open, 2 open)", ["backend"])
+)
+llm_breaker_rejections = registry.register(
+    Counter("glazing_llm_breaker_rejections", "Requests that skipped a backend because its circuit was open", ["backend"])
+)
+llm_ttft_timeouts = registry.register(
+    Counter("glazing_llm_ttft_timeouts", "Backend requests abandoned for not producing a first token in time", ["backend"])
+)
+llm_hedges = registry.register(
+    Counter("glazing_llm_hedges", "Hedged backend requests, by outcome (launched, won)", ["backend", "outcome"])
+)
+llm_coalesced = registry.register(
+    Counter("glazing_llm_coalesced", "Requests that joined an identical response already in flight instead of calling upstream")
+)
+
+# Conversation analytics
+analytics_events = registry.register(
+    Counter("glazing_analytics_events", "Conversation events by what happened to them (written, spilled, replayed, dropped)", ["outcome"])
+)
+
+# Edge rate limiting
+rate_limited = registry.register(
+    Counter("glazing_rate_limited", "Connections and prompts refused by an edge rate limit, by limit (ip, widget, message)", ["limit"])
+)
+
+# Logging
+log_records_dropped = registry.register(
+    Counter("glazing_log_records_dropped", "Log records dropped because the log queue was full")
+)
+log_records_sampled_out = registry.register(
+    Counter("glazing_log_records_sampled_out", "High-volume log records skipped by sampling, by sampler", ["sampler"])
+)
+
+
+# Unlabelled children, bound once so the per-token path skips a lookup
+_ttft = ttft_seconds.labels()
+_inter_token = inter_token_seconds.labels()
+
+
+class StreamTimer:
+    """Per-response TTFT, inter-token and throughput measurement.
+
+    Call ``token()`` for every streamed token and ``finish()`` once the
+    response ends; costs one clock read and a bucket lookup per token.
+    """
+
+    __slots__ = ("started", "first", "last", "tokens")
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.first = 0.0
+        self.last = 0.0
+        self.tokens = 0
+
+    def token(self) -> None:
+        if not METRICS_TOKEN_TIMING:
+            return
+        now = perf_counter()
+        if self.tokens:
+            _inter_token.observe(now - self.last)
+        else:
+            self.first = now
+            _ttft.observe(now - self.started)
+        self.last = now
+        self.tokens += 1
+
+    def finish(self, completed: bool = True) -> None:
+        if not METRICS_TOKEN_TIMING or not self.tokens:
+            return
+        tokens_total.inc(self.tokens)
+        if completed and self.tokens > 1 and self.last > self.first:
+            tokens_per_second.observe((self.tokens - 1) / (self.last - self.first))
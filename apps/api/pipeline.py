@@ -0,0 +1,98 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Per-session inbound prompt queue configuration
+SESSION_QUEUE_SIZE = int(os.environ.get("SESSION_QUEUE_SIZE", "4"))
+# Whether a newer prompt cancels the generation still streaming for an older one
+CANCEL_ON_NEW_PROMPT = os.environ.get("CANCEL_ON_NEW_PROMPT", "true").lower() == "true"
+
+
+class SessionPipeline:
+    """Run a session's prompts off the WebSocket receive loop.
+
+    Prompts go into a bounded queue and are handled one at a time by a
+    worker task, each generation in its own task so it can be cancelled by a
+    ``cancel`` message or, optionally, superseded by a newer prompt while the
+    receive loop keeps reading pings and control messages.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str], Awaitable[Any]],
+        queue_size: int = SESSION_QUEUE_SIZE,
+        cancel_on_new_prompt: bool = CANCEL_ON_NEW_PROMPT,
+    ) -> None:
+        """Initialize with the coroutine function that handles one prompt."""
+        self._handler = handler
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=max(queue_size, 1))
+        self.cancel_on_new_prompt = cancel_on_new_prompt
+        self._worker: Optional[asyncio.Task] = None
+        self._current: Optional[asyncio.Task] = None
+        self.cancelled = 0
+
+    def start(self) -> None:
+        """Start the worker task."""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    @property
+    def busy(self) -> bool:
+        """Whether a generation is running or prompts are waiting."""
+        return (self._current is not None and not self._current.done()) or not self._queue.empty()
+
+    def submit(self, prompt: str) -> bool:
+        """Queue a prompt, returning False if the queue is full."""
+        if self.cancel_on_new_prompt:
+            # The newest prompt supersedes anything queued or in flight
+            self.cancel()
+        try:
+            self._queue.put_nowait(prompt)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def cancel(self) -> bool:
+        """Cancel the in-flight generation and drop queued prompts.
+
+        Returns True if there was anything to cancel.
+        """
+        dropped = 0
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+            dropped += 1
+
+        current = self._current
+        if current is not None and not current.done():
+            current.cancel()
+            self.cancelled += 1
+            return True
+        return dropped > 0
+
+    async def close(self) -> None:
+        """Cancel the in-flight generation and stop the worker."""
+        self.cancel()
+        tasks = [task for task in (self._current, self._worker) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+        self._current = None
+
+    async def _run(self) -> None:
+        while True:
+            prompt = await self._queue.get()
+            self._current = asyncio.create_task(self._handler(prompt))
+            try:
+                # Wait without propagating a cancellation of the generation
+                # itself into the worker
+                await asyncio.wait({self._current})
+                if not self._current.cancelled() and self._current.exception():
+                    logger.error(f"Generation failed: {str(self._current.exception())}")
+            finally:
+                self._current = None
+                self._queue.task_done()
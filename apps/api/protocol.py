@@ -0,0 +1,102 @@
+import json
+import zlib
+from typing import Any, Dict, List, Optional, Union
+
+from fastapi import WebSocket
+
+try:
+    import msgpack
+except ImportError:  # v2 is only offered when msgpack is installed
+    msgpack = None
+
+# WebSocket subprotocol a client offers to get compact binary frames
+PROTOCOL_V2 = "glazing.v2.msgpack"
+
+# v2 frame type codes - each frame is a MessagePack array starting with one
+FRAME_OTHER = 0
+FRAME_TOKEN = 1
+FRAME_STATUS = 2
+FRAME_COMPLETION = 3
+FRAME_ERROR = 4
+FRAME_PING = 5
+FRAME_PONG = 6
+FRAME_SYSTEM = 7
+FRAME_NOTIFICATION = 8
+
+
+class JsonCodec:
+    """Protocol v1: verbose JSON text frames, kept for existing embeds."""
+
+    name = "json"
+    subprotocol: Optional[str] = None
+
+    def encode(self, frame: Dict[str, Any]) -> str:
+        return json.dumps(frame, separators=(",", ":"), ensure_ascii=False)
+
+
+class MsgpackCodec:
+    """Protocol v2: binary MessagePack arrays with short type codes.
+
+    Session ids and timestamps are dropped (the client knows its session and
+    has a clock) and the completion frame carries the response's UTF-8
+    length and CRC-32 instead of the text the client already assembled -
+    unless the frame is marked ``full_text``, when the text follows them.
+    """
+
+    name = "msgpack"
+    subprotocol = PROTOCOL_V2
+
+    def encode(self, frame: Dict[str, Any]) -> bytes:
+        frame_type = frame.get("type")
+        seq = frame.get("seq")
+        if frame_type == "token":
+            body: List[Any] = [FRAME_TOKEN, seq, frame["token"], frame.get("count", 1)]
+        elif frame_type == "status":
+            body = [FRAME_STATUS, seq, frame["message"]]
+        elif frame_type == "completion":
+            data = frame["message"].encode("utf-8")
+            body = [FRAME_COMPLETION, seq, len(data), zlib.crc32(data)]
+            if frame.get("full_text"):
+                # The client lost part of the stream and can't assemble it
+                body.append(frame["message"])
+        elif frame_type == "error":
+            body = [FRAME_ERROR, seq, frame["message"], frame.get("code"), frame.get("retry_after")]
+        elif frame_type == "ping":
+            body = [FRAME_PING]
+        elif frame_type == "pong":
+            body = [FRAME_PONG]
+        elif frame_type == "system":
+            body = [FRAME_SYSTEM, {k: v for k, v in frame.items() if k not in ("type", "timestamp")}]
+        elif frame_type == "notification":
+            body = [FRAME_NOTIFICATION, frame["message"]]
+        else:
+            body = [FRAME_OTHER, frame]
+        return msgpack.packb(body, use_bin_type=True)
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+Codec = Union[JsonCodec, MsgpackCodec]
+
+
+def negotiate(websocket: WebSocket) -> Codec:
+    """Pick the codec for a connection from the subprotocols the client offered."""
+    offered = websocket.scope.get("subprotocols") or []
+    if MSGPACK_CODEC is not None and PROTOCOL_V2 in offered:
+        return MSGPACK_CODEC
+    return JSON_CODEC
+
+
+async def send_payload(websocket: WebSocket, payload: Union[str, bytes]) -> None:
+    """Send an already-encoded frame as a text or binary message."""
+    if isinstance(payload, bytes):
+        await websocket.send_bytes(payload)
+    else:
+        await websocket.send_text(payload)
+
+
+async def send_frame(websocket: WebSocket, frame: Dict[str, Any]) -> None:
+    """Encode ``frame`` with the connection's negotiated codec and send it."""
+    codec = getattr(websocket.state, "codec", JSON_CODEC)
+    await send_payload(websocket, codec.encode(frame))
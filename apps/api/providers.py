@@ -0,0 +1,285 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+from metrics import llm_breaker_rejections, llm_breaker_state, llm_hedges, llm_ttft_timeouts
+
+logger = logging.getLogger(__name__)
+
+# Provider health configuration
+LLM_TTFT_TIMEOUT = float(os.environ.get("LLM_TTFT_TIMEOUT", "10"))  # Seconds to wait for a first token before failing over
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))  # Consecutive failures that open a circuit (0 = never)
+LLM_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))  # Seconds a circuit stays open before a trial request
+# Hedging: send a second request when the first token is slower than
+# LLM_HEDGE_PERCENTILE of recent requests
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_MS = float(os.environ.get("LLM_HEDGE_MIN_MS", "250"))  # Never hedge sooner than this
+LLM_HEDGE_MAX_RATIO = float(os.environ.get("LLM_HEDGE_MAX_RATIO", "0.1"))  # Cap on hedged requests per request
+LLM_TTFT_WINDOW = int(os.environ.get("LLM_TTFT_WINDOW", "200"))  # Recent TTFTs kept per backend
+
+# Samples needed before the TTFT percentile is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class TTFTTimeout(Exception):
+    """A backend produced no first token within the TTFT timeout."""
+
+
+class UpstreamRequestError(Exception):
+    """A backend refused the request itself (a 4xx such as an unknown model).
+
+    Another backend would refuse it too and the backend isn't failing, so
+    it is raised to the caller rather than failed over or counted against
+    the circuit.
+    """
+
+    def __init__(self, backend: str, status_code: int, message: str) -> None:
+        super().__init__(message)
+        self.backend = backend
+        self.status_code = status_code
+
+
+def is_request_error(error: BaseException) -> bool:
+    """Whether ``error`` is an upstream 4xx other than a timeout or rate limit.
+
+    Status errors from the OpenAI client (LangChain raises the same ones)
+    carry ``status_code``; timeouts, connection errors, 429s and 5xxs are
+    the backend's failures.
+    """
+    status = getattr(error, "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 409, 429)
+
+
+class CircuitBreaker:
+    """Stops sending requests to a backend that keeps failing.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    ``allow`` refuses requests for ``reset_timeout`` seconds, so callers
+    fail over at once instead of waiting for the backend to fail again.
+    Then one trial request is let through: success closes the circuit,
+    failure opens it for another ``reset_timeout``.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = LLM_BREAKER_FAILURES, reset_timeout: float = LLM_BREAKER_RESET) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        # When the half-open trial request started; a trial whose outcome
+        # is never recorded (e.g. cancelled) expires after reset_timeout
+        self._trial_started: Optional[float] = None
+        self._gauge = llm_breaker_state.labels(name)
+        self._rejections = llm_breaker_rejections.labels(name)
+
+    def _set(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"LLM backend {self.name} circuit {self.state} -> {state}")
+        self.state = state
+        self._gauge.set(STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent to the backend now."""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                self._rejections.inc()
+                return False
+            self._set(HALF_OPEN)
+        # Half open: one trial request at a time
+        if self._trial_started is not None and now - self._trial_started < self.reset_timeout:
+            self._rejections.inc()
+            return False
+        self._trial_started = now
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._trial_started = None
+        if self.state != CLOSED:
+            self._set(CLOSED)
+
+    def record_request_error(self) -> None:
+        """The backend answered but refused the request; not its failure."""
+        self._trial_started = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_started = None
+        if self.state == HALF_OPEN or (self.failure_threshold and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self._set(OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class ProviderHealth:
+    """Circuit breakers, TTFT timeouts and hedging for the LLM backends.
+
+    ``open_stream`` starts a backend's stream and waits for its first
+    token, giving up after ``ttft_timeout``. With hedging on, a request
+    still waiting after the backend's recent TTFT percentile gets a
+    duplicate; whichever produces a token first is streamed and the other
+    is cancelled. Hedges are capped at ``hedge_max_ratio`` of requests so
+    a slow backend doesn't get double the load.
+    """
+
+    def __init__(
+        self,
+        ttft_timeout: float = LLM_TTFT_TIMEOUT,
+        failure_threshold: int = LLM_BREAKER_FAILURES,
+        reset_timeout: float = LLM_BREAKER_RESET,
+        hedge: bool = LLM_HEDGE,
+        hedge_percentile: float = LLM_HEDGE_PERCENTILE,
+        hedge_min_ms: float = LLM_HEDGE_MIN_MS,
+        hedge_max_ratio: float = LLM_HEDGE_MAX_RATIO,
+        window: int = LLM_TTFT_WINDOW,
+    ) -> None:
+        self.ttft_timeout = ttft_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min = hedge_min_ms / 1000
+        self.hedge_max_ratio = hedge_max_ratio
+        self.window = window
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._ttfts: Dict[str, Deque[float]] = {}
+        self.requests = 0
+        self.hedges = 0
+
+    def breaker(self, backend: str) -> CircuitBreaker:
+        breaker = self.breakers.get(backend)
+        if breaker is None:
+            breaker = self.breakers[backend] = CircuitBreaker(backend, self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def record_ttft(self, backend: str, seconds: float) -> None:
+        samples = self._ttfts.get(backend)
+        if samples is None:
+            samples = self._ttfts[backend] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def _percentile(self, backend: str, pct: float) -> Optional[float]:
+        samples = self._ttfts.get(backend)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(max(int(round(pct / 100 * len(ordered))) - 1, 0), len(ordered) - 1)]
+
+    def hedge_delay(self, backend: str) -> Optional[float]:
+        """Seconds to wait for a first token before hedging, or None not to."""
+        if not self.hedge or len(self._ttfts.get(backend, ())) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self._percentile(backend, self.hedge_percentile) or 0, self.hedge_min)
+
+    def _hedge_allowed(self) -> bool:
+        return self.hedges < self.hedge_max_ratio * self.requests
+
+    async def open_stream(
+        self,
+        backend: str,
+        start: Callable[[], AsyncIterator[str]],
+    ) -> Tuple[AsyncIterator[str], Optional[str]]:
+        """Start ``start()`` and wait for its first token, hedging if it's slow.
+
+        Returns the winning stream and its first token (None if the stream
+        was empty). Raises ``TTFTTimeout`` if no attempt produced a token in
+        time, or the error of the last attempt if they all failed.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + self.ttft_timeout
+        hedge_delay = self.hedge_delay(backend)
+        hedge_at = started + hedge_delay if hedge_delay is not None else None
+        self.requests += 1
+
+        attempts: List[Tuple[AsyncIterator[str], "asyncio.Future[str]"]] = []
+
+        def launch() -> None:
+            stream = start()
+            attempts.append((stream, asyncio.ensure_future(stream.__anext__())))
+
+        launch()
+        winner: Optional[int] = None
+        try:
+            while True:
+                wake = deadline if hedge_at is None else min(deadline, hedge_at)
+                pending = [task for _, task in attempts if not task.done()]
+                await asyncio.wait(pending, timeout=max(wake - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED)
+
+                error: Optional[BaseException] = None
+                for index, (_, task) in enumerate(attempts):
+                    if not task.done():
+                        continue
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner = index
+                        break
+                if winner is not None:
+                    break
+                if all(task.done() for _, task in attempts):
+                    raise error  # type: ignore[misc]
+
+                now = loop.time()
+                if now >= deadline:
+                    llm_ttft_timeouts.labels(backend).inc()
+                    raise TTFTTimeout(f"No first token from {backend} within {self.ttft_timeout}s")
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if self._hedge_allowed():
+                        self.hedges += 1
+                        llm_hedges.labels(backend, "launched").inc()
+                        logger.debug("Hedging %s request after %.3fs", backend, now - started)
+                        launch()
+        finally:
+            for index, (stream, task) in enumerate(attempts):
+                if index != winner:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    try:
+                        await stream.aclose()
+                    except Exception:
+                        pass
+
+        self.record_ttft(backend, loop.time() - started)
+        if winner > 0:
+            llm_hedges.labels(backend, "won").inc()
+        stream, task = attempts[winner]
+        first = None if task.exception() is not None else task.result()
+        return stream, first
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ttft_timeout": self.ttft_timeout,
+            "hedge": self.hedge,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "backends": {
+                backend: {
+                    **breaker.stats(),
+                    "ttft_ms_p50": round((self._percentile(backend, 50) or 0) * 1000, 1),
+                    "ttft_ms_p95": round((self._percentile(backend, 95) or 0) * 1000, 1),
+                    "hedge_delay_ms": (
+                        round(self.hedge_delay(backend) * 1000, 1) if self.hedge_delay(backend) else None
+                    ),
+                }
+                for backend, breaker in self.breakers.items()
+            },
+        }
+
+
+provider_health = ProviderHealth()
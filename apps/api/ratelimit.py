@@ -0,0 +1,244 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import rate_limited
+
+logger = logging.getLogger(__name__)
+
+# Edge rate limits: token buckets refilled at RATE per second, holding up to
+# BURST. A rate of 0 turns that limit off.
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory").lower()  # memory or redis
+# New WebSocket connections per client IP
+RATE_LIMIT_IP_RATE = float(os.environ.get("RATE_LIMIT_IP_RATE", "1"))
+RATE_LIMIT_IP_BURST = float(os.environ.get("RATE_LIMIT_IP_BURST", "20"))
+# New WebSocket connections per widget key
+RATE_LIMIT_WIDGET_RATE = float(os.environ.get("RATE_LIMIT_WIDGET_RATE", "50"))
+RATE_LIMIT_WIDGET_BURST = float(os.environ.get("RATE_LIMIT_WIDGET_BURST", "500"))
+# Prompts per session
+RATE_LIMIT_MESSAGE_RATE = float(os.environ.get("RATE_LIMIT_MESSAGE_RATE", "0.5"))
+RATE_LIMIT_MESSAGE_BURST = float(os.environ.get("RATE_LIMIT_MESSAGE_BURST", "5"))
+# In-memory buckets kept per worker; the least recently used are dropped beyond this
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", "100000"))
+RATE_LIMIT_REDIS_TIMEOUT_MS = float(os.environ.get("RATE_LIMIT_REDIS_TIMEOUT_MS", "50"))
+
+# WebSocket close code for connections refused by a rate limit
+RATE_LIMIT_CLOSE_CODE = 4029
+
+
+class Limit:
+    """A named token bucket: ``rate`` tokens per second, at most ``burst``."""
+
+    __slots__ = ("name", "rate", "burst")
+
+    def __init__(self, name: str, rate: float, burst: float) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+
+
+class RateLimiter:
+    """Interface for where token buckets are kept."""
+
+    backend = "none"
+
+    async def check(self, limit: Limit, key: str, cost: float = 1.0) -> float:
+        """Take ``cost`` tokens from ``key``'s bucket.
+
+        Returns 0 if they were taken, otherwise the seconds until they
+        could be (and takes nothing).
+        """
+        return 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend}
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Buckets in a dict, per worker.
+
+    A bucket is created full on first use. Buckets are kept in order of
+    last use and beyond ``max_buckets`` the least recently used is dropped,
+    so memory stays bounded under key churn at a constant cost per check;
+    the oldest bucket has usually refilled anyway.
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_BUCKETS) -> None:
+        self.max_buckets = max_buckets
+        # (limit name, key) -> [tokens, updated], least recently used first
+        self._buckets: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self.evicted = 0
+
+    def take(self, limit: Limit, key: str, cost: float = 1.0) -> float:
+        """``check`` without the coroutine, for callers on the event loop."""
+        now = time.monotonic()
+        bucket_key = (limit.name, key)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+            bucket = self._buckets[bucket_key] = [limit.burst, now]
+        else:
+            self._buckets.move_to_end(bucket_key)
+            tokens = bucket[0] + (now - bucket[1]) * limit.rate
+            bucket[0] = tokens if tokens < limit.burst else limit.burst
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / limit.rate
+
+    async def check(self, limit: Limit, key: str, cost: float = 1.0) -> float:
+        return self.take(limit, key, cost)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "buckets": len(self._buckets), "evicted": self.evicted}
+
+
+class RedisRateLimiter(RateLimiter):
+    """Buckets in Redis, shared by every worker and host.
+
+    Each check is one atomic Lua script run against Redis' own clock, so
+    concurrent workers can't both spend the last token. If Redis is slow
+    or down the check falls back to this worker's in-memory buckets.
+    """
+
+    backend = "redis"
+
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local cost = tonumber(ARGV[3])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1])
+        if tokens == nil then
+            tokens = burst
+        else
+            tokens = math.min(burst, tokens + (now - tonumber(bucket[2])) * rate)
+        end
+        local retry = 0
+        if tokens >= cost then
+            tokens = tokens - cost
+        else
+            retry = (cost - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        -- Gone once it would have refilled anyway
+        redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+        return tostring(retry)
+    """
+
+    def __init__(self, redis_client: Any, timeout_ms: float = RATE_LIMIT_REDIS_TIMEOUT_MS) -> None:
+        self.redis = redis_client
+        self.timeout = timeout_ms / 1000
+        self._script = redis_client.register_script(self.SCRIPT)
+        self.fallback = MemoryRateLimiter()
+        self.errors = 0
+        self._failing = False
+
+    async def check(self, limit: Limit, key: str, cost: float = 1.0) -> float:
+        try:
+            retry = await asyncio.wait_for(
+                self._script(keys=[f"ratelimit:{limit.name}:{key}"], args=[limit.rate, limit.burst, cost]),
+                timeout=self.timeout,
+            )
+        except Exception as e:
+            self.errors += 1
+            if not self._failing:
+                self._failing = True
+                logger.warning(f"Rate limit Redis check failed, limiting per worker: {str(e)}")
+            return self.fallback.take(limit, key, cost)
+        if self._failing:
+            self._failing = False
+            logger.info("Rate limit Redis checks recovered")
+        return float(retry)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "redis_errors": self.errors, "fallback": self.fallback.stats()}
+
+
+def create_rate_limiter(backend: str = RATE_LIMIT_BACKEND) -> RateLimiter:
+    """Build the configured limiter backend."""
+    if backend == "redis":
+        from redis_pool import get_redis
+
+        return RedisRateLimiter(get_redis())
+    return MemoryRateLimiter()
+
+
+class EdgeRateLimits:
+    """Connection and message limits enforced by the WebSocket endpoint.
+
+    ``connection`` is checked before a socket is set up, against the
+    client IP's and the widget key's buckets; ``message`` before a prompt
+    is queued, against the session's. Both return 0 to go ahead or the
+    seconds the client should wait, which goes back in the error frame's
+    ``retry_after``.
+    """
+
+    def __init__(
+        self,
+        limiter: Optional[RateLimiter] = None,
+        enabled: bool = RATE_LIMIT_ENABLED,
+        per_ip: Limit = Limit("ip", RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST),
+        per_widget: Limit = Limit("widget", RATE_LIMIT_WIDGET_RATE, RATE_LIMIT_WIDGET_BURST),
+        per_session: Limit = Limit("message", RATE_LIMIT_MESSAGE_RATE, RATE_LIMIT_MESSAGE_BURST),
+    ) -> None:
+        self.limiter = limiter or MemoryRateLimiter()
+        self.enabled = enabled
+        self.per_ip = per_ip
+        self.per_widget = per_widget
+        self.per_session = per_session
+        self.limited: Dict[str, int] = {per_ip.name: 0, per_widget.name: 0, per_session.name: 0}
+        self._limited_metrics = {name: rate_limited.labels(name) for name in self.limited}
+
+    async def _check(self, limit: Limit, key: str) -> float:
+        if not limit.rate:
+            return 0.0
+        retry_after = await self.limiter.check(limit, key)
+        if not retry_after:
+            return 0.0
+        self.limited[limit.name] += 1
+        self._limited_metrics[limit.name].inc()
+        # Rounded up, so a client waiting that long finds a token
+        return math.ceil(retry_after * 10) / 10
+
+    async def connection(self, ip: Optional[str], widget_key: str) -> float:
+        """Seconds a new connection from ``ip`` to ``widget_key`` must wait, or 0."""
+        if not self.enabled:
+            return 0.0
+        if ip:
+            retry_after = await self._check(self.per_ip, ip)
+            if retry_after:
+                return retry_after
+        return await self._check(self.per_widget, widget_key)
+
+    async def message(self, session_id: str) -> float:
+        """Seconds the session must wait before its next prompt, or 0."""
+        if not self.enabled:
+            return 0.0
+        return await self._check(self.per_session, session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "limits": {
+                limit.name: {"rate": limit.rate, "burst": limit.burst}
+                for limit in (self.per_ip, self.per_widget, self.per_session)
+            },
+            "limited": dict(self.limited),
+            **self.limiter.stats(),
+        }
+
+
+edge_limits = EdgeRateLimits(create_rate_limiter())
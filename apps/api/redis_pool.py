@@ -0,0 +1,45 @@
+import os
+import logging
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Redis connection - optional for local development
+USE_REDIS = os.environ.get("USE_REDIS", "false").lower() == "true"
+REDIS_HOST = os.environ.get("REDIS_HOST", "redis")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", "2"))
+
+_redis: Optional[Any] = None
+
+
+def get_redis() -> Any:
+    """Return the shared asyncio Redis client, creating its pool on first use."""
+    global _redis
+    if _redis is None:
+        import redis.asyncio as aioredis
+
+        pool = aioredis.ConnectionPool(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=0,
+            decode_responses=True,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        )
+        _redis = aioredis.Redis(connection_pool=pool)
+    return _redis
+
+
+async def close_redis() -> None:
+    """Close the shared Redis client and its pool."""
+    global _redis
+    if _redis is not None:
+        try:
+            await _redis.close()
+            await _redis.connection_pool.disconnect()
+        except Exception as e:
+            logger.error(f"Error closing Redis pool: {str(e)}")
+        _redis = None
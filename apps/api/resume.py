@@ -0,0 +1,292 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+from fastapi import WebSocket
+
+from pipeline import SessionPipeline
+from protocol import JSON_CODEC, Codec, send_payload
+
+logger = logging.getLogger(__name__)
+
+# Resumable stream configuration
+RESUME_ENABLED = os.environ.get("RESUME_ENABLED", "true").lower() == "true"
+# Seconds a disconnected session can still be resumed
+RESUME_TTL = float(os.environ.get("RESUME_TTL", "120"))
+# Seconds a detached session's generation keeps running before it is cancelled
+RESUME_GENERATION_GRACE = float(os.environ.get("RESUME_GENERATION_GRACE", "30"))
+RESUME_BUFFER_FRAMES = int(os.environ.get("RESUME_BUFFER_FRAMES", "512"))
+RESUME_BUFFER_BYTES = int(os.environ.get("RESUME_BUFFER_BYTES", str(256 * 1024)))
+# Cap on replay buffers across all sessions; detached sessions are evicted first
+RESUME_MAX_BYTES = int(os.environ.get("RESUME_MAX_BYTES", str(64 * 1024 * 1024)))
+RESUME_REAP_INTERVAL = float(os.environ.get("RESUME_REAP_INTERVAL", "5"))
+
+# Connection-level frames that are neither sequenced nor replayed
+UNSEQUENCED_TYPES = frozenset({"ping", "pong", "system", "notification"})
+
+
+class ReplayBuffer:
+    """Ring buffer of a session's most recent encoded frames.
+
+    Bounded by frame count and bytes; the newest frame is always kept.
+    """
+
+    def __init__(self, max_frames: int = RESUME_BUFFER_FRAMES, max_bytes: int = RESUME_BUFFER_BYTES) -> None:
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self._frames: Deque[Tuple[int, Union[str, bytes]]] = deque()
+        self.bytes = 0
+        self.last_seq = 0
+
+    def append(self, payload: Union[str, bytes]) -> int:
+        """Buffer a frame, returning its sequence number."""
+        self.last_seq += 1
+        self._frames.append((self.last_seq, payload))
+        self.bytes += len(payload)
+        while len(self._frames) > 1 and (len(self._frames) > self.max_frames or self.bytes > self.max_bytes):
+            _, dropped = self._frames.popleft()
+            self.bytes -= len(dropped)
+        return self.last_seq
+
+    def since(self, last_seq: int) -> Optional[List[Tuple[int, Union[str, bytes]]]]:
+        """Frames after ``last_seq``, or None if some were already evicted."""
+        if last_seq >= self.last_seq:
+            return []
+        if not self._frames or self._frames[0][0] > last_seq + 1:
+            return None
+        return [frame for frame in self._frames if frame[0] > last_seq]
+
+    def clear(self) -> None:
+        self._frames.clear()
+        self.bytes = 0
+
+
+class ResumableStream:
+    """A session's outbound frames, decoupled from any one WebSocket.
+
+    ``send_json`` numbers each frame, keeps it in the replay buffer and
+    forwards it to the attached socket if there is one. While detached the
+    generation keeps running and its frames are only buffered, so a client
+    that reconnects can pick up where it left off. Frames are encoded once,
+    with the protocol the session was opened with.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        widget_key: str,
+        codec: Codec = JSON_CODEC,
+        buffer: Optional[ReplayBuffer] = None,
+    ) -> None:
+        self.session_id = session_id
+        self.widget_key = widget_key
+        self.codec = codec
+        self.buffer = buffer or ReplayBuffer()
+        self.websocket: Optional[WebSocket] = None
+        self.pipeline: Optional[SessionPipeline] = None
+        self.detached_at: Optional[float] = time.monotonic()
+        # Set when a resume couldn't replay everything the client missed;
+        # the next completion frame then carries the full response text
+        self.replay_gap = False
+        # Held from numbering a frame until it is on the wire, so concurrent
+        # senders (tokens, pushes) can't put seq N+1 out before seq N
+        self._send_lock = asyncio.Lock()
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        """Send a frame to the client, sequencing and buffering stream frames."""
+        if data.get("type") in UNSEQUENCED_TYPES:
+            websocket = self.websocket
+            if websocket is not None:
+                await send_payload(websocket, self.codec.encode(data))
+            return
+
+        async with self._send_lock:
+            if self.replay_gap and data.get("type") == "completion":
+                self.replay_gap = False
+                data["full_text"] = True
+            data["seq"] = self.buffer.last_seq + 1
+            # Encode once for both the buffer and the socket
+            payload = self.codec.encode(data)
+            self.buffer.append(payload)
+            websocket = self.websocket
+            if websocket is None:
+                return
+            try:
+                await send_payload(websocket, payload)
+            except Exception as e:
+                # The receive loop will notice the disconnect; keep generating
+                logger.debug(f"Send failed for session {self.session_id}, detaching: {str(e)}")
+                if self.websocket is websocket:
+                    self.websocket = None
+                    self.detached_at = time.monotonic()
+
+
+class ResumeRegistry:
+    """In-process registry of resumable sessions.
+
+    Detached sessions keep their buffer for ``ttl`` seconds; their in-flight
+    generation is cancelled after ``grace`` seconds so abandoned sessions
+    stop consuming upstream tokens.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = RESUME_ENABLED,
+        ttl: float = RESUME_TTL,
+        grace: float = RESUME_GENERATION_GRACE,
+        max_bytes: int = RESUME_MAX_BYTES,
+        reap_interval: float = RESUME_REAP_INTERVAL,
+    ) -> None:
+        self.enabled = enabled
+        self.ttl = ttl
+        self.grace = grace
+        self.max_bytes = max_bytes
+        self.reap_interval = reap_interval
+        self._streams: Dict[str, ResumableStream] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self.resumed = 0
+        self.replay_gaps = 0
+        self.expired = 0
+
+    async def start(self) -> None:
+        if self.enabled and self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+        streams = list(self._streams.values())
+        self._streams.clear()
+        await asyncio.gather(*(self._close_stream(s) for s in streams), return_exceptions=True)
+
+    def create(self, session_id: str, widget_key: str, codec: Codec = JSON_CODEC) -> ResumableStream:
+        stream = ResumableStream(session_id, widget_key, codec)
+        self._streams[session_id] = stream
+        return stream
+
+    def get(self, session_id: str, widget_key: str, codec: Codec = JSON_CODEC) -> Optional[ResumableStream]:
+        """Return a resumable session, if it exists and belongs to ``widget_key``.
+
+        The reconnecting client must speak the protocol the buffered frames
+        were encoded with.
+        """
+        if not self.enabled:
+            return None
+        stream = self._streams.get(session_id)
+        if stream is None or stream.widget_key != widget_key or stream.codec is not codec:
+            return None
+        return stream
+
+    def find(self, session_id: str) -> Optional[ResumableStream]:
+        """Return a session's stream regardless of widget key (for server pushes)."""
+        return self._streams.get(session_id)
+
+    async def attach(self, stream: ResumableStream, websocket: WebSocket, last_seq: Optional[int] = None) -> int:
+        """Make ``websocket`` the session's socket, replaying frames after ``last_seq``.
+
+        Returns the number of frames replayed.
+        """
+        previous = stream.websocket
+        stream.websocket = None
+        if previous is not None and previous is not websocket:
+            # A half-open old connection is superseded by the new one
+            try:
+                await previous.close(code=4001)
+            except Exception:
+                pass
+
+        replayed = 0
+        if last_seq is not None:
+            self.resumed += 1
+            # Frames generated while replaying are picked up by the next pass;
+            # there is no await between the last check and attaching
+            while True:
+                frames = stream.buffer.since(last_seq)
+                if frames is None:
+                    self.replay_gaps += 1
+                    stream.replay_gap = True
+                    break
+                if not frames:
+                    break
+                for seq, payload in frames:
+                    await send_payload(websocket, payload)
+                    last_seq = seq
+                    replayed += 1
+
+        stream.websocket = websocket
+        stream.detached_at = None
+        return replayed
+
+    async def release(self, stream: ResumableStream, websocket: WebSocket) -> None:
+        """Detach a closed socket; the session stays resumable for ``ttl`` seconds."""
+        if stream.websocket is websocket:
+            stream.websocket = None
+            stream.detached_at = time.monotonic()
+        if not self.enabled:
+            self._streams.pop(stream.session_id, None)
+            await self._close_stream(stream)
+
+    async def _close_stream(self, stream: ResumableStream) -> None:
+        stream.websocket = None
+        if stream.pipeline is not None:
+            await stream.pipeline.close()
+        stream.buffer.clear()
+
+    async def _reap_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(f"Error reaping resumable sessions: {str(e)}")
+
+    async def reap(self) -> None:
+        """Cancel abandoned generations and evict expired or excess sessions."""
+        now = time.monotonic()
+        evict: List[ResumableStream] = []
+        detached: List[ResumableStream] = []
+        total_bytes = 0
+        for stream in self._streams.values():
+            total_bytes += stream.buffer.bytes
+            if stream.detached_at is None:
+                continue
+            idle = now - stream.detached_at
+            if idle > self.ttl:
+                evict.append(stream)
+                continue
+            detached.append(stream)
+            if idle > self.grace and stream.pipeline is not None and stream.pipeline.busy:
+                logger.info(f"Cancelling generation for abandoned session {stream.session_id}")
+                stream.pipeline.cancel()
+
+        # Over the memory cap - drop the longest-detached sessions first
+        remaining = total_bytes - sum(s.buffer.bytes for s in evict)
+        for stream in sorted(detached, key=lambda s: s.detached_at):
+            if remaining <= self.max_bytes:
+                break
+            remaining -= stream.buffer.bytes
+            evict.append(stream)
+
+        for stream in evict:
+            self._streams.pop(stream.session_id, None)
+            self.expired += 1
+            await self._close_stream(stream)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sessions": len(self._streams),
+            "detached": sum(1 for s in self._streams.values() if s.detached_at is not None),
+            "buffer_bytes": sum(s.buffer.bytes for s in self._streams.values()),
+            "resumed": self.resumed,
+            "replay_gaps": self.replay_gaps,
+            "expired": self.expired,
+        }
+
+
+resume_registry = ResumeRegistry()
@@ -0,0 +1,538 @@
+import os
+import re
+import json
+import zlib
+import fcntl
+import asyncio
+import hashlib
+import logging
+import pathlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from history import token_counter
+
+logger = logging.getLogger(__name__)
+
+# Retrieval (RAG) configuration
+RAG_ENABLED = os.environ.get("RAG_ENABLED", "false").lower() == "true"
+RAG_INDEX_DIR = os.environ.get("RAG_INDEX_DIR") or str(pathlib.Path(__file__).parent / "data" / "knowledge")
+RAG_DIM = int(os.environ.get("RAG_DIM", "256"))  # Dimensions of the local hashing embedder
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", "4"))
+RAG_MIN_SCORE = float(os.environ.get("RAG_MIN_SCORE", "0.15"))  # Cosine similarity a chunk needs to be used
+RAG_CHUNK_CHARS = int(os.environ.get("RAG_CHUNK_CHARS", "800"))
+RAG_CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", "100"))
+RAG_MAX_CONTEXT_TOKENS = int(os.environ.get("RAG_MAX_CONTEXT_TOKENS", "800"))  # Retrieved text added to the prompt
+RAG_THREAD_MIN_ROWS = int(os.environ.get("RAG_THREAD_MIN_ROWS", "20000"))  # Search larger indexes off the event loop
+
+# Rows scored per matrix product, bounding the temporary score matrix
+SEARCH_BLOCK_ROWS = 131072
+INITIAL_CAPACITY = 1024
+
+WORD_RE = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be by can do for from has have how i in is it my of on or our "
+    "so that the this to was we what when where which who why will with you your".split()
+)
+
+CONTEXT_HEADER = "\n\nRelevant information from the company's documents:\n"
+
+
+def chunk_text(text: str, size: int = RAG_CHUNK_CHARS, overlap: int = RAG_CHUNK_OVERLAP) -> List[str]:
+    """Split ``text`` into chunks of about ``size`` characters on word boundaries.
+
+    Consecutive chunks share about ``overlap`` characters, so a passage cut
+    by a boundary is still whole in one of them.
+    """
+    words = text.split()
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = start
+        length = 0
+        while end < len(words) and (end == start or length + len(words[end]) + 1 <= size):
+            length += len(words[end]) + 1
+            end += 1
+        chunks.append(" ".join(words[start:end]))
+        if end >= len(words):
+            break
+        next_start = end
+        shared = 0
+        while next_start > start + 1 and shared + len(words[next_start - 1]) + 1 <= overlap:
+            next_start -= 1
+            shared += len(words[next_start]) + 1
+        start = next_start
+    return chunks
+
+
+class Embedder:
+    """Interface for turning texts into unit-length vectors."""
+
+    dim = 0
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Return a ``(len(texts), dim)`` float32 matrix of L2-normalised rows."""
+        raise NotImplementedError
+
+
+class HashEmbedder(Embedder):
+    """Deterministic local embeddings from hashed words and word pairs.
+
+    Needs no model or network and gives the same vector for the same text
+    in every process, so tests and benchmarks are repeatable. Matching is
+    lexical: texts score high when they share words.
+    """
+
+    def __init__(self, dim: int = RAG_DIM) -> None:
+        self.dim = dim
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        words = [w for w in WORD_RE.findall(text.lower()) if w not in STOPWORDS]
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        if not features:
+            return np.zeros(self.dim, dtype=np.float32)
+        # crc32 rather than hash(), which is salted per process
+        hashes = np.fromiter((zlib.crc32(f.encode()) for f in features), dtype=np.uint32, count=len(features))
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+        vector = np.bincount((hashes % self.dim).astype(np.intp), weights=signs, minlength=self.dim)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).astype(np.float32)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self._embed_one(text) for text in texts])
+
+
+def _dir_name(widget_key: str) -> str:
+    if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", widget_key):
+        return widget_key
+    return "k-" + hashlib.sha1(widget_key.encode()).hexdigest()
+
+
+class VectorIndex:
+    """One widget's chunks and their embeddings in memory-mapped files.
+
+    - ``vectors.f32``: ``(capacity, dim)`` float32 embeddings
+    - ``owner.i32``: per row, the owning document's number plus one (0 = free)
+    - ``rows.i64``: per row, offset and length of its text and its token count
+    - ``texts.bin``: chunk texts, appended (deleted chunks' text is not reclaimed)
+    - ``manifest.json``: dimensions, capacity, rows in use and document numbers
+
+    Adding a document fills free rows (left by deletes) before appending,
+    growing the files by doubling, so neither adds nor deletes rebuild the
+    index. Readers use whatever mapping they started with; writers take a
+    file lock, so several workers can share one index.
+    """
+
+    def __init__(self, path: pathlib.Path, widget_key: str, dim: int) -> None:
+        self.path = path
+        self.widget_key = widget_key
+        self.dim = dim
+        self.capacity = 0
+        self.size = 0
+        self.docs: Dict[str, int] = {}
+        self.next_doc = 1
+        self._manifest_mtime = 0.0
+        self._text_fd: Optional[int] = None
+        # Swapped as a whole so a search always sees one consistent mapping
+        self._view: Tuple[Any, Any, Any, int] = (None, None, None, 0)
+
+    @classmethod
+    def open(cls, root: str, widget_key: str, dim: int, create: bool = False) -> Optional["VectorIndex"]:
+        path = pathlib.Path(root) / _dir_name(widget_key)
+        if not (path / "manifest.json").exists():
+            if not create:
+                return None
+            path.mkdir(parents=True, exist_ok=True)
+        index = cls(path, widget_key, dim)
+        with index._locked():
+            if not (path / "manifest.json").exists():
+                index._grow(INITIAL_CAPACITY)
+                index._write_manifest()
+            index._load()
+        return index
+
+    def _locked(self) -> Any:
+        return _FileLock(self.path / "lock")
+
+    def _load(self) -> None:
+        """Map the files as described by the manifest, if it changed."""
+        manifest_path = self.path / "manifest.json"
+        mtime = manifest_path.stat().st_mtime
+        if mtime == self._manifest_mtime:
+            return
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["dim"] != self.dim:
+            raise ValueError(f"Index for {self.widget_key} has {manifest['dim']} dimensions, expected {self.dim}")
+        self.capacity = manifest["capacity"]
+        self.docs = manifest["docs"]
+        self.next_doc = manifest["next_doc"]
+        self.size = manifest["size"]
+        self._map()
+        self._manifest_mtime = mtime
+
+    def _map(self) -> None:
+        vectors = np.memmap(self.path / "vectors.f32", dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+        owner = np.memmap(self.path / "owner.i32", dtype=np.int32, mode="r+", shape=(self.capacity,))
+        rows = np.memmap(self.path / "rows.i64", dtype=np.int64, mode="r+", shape=(self.capacity, 3))
+        if self._text_fd is None:
+            self._text_fd = os.open(self.path / "texts.bin", os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        self._view = (vectors, owner, rows, self.size)
+
+    def _grow(self, capacity: int) -> None:
+        """Extend the row files to ``capacity``; new rows read as free."""
+        for name, row_bytes in (("vectors.f32", self.dim * 4), ("owner.i32", 4), ("rows.i64", 24)):
+            with open(self.path / name, "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self._map()
+
+    def _write_manifest(self) -> None:
+        manifest = {
+            "widget_key": self.widget_key,
+            "dim": self.dim,
+            "capacity": self.capacity,
+            "size": self.size,
+            "docs": self.docs,
+            "next_doc": self.next_doc,
+        }
+        tmp = self.path / "manifest.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.path / "manifest.json")
+        self._manifest_mtime = (self.path / "manifest.json").stat().st_mtime
+
+    def reload(self) -> None:
+        """Pick up changes another worker made."""
+        self._load()
+
+    @property
+    def chunks(self) -> int:
+        _, owner, _, size = self._view
+        return int(np.count_nonzero(owner[:size])) if size else 0
+
+    def add(self, doc_id: str, texts: List[str], vectors: np.ndarray, tokens: List[int]) -> int:
+        """Store a document's chunks, replacing any earlier version of it."""
+        with self._locked():
+            self._load()
+            self._delete_rows(doc_id)
+            _, owner, _, size = self._view
+            free = np.flatnonzero(owner[:size] == 0)[:len(texts)]
+            appended = len(texts) - len(free)
+            if size + appended > self.capacity:
+                self._grow(max(self.capacity * 2, size + appended))
+            rows = np.concatenate([free, np.arange(size, size + appended)]).astype(np.intp)
+            vector_map, owner, row_map, _ = self._view
+
+            encoded = [text.encode() for text in texts]
+            offset = os.fstat(self._text_fd).st_size
+            os.write(self._text_fd, b"".join(encoded))
+            for row, data, count in zip(rows, encoded, tokens):
+                row_map[row] = (offset, len(data), count)
+                offset += len(data)
+            vector_map[rows] = vectors
+            row_map.flush()
+            vector_map.flush()
+
+            # The manifest registers the document, then setting the owner
+            # makes its rows visible to searches
+            doc_number = self.next_doc
+            self.docs[doc_id] = doc_number
+            self.next_doc += 1
+            self.size = size + appended
+            self._write_manifest()
+            owner[rows] = doc_number
+            owner.flush()
+            self._view = (vector_map, owner, row_map, self.size)
+        return len(rows)
+
+    def _delete_rows(self, doc_id: str) -> int:
+        doc_number = self.docs.pop(doc_id, None)
+        if doc_number is None:
+            return 0
+        _, owner, _, size = self._view
+        rows = np.flatnonzero(owner[:size] == doc_number)
+        owner[rows] = 0
+        owner.flush()
+        return len(rows)
+
+    def delete(self, doc_id: str) -> int:
+        """Remove a document's chunks; their rows are reused by later adds."""
+        with self._locked():
+            self._load()
+            deleted = self._delete_rows(doc_id)
+            self._write_manifest()
+        return deleted
+
+    def search(self, queries: np.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        """Top ``k`` rows by cosine similarity for each row of ``queries``.
+
+        Scores are one matrix product per block of rows for the whole batch
+        of queries, with an ``argpartition`` per block to keep only the
+        candidates.
+        """
+        vectors, owner, _, size = self._view
+        if not size or not len(queries):
+            return [[] for _ in range(len(queries))]
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        best_rows: Optional[np.ndarray] = None
+        best_scores: Optional[np.ndarray] = None
+        for start in range(0, size, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, size)
+            # (queries, rows): each query's scores are contiguous for the partition
+            scores = queries @ vectors[start:stop].T
+            scores[:, owner[start:stop] == 0] = -np.inf
+            keep = min(k, stop - start)
+            top = np.argpartition(scores, -keep, axis=1)[:, -keep:]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            top += start
+            if best_rows is None:
+                best_rows, best_scores = top, top_scores
+            else:
+                rows = np.concatenate([best_rows, top], axis=1)
+                merged = np.concatenate([best_scores, top_scores], axis=1)
+                keep = min(k, rows.shape[1])
+                order = np.argpartition(merged, -keep, axis=1)[:, -keep:]
+                best_rows = np.take_along_axis(rows, order, axis=1)
+                best_scores = np.take_along_axis(merged, order, axis=1)
+
+        results = []
+        for rows, scores in zip(best_rows, best_scores):
+            order = np.argsort(-scores)
+            results.append([(int(rows[i]), float(scores[i])) for i in order if scores[i] != -np.inf])
+        return results
+
+    def text(self, row: int) -> Tuple[str, int]:
+        """The chunk text stored in ``row`` and its token count."""
+        _, _, rows, _ = self._view
+        offset, length, tokens = rows[row]
+        return os.pread(self._text_fd, int(length), int(offset)).decode(), int(tokens)
+
+    def close(self) -> None:
+        if self._text_fd is not None:
+            os.close(self._text_fd)
+            self._text_fd = None
+        self._view = (None, None, None, 0)
+
+
+class _FileLock:
+    """Exclusive ``flock`` on a file, for writers in different processes."""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def __enter__(self) -> "_FileLock":
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+
+
+class KnowledgeBase:
+    """Per-widget document indexes, searched in process before each LLM call.
+
+    Indexes are opened at startup, so a message only pays for embedding its
+    text and a matrix product - no network hop. Small indexes are searched
+    inline; larger ones in a thread, with queries that arrive while a
+    search runs batched into the next one.
+    """
+
+    def __init__(
+        self,
+        root: str = RAG_INDEX_DIR,
+        embedder: Optional[Embedder] = None,
+        enabled: bool = RAG_ENABLED,
+        top_k: int = RAG_TOP_K,
+        min_score: float = RAG_MIN_SCORE,
+        max_context_tokens: int = RAG_MAX_CONTEXT_TOKENS,
+        thread_min_rows: int = RAG_THREAD_MIN_ROWS,
+    ) -> None:
+        self.root = root
+        self.embedder = embedder or HashEmbedder()
+        self.enabled = enabled
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_context_tokens = max_context_tokens
+        self.thread_min_rows = thread_min_rows
+        self.indexes: Dict[str, VectorIndex] = {}
+        # Queries waiting for a thread search: (vector, k, future)
+        self._pending: Dict[VectorIndex, List[Tuple[np.ndarray, int, asyncio.Future]]] = {}
+        # The task draining each index's queue - held so it isn't collected mid-run
+        self._batch_tasks: Dict[VectorIndex, asyncio.Task] = {}
+        self.searches = 0
+        self.batches = 0
+
+    async def start(self) -> None:
+        """Open every widget's index."""
+        if self.enabled:
+            await asyncio.to_thread(self._open_all)
+
+    def _open_all(self) -> None:
+        root = pathlib.Path(self.root)
+        if not root.exists():
+            return
+        for manifest in root.glob("*/manifest.json"):
+            try:
+                with open(manifest) as f:
+                    widget_key = json.load(f)["widget_key"]
+                index = VectorIndex.open(self.root, widget_key, self.embedder.dim)
+                if index is not None:
+                    self.indexes[widget_key] = index
+            except Exception as e:
+                logger.error(f"Error opening knowledge index {manifest.parent}: {str(e)}")
+        logger.info(f"Opened knowledge indexes for {len(self.indexes)} widgets")
+
+    async def close(self) -> None:
+        tasks = list(self._batch_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for index in self.indexes.values():
+            index.close()
+        self.indexes.clear()
+
+    def _index(self, widget_key: str, create: bool = False) -> Optional[VectorIndex]:
+        index = self.indexes.get(widget_key)
+        if index is None:
+            index = VectorIndex.open(self.root, widget_key, self.embedder.dim, create=create)
+            if index is not None:
+                self.indexes[widget_key] = index
+        return index
+
+    async def add_document(self, widget_key: str, doc_id: str, text: str) -> int:
+        """Chunk, embed and index a document; returns the number of chunks."""
+
+        def add() -> int:
+            chunks = chunk_text(text)
+            vectors = self.embedder.embed(chunks)
+            tokens = [token_counter.count_message(chunk) for chunk in chunks]
+            return self._index(widget_key, create=True).add(doc_id, chunks, vectors, tokens)
+
+        return await asyncio.to_thread(add)
+
+    async def delete_document(self, widget_key: str, doc_id: str) -> int:
+        """Remove a document; returns the number of chunks removed."""
+        index = self.indexes.get(widget_key)
+        if index is None:
+            return 0
+        return await asyncio.to_thread(index.delete, doc_id)
+
+    async def reload(self, widget_key: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> None:
+        """Pick up documents another worker added or deleted."""
+        if widget_key is None:
+            return
+        if widget_key in self.indexes:
+            await asyncio.to_thread(self.indexes[widget_key].reload)
+        else:
+            await asyncio.to_thread(self._index, widget_key)
+
+    async def search(self, widget_key: str, query: str, k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """The chunks most similar to ``query`` that clear ``min_score``."""
+        index = self.indexes.get(widget_key)
+        if index is None or not index.size:
+            return []
+        k = k or self.top_k
+        vector = self.embedder.embed([query])[0]
+        self.searches += 1
+        if index.size < self.thread_min_rows:
+            hits = index.search(vector[None, :], k)[0]
+        else:
+            hits = await self._search_batched(index, vector, k)
+        results = []
+        for row, score in hits:
+            if score < self.min_score:
+                break
+            text, tokens = index.text(row)
+            results.append({"text": text, "score": round(score, 4), "tokens": tokens})
+        return results
+
+    async def _search_batched(self, index: VectorIndex, vector: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.get(index)
+        if pending is None:
+            pending = self._pending[index] = []
+            task = self._batch_tasks[index] = asyncio.create_task(self._run_batches(index))
+            task.add_done_callback(lambda task: self._batches_done(index, task))
+        pending.append((vector, k, future))
+        return await future
+
+    async def _run_batches(self, index: VectorIndex) -> None:
+        """Search everything queued for ``index``, one batch at a time."""
+        while self._pending.get(index):
+            batch = self._pending[index]
+            self._pending[index] = []
+            self.batches += 1
+            try:
+                queries = np.stack([vector for vector, _, _ in batch])
+                results = await asyncio.to_thread(index.search, queries, max(k for _, k, _ in batch))
+            except asyncio.CancelledError:
+                for _, _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, k, future), hits in zip(batch, results):
+                if not future.done():
+                    future.set_result(hits[:k])
+        self._pending.pop(index, None)
+
+    def _batches_done(self, index: VectorIndex, task: asyncio.Task) -> None:
+        if self._batch_tasks.get(index) is task:
+            self._batch_tasks.pop(index)
+        if not task.cancelled() and task.exception() is None:
+            return
+        if not task.cancelled():
+            logger.error(f"Knowledge search batches for {index.widget_key} failed: {str(task.exception())}")
+        if index in self._batch_tasks:
+            # A new task has taken over the queue
+            return
+        # Whatever was still queued would otherwise wait forever
+        for _, _, future in self._pending.pop(index, []):
+            if future.done():
+                continue
+            if task.cancelled():
+                future.cancel()
+            else:
+                future.set_exception(task.exception())
+
+    async def context(self, widget_key: str, query: str) -> Tuple[str, int]:
+        """Retrieved text to append to the system prompt, and its token count."""
+        if not self.enabled or widget_key not in self.indexes:
+            return "", 0
+        try:
+            hits = await self.search(widget_key, query)
+        except Exception as e:
+            logger.error(f"Error searching knowledge for widget {widget_key}: {str(e)}")
+            return "", 0
+        passages = []
+        tokens = 0
+        for hit in hits:
+            if tokens + hit["tokens"] > self.max_context_tokens:
+                break
+            passages.append(hit["text"])
+            tokens += hit["tokens"]
+        if not passages:
+            return "", 0
+        return CONTEXT_HEADER + "\n---\n".join(passages), tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "widgets": len(self.indexes),
+            "chunks": sum(index.chunks for index in self.indexes.values()),
+            "searches": self.searches,
+            "batches": self.batches,
+        }
+
+
+knowledge_base = KnowledgeBase()
@@ -1,4 +1,64 @@
+import argparse
+import logging
+import os
+
 import uvicorn
 
+logger = logging.getLogger(__name__)
+
+# Compress WebSocket frames for clients that support permessage-deflate
+WS_PER_MESSAGE_DEFLATE = os.environ.get("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the GlazingAI API")
+    parser.add_argument(
+        "--prod",
+        action="store_true",
+        default=os.environ.get("RUN_MODE", "development") == "production",
+        help="production mode: multiple workers, no auto-reload (or RUN_MODE=production)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        help="worker processes in production mode (default: WEB_CONCURRENCY or CPU count)",
+    )
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    return parser.parse_args()
+
+
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    args = parse_args()
+
+    if not args.prod:
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            reload=True,
+            ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE,
+        )
+    else:
+        if args.workers > 1 and os.environ.get(
+            "BUS_USE_REDIS", os.environ.get("USE_REDIS", "false")
+        ).lower() != "true":
+            logging.basicConfig(level=logging.INFO)
+            logger.warning(
+                "Running several workers without Redis - admin pushes and broadcasts "
+                "only reach sockets held by the worker that receives them"
+            )
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            # Absorb connection bursts (e.g. every widget reconnecting after a deploy)
+            backlog=int(os.environ.get("BACKLOG", "2048")),
+            ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE,
+            proxy_headers=True,
+            forwarded_allow_ips=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+            log_level=os.environ.get("LOG_LEVEL", "info").lower(),
+        )
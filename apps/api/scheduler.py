@@ -0,0 +1,350 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional
+
+from llm import get_llm_response
+
+logger = logging.getLogger(__name__)
+
+# Upstream admission configuration
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "32"))
+LLM_WIDGET_CONCURRENCY = int(os.environ.get("LLM_WIDGET_CONCURRENCY", "4"))
+# Tokens-per-minute budget per widget key (0 disables the budget)
+LLM_WIDGET_TPM = int(os.environ.get("LLM_WIDGET_TPM", "40000"))
+LLM_MAX_QUEUE_DEPTH = int(os.environ.get("LLM_MAX_QUEUE_DEPTH", "200"))
+LLM_WIDGET_QUEUE_DEPTH = int(os.environ.get("LLM_WIDGET_QUEUE_DEPTH", "20"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "30"))
+# Widget keys tracked per worker; beyond this the least recently used idle
+# ones are dropped
+LLM_MAX_TENANTS = int(os.environ.get("LLM_MAX_TENANTS", "10000"))
+# Expected completion size used to estimate a request's token cost
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("LLM_EXPECTED_OUTPUT_TOKENS", "256"))
+# Fair-share weights, e.g. "big-customer:4,trial-widget:0.5" (default 1)
+LLM_WIDGET_WEIGHTS = {
+    key.strip(): float(weight)
+    for key, _, weight in (
+        item.partition(":") for item in os.environ.get("LLM_WIDGET_WEIGHTS", "").split(",")
+    )
+    if key.strip() and weight
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token)."""
+    return max(len(text) // 4, 1)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed instead of queued."""
+
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(f"LLM request rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("future", "cost", "finish_tag", "enqueued_at")
+
+    def __init__(self, future: "asyncio.Future[None]", cost: int, finish_tag: float) -> None:
+        self.future = future
+        self.cost = cost
+        self.finish_tag = finish_tag
+        self.enqueued_at = time.monotonic()
+
+
+class _Tenant:
+    """Per-widget-key scheduling state."""
+
+    def __init__(self, weight: float, tpm: int) -> None:
+        self.weight = weight
+        self.tpm = tpm
+        self.budget = float(tpm)
+        self.budget_updated = time.monotonic()
+        self.running = 0
+        self.queue: Deque[_Waiter] = deque()
+        self.last_finish_tag = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def refill(self, now: float) -> None:
+        if self.tpm:
+            elapsed = now - self.budget_updated
+            self.budget = min(self.tpm, self.budget + elapsed * self.tpm / 60)
+        self.budget_updated = now
+
+    def seconds_until_budget(self, cost: int) -> float:
+        if not self.tpm or self.budget >= cost:
+            return 0.0
+        # A request bigger than the whole budget only waits for a full bucket
+        needed = min(cost, self.tpm) - self.budget
+        return needed * 60 / self.tpm
+
+
+class Ticket:
+    """An admitted upstream request; release it with the tokens actually used."""
+
+    def __init__(self, scheduler: "AdmissionScheduler", widget_key: str, cost: int) -> None:
+        self.scheduler = scheduler
+        self.widget_key = widget_key
+        self.cost = cost
+        self.released = False
+
+    def release(self, tokens_used: Optional[int] = None) -> None:
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self, self.cost if tokens_used is None else tokens_used)
+
+
+class AdmissionScheduler:
+    """Weighted fair queuing of upstream LLM calls across widget keys.
+
+    Enforces a global concurrency cap plus per-widget-key concurrency and
+    tokens-per-minute budgets. Waiting requests are ordered by virtual finish
+    time (cost / weight) so a busy tenant cannot starve the others, and
+    requests are shed with ``AdmissionRejected`` when queues are too deep.
+
+    Widget keys come from the URL, so the state kept per key is capped at
+    ``max_tenants``: beyond it the least recently used key with nothing
+    running or queued is dropped. Its budget has usually refilled anyway.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        widget_concurrency: int = LLM_WIDGET_CONCURRENCY,
+        widget_tpm: int = LLM_WIDGET_TPM,
+        max_queue_depth: int = LLM_MAX_QUEUE_DEPTH,
+        widget_queue_depth: int = LLM_WIDGET_QUEUE_DEPTH,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+        weights: Optional[Dict[str, float]] = None,
+        max_tenants: int = LLM_MAX_TENANTS,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.widget_concurrency = widget_concurrency
+        self.widget_tpm = widget_tpm
+        self.max_queue_depth = max_queue_depth
+        self.widget_queue_depth = widget_queue_depth
+        self.queue_timeout = queue_timeout
+        self.weights = dict(LLM_WIDGET_WEIGHTS if weights is None else weights)
+        self.max_tenants = max_tenants
+        # Least recently used first
+        self._tenants: "OrderedDict[str, _Tenant]" = OrderedDict()
+        self.evicted = 0
+        self._running = 0
+        self._queued = 0
+        self._virtual_time = 0.0
+        self._refill_timer: Optional[asyncio.TimerHandle] = None
+
+    def _tenant(self, widget_key: str) -> _Tenant:
+        tenant = self._tenants.get(widget_key)
+        if tenant is None:
+            if len(self._tenants) >= self.max_tenants:
+                self._evict()
+            tenant = _Tenant(self.weights.get(widget_key, 1.0), self.widget_tpm)
+            self._tenants[widget_key] = tenant
+        else:
+            self._tenants.move_to_end(widget_key)
+        return tenant
+
+    def _evict(self) -> None:
+        """Drop the least recently used tenant with nothing running or queued."""
+        for key, tenant in self._tenants.items():
+            if not tenant.running and not tenant.queue:
+                del self._tenants[key]
+                self.evicted += 1
+                return
+
+    def _can_run(self, tenant: _Tenant, cost: int) -> bool:
+        return (
+            self._running < self.max_concurrency
+            and tenant.running < self.widget_concurrency
+            and tenant.seconds_until_budget(cost) == 0
+        )
+
+    def _start(self, widget_key: str, tenant: _Tenant, cost: int, waited: float) -> Ticket:
+        self._running += 1
+        tenant.running += 1
+        if tenant.tpm:
+            tenant.budget -= cost
+        tenant.admitted += 1
+        tenant.wait_total += waited
+        tenant.wait_max = max(tenant.wait_max, waited)
+        return Ticket(self, widget_key, cost)
+
+    async def acquire(self, widget_key: str, cost: int) -> Ticket:
+        """Wait for an upstream slot, raising ``AdmissionRejected`` if shed."""
+        tenant = self._tenant(widget_key)
+        tenant.refill(time.monotonic())
+
+        # Fast path - nothing queued ahead of us and capacity available
+        if not tenant.queue and self._queued == 0 and self._can_run(tenant, cost):
+            return self._start(widget_key, tenant, cost, 0.0)
+
+        if self._queued >= self.max_queue_depth or len(tenant.queue) >= self.widget_queue_depth:
+            tenant.rejected += 1
+            raise AdmissionRejected("queue_full", self._retry_after(tenant, cost))
+
+        start_tag = max(self._virtual_time, tenant.last_finish_tag)
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), cost, start_tag + cost / tenant.weight)
+        tenant.last_finish_tag = waiter.finish_tag
+        tenant.queue.append(waiter)
+        self._queued += 1
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as we gave up - hand the slot back
+                self._release_slot(widget_key, cost, cost)
+            else:
+                waiter.future.cancel()
+                self._remove_waiter(tenant, waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            tenant.rejected += 1
+            raise AdmissionRejected("queue_timeout", self._retry_after(tenant, cost))
+
+        return Ticket(self, widget_key, cost)
+
+    @asynccontextmanager
+    async def admit(self, widget_key: str, cost: int) -> AsyncIterator[Ticket]:
+        """Context manager around ``acquire``/``release``."""
+        ticket = await self.acquire(widget_key, cost)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def _remove_waiter(self, tenant: _Tenant, waiter: _Waiter) -> None:
+        try:
+            tenant.queue.remove(waiter)
+            self._queued -= 1
+        except ValueError:
+            pass
+
+    def _release(self, ticket: Ticket, tokens_used: int) -> None:
+        self._release_slot(ticket.widget_key, ticket.cost, tokens_used)
+
+    def _release_slot(self, widget_key: str, cost: int, tokens_used: int) -> None:
+        tenant = self._tenant(widget_key)
+        self._running -= 1
+        tenant.running -= 1
+        if tenant.tpm:
+            # Settle the estimate against what was actually used
+            tenant.budget -= tokens_used - cost
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Admit queued requests in virtual-finish-time order."""
+        now = time.monotonic()
+        next_refill = None
+        while self._queued and self._running < self.max_concurrency:
+            best: Optional[_Tenant] = None
+            best_key = ""
+            for key, tenant in self._tenants.items():
+                if not tenant.queue or tenant.running >= self.widget_concurrency:
+                    continue
+                tenant.refill(now)
+                head = tenant.queue[0]
+                wait = tenant.seconds_until_budget(head.cost)
+                if wait:
+                    next_refill = wait if next_refill is None else min(next_refill, wait)
+                    continue
+                if best is None or head.finish_tag < best.queue[0].finish_tag:
+                    best, best_key = tenant, key
+            if best is None:
+                break
+
+            waiter = best.queue.popleft()
+            self._queued -= 1
+            if waiter.future.done():
+                continue
+            self._virtual_time = max(self._virtual_time, waiter.finish_tag - waiter.cost / best.weight)
+            self._start(best_key, best, waiter.cost, now - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+        # Re-run dispatch once a budget-blocked tenant can afford its request
+        if next_refill is not None and self._refill_timer is None:
+            def on_refill() -> None:
+                self._refill_timer = None
+                self._dispatch()
+
+            self._refill_timer = asyncio.get_running_loop().call_later(next_refill, on_refill)
+
+    def _retry_after(self, tenant: _Tenant, cost: int) -> float:
+        wait = tenant.seconds_until_budget(cost)
+        if not wait:
+            # Rough guess - average wait this tenant has seen so far
+            wait = tenant.wait_total / tenant.admitted if tenant.admitted else 1.0
+        return round(max(wait, 1.0), 1)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return global and per-widget-key queue depth and wait times."""
+        return {
+            "running": self._running,
+            "queued": self._queued,
+            "max_concurrency": self.max_concurrency,
+            "evicted_widgets": self.evicted,
+            "widgets": {
+                key: {
+                    "running": tenant.running,
+                    "queued": len(tenant.queue),
+                    "admitted": tenant.admitted,
+                    "rejected": tenant.rejected,
+                    "wait_ms_avg": round(tenant.wait_total / tenant.admitted * 1000, 1) if tenant.admitted else 0,
+                    "wait_ms_max": round(tenant.wait_max * 1000, 1),
+                    "tpm_budget_remaining": round(tenant.budget) if tenant.tpm else None,
+                }
+                for key, tenant in self._tenants.items()
+            },
+        }
+
+
+scheduler = AdmissionScheduler()
+
+
+async def get_admitted_llm_response(
+    prompt: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    streaming_callback: Optional[Callable[[str], Any]] = None,
+    widget_key: str = "default",
+    messages: Optional[List[Dict[str, str]]] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    system_prompt_tokens: Optional[int] = None,
+) -> AsyncIterator[str]:
+    """Run ``get_llm_response`` once the scheduler admits the widget's request.
+
+    ``system_prompt_tokens`` is the prompt's token count if the caller
+    already knows it, e.g. precomputed with the tenant's configuration.
+    """
+    if system_prompt_tokens is None:
+        system_prompt_tokens = estimate_tokens(system_prompt or "")
+    input_text = "".join(m["content"] for m in messages) if messages else (prompt or "")
+    cost = system_prompt_tokens + estimate_tokens(input_text) + LLM_EXPECTED_OUTPUT_TOKENS
+    ticket = await scheduler.acquire(widget_key, cost)
+    output_chars = 0
+    try:
+        async with aclosing(get_llm_response(
+            prompt=prompt,
+            system_prompt=system_prompt,
+            streaming_callback=streaming_callback,
+            messages=messages,
+            meta=meta,
+            model=model,
+            temperature=temperature,
+        )) as stream:
+            async for token in stream:
+                output_chars += len(token)
+                yield token
+    finally:
+        ticket.release(cost - LLM_EXPECTED_OUTPUT_TOKENS + output_chars // 4)
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Session lifetimes in seconds
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "86400"))
+SESSION_CLOSED_TTL = int(os.environ.get("SESSION_CLOSED_TTL", "300"))
+# How often batched Redis writes are flushed and how many ops per pipeline
+SESSION_FLUSH_INTERVAL_MS = float(os.environ.get("SESSION_FLUSH_INTERVAL_MS", "50"))
+SESSION_FLUSH_BATCH = int(os.environ.get("SESSION_FLUSH_BATCH", "500"))
+
+
+class SessionStore(ABC):
+    """Interface for session persistence used by the WebSocket endpoint.
+
+    Writes (``create``, ``touch``, ``expire``) never block on the backing
+    store; implementations may buffer them and apply them later.
+    """
+
+    backend = "none"
+
+    async def start(self) -> None:
+        """Start any background work."""
+
+    async def close(self) -> None:
+        """Flush pending writes and release resources."""
+
+    @abstractmethod
+    async def create(self, session_id: str, data: Dict[str, Any]) -> None:
+        """Record a new session with the full session TTL."""
+
+    @abstractmethod
+    async def touch(self, session_id: str) -> None:
+        """Refresh the TTL of an active session."""
+
+    @abstractmethod
+    async def expire(self, session_id: str, ttl: int = SESSION_CLOSED_TTL) -> None:
+        """Shorten the TTL of a session that has disconnected."""
+
+    @abstractmethod
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return stored session data, or None if unknown or expired."""
+
+    async def ping(self) -> str:
+        """Return a health status string for /healthz."""
+        return "disabled"
+
+
+class InMemorySessionStore(SessionStore):
+    """Process-local session store used when Redis is disabled."""
+
+    backend = "memory"
+
+    def __init__(self, ttl: int = SESSION_TTL) -> None:
+        self.ttl = ttl
+        self._sessions: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._writes = 0
+
+    async def create(self, session_id: str, data: Dict[str, Any]) -> None:
+        self._sessions[session_id] = (time.monotonic() + self.ttl, data)
+        self._purge_expired()
+
+    async def touch(self, session_id: str) -> None:
+        entry = self._sessions.get(session_id)
+        if entry:
+            self._sessions[session_id] = (time.monotonic() + self.ttl, entry[1])
+
+    async def expire(self, session_id: str, ttl: int = SESSION_CLOSED_TTL) -> None:
+        entry = self._sessions.get(session_id)
+        if entry:
+            self._sessions[session_id] = (time.monotonic() + ttl, entry[1])
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._sessions[session_id]
+            return None
+        return entry[1]
+
+    def _purge_expired(self) -> None:
+        # Amortize cleanup over writes instead of running a timer
+        self._writes += 1
+        if self._writes % 1000:
+            return
+        now = time.monotonic()
+        expired = [key for key, (expires, _) in self._sessions.items() if expires <= now]
+        for key in expired:
+            del self._sessions[key]
+
+
+class RedisSessionStore(SessionStore):
+    """Session store on an asyncio Redis client with pipelined writes.
+
+    Writes are queued per session (a later write replaces an earlier pending
+    one, so touches coalesce) and flushed by a background task in pipelines,
+    so a slow Redis never stalls the event loop or other sessions.
+    """
+
+    backend = "redis"
+
+    def __init__(
+        self,
+        client: Any,
+        ttl: int = SESSION_TTL,
+        flush_interval_ms: float = SESSION_FLUSH_INTERVAL_MS,
+        batch_size: int = SESSION_FLUSH_BATCH,
+        key_prefix: str = "session:",
+    ) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.key_prefix = key_prefix
+        self._pending: Dict[str, Tuple[str, Any]] = {}
+        self._wakeup = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self.writes_flushed = 0
+        self.flush_errors = 0
+
+    async def start(self) -> None:
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    async def create(self, session_id: str, data: Dict[str, Any]) -> None:
+        self._queue(session_id, "setex", json.dumps(data))
+
+    async def touch(self, session_id: str) -> None:
+        # Don't let a touch overwrite a pending create for the same session
+        pending = self._pending.get(session_id)
+        if pending and pending[0] == "setex":
+            return
+        if pending and pending[0] == "setex_short":
+            # Back before its short-TTL write went out - write it with the full TTL
+            self._queue(session_id, "setex", pending[1][0])
+            return
+        self._queue(session_id, "expire", self.ttl)
+
+    async def expire(self, session_id: str, ttl: int = SESSION_CLOSED_TTL) -> None:
+        pending = self._pending.pop(session_id, None)
+        if pending and pending[0] == "setex":
+            # Session never reached Redis - write it with the short TTL directly
+            self._queue(session_id, "setex_short", (pending[1], ttl))
+        else:
+            self._queue(session_id, "expire", ttl)
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        pending = self._pending.get(session_id)
+        if pending and pending[0] in ("setex", "setex_short"):
+            value = pending[1] if pending[0] == "setex" else pending[1][0]
+            return json.loads(value)
+        value = await self.client.get(f"{self.key_prefix}{session_id}")
+        return json.loads(value) if value else None
+
+    async def ping(self) -> str:
+        try:
+            await asyncio.wait_for(self.client.ping(), timeout=2)
+            return "healthy"
+        except Exception as e:
+            return f"unhealthy: {str(e)}"
+
+    def _queue(self, session_id: str, op: str, arg: Any) -> None:
+        self._pending[session_id] = (op, arg)
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Write all pending operations to Redis in pipelined batches."""
+        while self._pending:
+            batch = dict(list(self._pending.items())[: self.batch_size])
+            for session_id in batch:
+                del self._pending[session_id]
+
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for session_id, (op, arg) in batch.items():
+                    key = f"{self.key_prefix}{session_id}"
+                    if op == "setex":
+                        pipe.setex(key, self.ttl, arg)
+                    elif op == "setex_short":
+                        pipe.setex(key, arg[1], arg[0])
+                    else:
+                        pipe.expire(key, arg)
+                await pipe.execute()
+                self.writes_flushed += len(batch)
+            except Exception as e:
+                # Sessions are soft state - log and drop rather than block
+                self.flush_errors += 1
+                logger.error(f"Error flushing {len(batch)} session writes to Redis: {str(e)}")
+
+
+async def create_session_store(use_redis: bool) -> SessionStore:
+    """Build the configured session store, falling back to memory if Redis is down."""
+    if use_redis:
+        try:
+            from redis_pool import get_redis
+
+            client = get_redis()
+            await asyncio.wait_for(client.ping(), timeout=2)
+            store: SessionStore = RedisSessionStore(client)
+            await store.start()
+            logger.info("Connected to Redis successfully")
+            return store
+        except Exception as e:
+            logger.error(f"Failed to connect to Redis: {str(e)}")
+    else:
+        logger.info("Redis is disabled for local development")
+    return InMemorySessionStore()
@@ -0,0 +1,97 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Coalescing configuration - a flush interval of 0 disables coalescing and
+# sends every token in its own frame (the original behaviour)
+TOKEN_FLUSH_INTERVAL_MS = float(os.environ.get("TOKEN_FLUSH_INTERVAL_MS", "40"))
+TOKEN_FLUSH_BYTES = int(os.environ.get("TOKEN_FLUSH_BYTES", "512"))
+
+
+class TokenCoalescer:
+    """Buffer streamed tokens and send them as batched frames.
+
+    Buffered tokens are flushed when the oldest buffered token is older than
+    ``flush_interval_ms``, when the buffer reaches ``flush_bytes`` or when
+    the stream ends (``aclose``).
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, int], Awaitable[Any]],
+        flush_interval_ms: float = TOKEN_FLUSH_INTERVAL_MS,
+        flush_bytes: int = TOKEN_FLUSH_BYTES,
+    ) -> None:
+        """Initialize with a coroutine that sends ``(text, token_count)``."""
+        self._send = send
+        self._interval = max(flush_interval_ms, 0) / 1000
+        self._max_bytes = max(flush_bytes, 1)
+        self._buffer: List[str] = []
+        self._buffered_bytes = 0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+        self.frames_sent = 0
+        self.tokens_sent = 0
+
+    async def add(self, token: str) -> None:
+        """Add a token, flushing immediately if a threshold is reached."""
+        self._raise_pending_error()
+        if not token:
+            return
+
+        self._buffer.append(token)
+        self._buffered_bytes += len(token.encode("utf-8"))
+
+        if self._interval == 0 or self._buffered_bytes >= self._max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """Send everything currently buffered as a single frame."""
+        self._cancel_timer()
+        async with self._lock:
+            if not self._buffer:
+                return
+            tokens = self._buffer
+            self._buffer = []
+            self._buffered_bytes = 0
+            await self._send("".join(tokens), len(tokens))
+            self.frames_sent += 1
+            self.tokens_sent += len(tokens)
+
+    async def aclose(self) -> None:
+        """Flush remaining tokens at end of stream."""
+        self._raise_pending_error()
+        await self.flush()
+
+    def cancel(self) -> None:
+        """Stop a pending timed flush, e.g. once the stream is gone."""
+        self._cancel_timer()
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self._interval)
+            self._timer = None
+            await self.flush()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Surface send failures to the producer on its next call
+            logger.error(f"Error flushing coalesced tokens: {str(e)}")
+            self._error = e
+
+    def _cancel_timer(self) -> None:
+        timer = self._timer
+        self._timer = None
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+
+    def _raise_pending_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
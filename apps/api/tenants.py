@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import pathlib
+import sqlite3
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from history import token_counter
+
+logger = logging.getLogger(__name__)
+
+PROMPTS_DIR = pathlib.Path(__file__).parent / "prompts"
+SYSTEM_PROMPT_PATH = PROMPTS_DIR / "system.txt"
+
+# Tenant configuration store: file, sqlite, postgres or none
+TENANT_STORE = os.environ.get("TENANT_STORE", "file").lower()
+TENANT_CONFIG_FILE = os.environ.get("TENANT_CONFIG_FILE") or str(PROMPTS_DIR / "tenants.json")
+TENANT_SQLITE_PATH = os.environ.get("TENANT_SQLITE_PATH", "tenants.db")
+TENANT_DATABASE_URL = os.environ.get("TENANT_DATABASE_URL") or "postgresql://{}:{}@{}:{}/{}".format(
+    os.environ.get("POSTGRES_USER", "postgres"),
+    os.environ.get("POSTGRES_PASSWORD", "postgres"),
+    os.environ.get("POSTGRES_HOST", "localhost"),
+    os.environ.get("POSTGRES_PORT", "5432"),
+    os.environ.get("POSTGRES_DB", "glazingai"),
+)
+# Seconds between full reloads; pushed invalidations apply immediately
+TENANT_CACHE_TTL = float(os.environ.get("TENANT_CACHE_TTL", "300"))
+
+# Postgres NOTIFY channel carrying the widget key of a changed row
+TENANT_NOTIFY_CHANNEL = "tenant_config"
+
+# Called with a widget key, or None for every tenant
+InvalidateHandler = Callable[[Optional[str]], Awaitable[None]]
+
+
+def load_system_prompt(path: pathlib.Path = SYSTEM_PROMPT_PATH) -> str:
+    """Read the default system prompt, or return "" if it can't be read."""
+    try:
+        if path.exists():
+            with open(path, "r") as f:
+                prompt = f.read().strip()
+            logger.info(f"Loaded system prompt: {len(prompt)} chars")
+            return prompt
+        logger.warning(f"System prompt file not found at {path}")
+    except Exception as e:
+        logger.error(f"Error loading system prompt: {str(e)}")
+    return ""
+
+
+class TenantConfig:
+    """A widget key's prompt and model settings, with the prompt pre-counted."""
+
+    __slots__ = ("widget_key", "system_prompt", "model", "temperature", "prompt_tokens")
+
+    def __init__(self, widget_key: str, system_prompt: str, model: str, temperature: float) -> None:
+        self.widget_key = widget_key
+        self.system_prompt = system_prompt
+        self.model = model
+        self.temperature = temperature
+        # Counted once here rather than for every message
+        self.prompt_tokens = token_counter.count_message(system_prompt) if system_prompt else 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "widget_key": self.widget_key,
+            "model": self.model,
+            "temperature": self.temperature,
+            "prompt_tokens": self.prompt_tokens,
+        }
+
+
+class TenantStore:
+    """Interface for where per-widget configuration is kept.
+
+    Rows are dicts with optional ``system_prompt``, ``model`` and
+    ``temperature``; missing values fall back to the defaults.
+    """
+
+    backend = "none"
+
+    async def start(self) -> None:
+        """Open connections and create the schema if needed."""
+
+    async def close(self) -> None:
+        """Release resources."""
+
+    async def load_all(self) -> Dict[str, Dict[str, Any]]:
+        """Return every tenant's row by widget key."""
+        return {}
+
+    async def load(self, widget_key: str) -> Optional[Dict[str, Any]]:
+        """Return one tenant's row, or None if it has none."""
+        return None
+
+    async def watch(self, handler: InvalidateHandler) -> None:
+        """Call ``handler`` when the store reports a change, if it can."""
+
+
+class FileTenantStore(TenantStore):
+    """Tenants in a JSON file: ``{"widget-key": {"system_prompt": ..., "model": ...}}``.
+
+    Edits are picked up at the next reload or an admin invalidation.
+    """
+
+    backend = "file"
+
+    def __init__(self, path: str = TENANT_CONFIG_FILE) -> None:
+        self.path = pathlib.Path(path)
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        if not self.path.exists():
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    async def load_all(self) -> Dict[str, Dict[str, Any]]:
+        return await asyncio.to_thread(self._read)
+
+    async def load(self, widget_key: str) -> Optional[Dict[str, Any]]:
+        return (await self.load_all()).get(widget_key)
+
+
+class SqliteTenantStore(TenantStore):
+    """Tenants in a SQLite table, for tests and single-host installs."""
+
+    backend = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tenant_configs (
+            widget_key TEXT PRIMARY KEY,
+            system_prompt TEXT,
+            model TEXT,
+            temperature REAL,
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """
+
+    def __init__(self, path: str = TENANT_SQLITE_PATH) -> None:
+        self.path = path
+
+    def _query(self, sql: str, *args: Any) -> Dict[str, Dict[str, Any]]:
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute(sql, args).fetchall()
+            connection.commit()
+            return {row["widget_key"]: dict(row) for row in rows}
+        finally:
+            connection.close()
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self._query, self.SCHEMA)
+
+    async def load_all(self) -> Dict[str, Dict[str, Any]]:
+        return await asyncio.to_thread(self._query, "SELECT * FROM tenant_configs")
+
+    async def load(self, widget_key: str) -> Optional[Dict[str, Any]]:
+        rows = await asyncio.to_thread(
+            self._query, "SELECT * FROM tenant_configs WHERE widget_key = ?", widget_key
+        )
+        return rows.get(widget_key)
+
+
+class PostgresTenantStore(TenantStore):
+    """Tenants in the Postgres database from docker-compose.
+
+    A trigger NOTIFYs every change, so each worker listening on the channel
+    reloads the changed tenant without waiting for the TTL.
+    """
+
+    backend = "postgres"
+
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS tenant_configs (
+            widget_key TEXT PRIMARY KEY,
+            system_prompt TEXT,
+            model TEXT,
+            temperature DOUBLE PRECISION,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE OR REPLACE FUNCTION notify_tenant_config() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{TENANT_NOTIFY_CHANNEL}', COALESCE(NEW.widget_key, OLD.widget_key));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE OR REPLACE TRIGGER tenant_configs_notify
+            AFTER INSERT OR UPDATE OR DELETE ON tenant_configs
+            FOR EACH ROW EXECUTE FUNCTION notify_tenant_config();
+    """
+
+    def __init__(self, dsn: str = TENANT_DATABASE_URL) -> None:
+        self.dsn = dsn
+        self.pool: Any = None
+        self._listener: Any = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=2)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                # Workers start together; only one replaces the trigger at a time
+                await connection.execute("SELECT pg_advisory_xact_lock(hashtext('tenant_configs'))")
+                await connection.execute(self.SCHEMA)
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def load_all(self) -> Dict[str, Dict[str, Any]]:
+        rows = await self.pool.fetch("SELECT * FROM tenant_configs")
+        return {row["widget_key"]: dict(row) for row in rows}
+
+    async def load(self, widget_key: str) -> Optional[Dict[str, Any]]:
+        row = await self.pool.fetchrow("SELECT * FROM tenant_configs WHERE widget_key = $1", widget_key)
+        return dict(row) if row is not None else None
+
+    async def watch(self, handler: InvalidateHandler) -> None:
+        import asyncpg
+
+        def on_notify(connection: Any, pid: int, channel: str, payload: str) -> None:
+            task = asyncio.create_task(handler(payload or None))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        # LISTEN needs a connection of its own, outside the pool. Changes
+        # missed while it is down are picked up by the periodic reload.
+        self._listener = await asyncpg.connect(self.dsn)
+        await self._listener.add_listener(TENANT_NOTIFY_CHANNEL, on_notify)
+
+
+async def create_tenant_store(backend: str = TENANT_STORE) -> TenantStore:
+    """Build and start the configured tenant store; without one every widget gets the defaults."""
+    if backend == "file":
+        store: TenantStore = FileTenantStore()
+    elif backend == "sqlite":
+        store = SqliteTenantStore()
+    elif backend == "postgres":
+        store = PostgresTenantStore()
+    else:
+        return TenantStore()
+    try:
+        await store.start()
+        return store
+    except Exception as e:
+        logger.error(f"Failed to open {backend} tenant store, using defaults: {str(e)}")
+        return TenantStore()
+
+
+class TenantConfigCache:
+    """Every tenant's configuration, held in process.
+
+    ``get`` is a dict lookup and never waits on the store, so the message
+    path does no I/O for configuration. The whole set is reloaded in the
+    background every ``ttl`` seconds; ``invalidate`` reloads one tenant (or
+    all) straight away and is called by store notifications and the admin
+    endpoint. If the store is unreachable the last good configuration keeps
+    being served.
+    """
+
+    def __init__(self, ttl: float = TENANT_CACHE_TTL) -> None:
+        self.ttl = ttl
+        self.store: TenantStore = TenantStore()
+        self.default = TenantConfig("default", "", "gpt-3.5-turbo", 0.7)
+        self._configs: Dict[str, TenantConfig] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.loaded_at: Optional[float] = None
+        self.reloads = 0
+        self.invalidations = 0
+        self.errors = 0
+
+    async def start(self, store: Optional[TenantStore] = None) -> None:
+        """Load the defaults and every tenant, then keep them fresh."""
+        self.store = store or await create_tenant_store()
+        self.default = TenantConfig(
+            "default",
+            await asyncio.to_thread(load_system_prompt),
+            os.environ.get("MODEL_NAME", "gpt-3.5-turbo"),
+            float(os.environ.get("TEMPERATURE", "0.7")),
+        )
+        await self.reload()
+        try:
+            await self.store.watch(self.invalidate)
+        except Exception as e:
+            logger.error(f"Failed to watch tenant store for changes: {str(e)}")
+        if self._task is None and self.ttl > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.store.close()
+
+    def get(self, widget_key: Optional[str]) -> TenantConfig:
+        """Return the widget's configuration, or the defaults if it has none."""
+        return self._configs.get(widget_key, self.default) if widget_key else self.default
+
+    def _build(self, widget_key: str, row: Dict[str, Any]) -> TenantConfig:
+        temperature = row.get("temperature")
+        return TenantConfig(
+            widget_key,
+            row.get("system_prompt") or self.default.system_prompt,
+            row.get("model") or self.default.model,
+            float(temperature) if temperature is not None else self.default.temperature,
+        )
+
+    def _build_all(self, rows: Dict[str, Dict[str, Any]]) -> Dict[str, TenantConfig]:
+        return {key: self._build(key, row) for key, row in rows.items()}
+
+    async def reload(self) -> None:
+        """Replace every tenant's configuration from the store."""
+        try:
+            rows = await self.store.load_all()
+            # Counting prompt tokens for many tenants is CPU work - keep it
+            # off the event loop
+            self._configs = await asyncio.to_thread(self._build_all, rows)
+            self.loaded_at = time.time()
+            self.reloads += 1
+            logger.debug("Loaded configuration for %d tenants", len(self._configs))
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error loading tenant configuration: {str(e)}")
+
+    async def invalidate(self, widget_key: Optional[str] = None, data: Optional[Dict[str, Any]] = None) -> None:
+        """Reload one tenant's configuration, or every tenant's."""
+        self.invalidations += 1
+        if widget_key is None:
+            await self.reload()
+            return
+        try:
+            row = await self.store.load(widget_key)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error loading configuration for widget {widget_key}: {str(e)}")
+            return
+        if row is None:
+            self._configs.pop(widget_key, None)
+        else:
+            # Counts the prompt's tokens - off the event loop, as in reload()
+            self._configs[widget_key] = await asyncio.to_thread(self._build, widget_key, row)
+        logger.info(f"Reloaded configuration for widget {widget_key}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl)
+            await self.reload()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.store.backend,
+            "tenants": len(self._configs),
+            "default": self.default.to_dict(),
+            "age_seconds": round(time.time() - self.loaded_at, 1) if self.loaded_at else None,
+            "ttl": self.ttl,
+            "reloads": self.reloads,
+            "invalidations": self.invalidations,
+            "errors": self.errors,
+        }
+
+
+tenant_configs = TenantConfigCache()
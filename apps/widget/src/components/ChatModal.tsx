@@ -19,7 +19,7 @@ const ChatModal: React.FC<ChatModalProps> = ({ isOpen, onClose, widgetKey }) =>
   }>>([]);
 
   // Always call hooks unconditionally
-  const { messages, sendMessage, isConnected, isThinking, reconnect, reconnectAttempt } = useWebSocket(widgetKey || 'demo-widget-key', isOpen);
+  const { messages, sendMessage, cancelGeneration, isConnected, isThinking, reconnect, reconnectAttempt } = useWebSocket(widgetKey || 'demo-widget-key', isOpen);
 
   // Sync messages from WebSocket to local state
   useEffect(() => {
@@ -147,17 +147,27 @@ const ChatModal: React.FC<ChatModalProps> = ({ isOpen, onClose, widgetKey }) =>
               className="flex-1 border border-gray-300 rounded-l-lg p-2 focus:outline-none focus:ring-2 focus:ring-blue-500"
               disabled={!isConnected || isThinking}
             />
-            <button
-              onClick={handleSendMessage}
-              disabled={!isConnected || !inputMessage.trim() || isThinking}
-              className={`px-4 py-2 rounded-r-lg ${
-                isConnected && inputMessage.trim() && !isThinking
-                  ? 'bg-blue-600 hover:bg-blue-700 text-white'
-                  : 'bg-gray-400 text-gray-200 cursor-not-allowed'
-              }`}
-            >
-              {isThinking ? 'Thinking...' : 'Send'}
-            </button>
+            {isThinking ? (
+              <button
+                onClick={cancelGeneration}
+                disabled={!isConnected}
+                className="px-4 py-2 rounded-r-lg bg-red-500 hover:bg-red-600 text-white"
+              >
+                Stop
+              </button>
+            ) : (
+              <button
+                onClick={handleSendMessage}
+                disabled={!isConnected || !inputMessage.trim()}
+                className={`px-4 py-2 rounded-r-lg ${
+                  isConnected && inputMessage.trim()
+                    ? 'bg-blue-600 hover:bg-blue-700 text-white'
+                    : 'bg-gray-400 text-gray-200 cursor-not-allowed'
+                }`}
+              >
+                Send
+              </button>
+            )}
           </div>
           <div className="text-xs text-gray-500 mt-1">
             {isThinking && 'AI is thinking...'}
@@ -1,4 +1,5 @@
 import { useState, useEffect, useCallback, useRef } from 'react';
+import { PROTOCOL_V2, ServerFrame, decodeFrame, verifyCompletion } from '../utils/protocol';
 
 export interface Message {
   id: string;
@@ -8,14 +9,6 @@ export interface Message {
   isStreaming?: boolean;
 }
 
-interface WebSocketResponse {
-  type: string;
-  message?: string;
-  token?: string;
-  session_id: string;
-  timestamp?: string;
-}
-
 // Helper to determine WebSocket URL
 const getWebSocketUrl = (widgetKey: string): string => {
   const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
@@ -40,6 +33,11 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
   const reconnectDelay = 1000;
   const reconnectTimeoutRef = useRef<NodeJS.Timeout | null>(null);
   const streamingMessageIdRef = useRef<string | null>(null);
+  // Session to resume on reconnect and the last stream frame we saw from it
+  const sessionIdRef = useRef<string | null>(null);
+  const lastSeqRef = useRef<number>(0);
+  // When the server's rate limit lets us connect or send again (ms epoch)
+  const retryAtRef = useRef<number>(0);
 
   // Create WebSocket connection
   const connectWebSocket = useCallback(() => {
@@ -70,10 +68,16 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
 
       // Create new connection
       const safeWidgetKey = widgetKey || 'demo-widget-key';
-      const wsUrl = getWebSocketUrl(safeWidgetKey);
+      let wsUrl = getWebSocketUrl(safeWidgetKey);
+      if (sessionIdRef.current) {
+        // Ask the server to replay what we missed instead of starting over
+        wsUrl += `?session_id=${encodeURIComponent(sessionIdRef.current)}&last_seq=${lastSeqRef.current}`;
+      }
       console.log(`Creating WebSocket connection to: ${wsUrl}`);
 
-      const ws = new WebSocket(wsUrl);
+      // Offer the compact binary protocol; servers without it answer in JSON
+      const ws = new WebSocket(wsUrl, [PROTOCOL_V2]);
+      ws.binaryType = 'arraybuffer';
 
       // Set up event handlers
       ws.onopen = () => {
@@ -91,9 +95,18 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
 
         console.log('Message received:', event.data);
         try {
-          const data = JSON.parse(event.data) as WebSocketResponse;
+          const data: ServerFrame = event.data instanceof ArrayBuffer
+            ? decodeFrame(event.data)
+            : JSON.parse(event.data);
+
+          if (typeof data.seq === 'number') {
+            // Skip frames already seen before a reconnect
+            if (data.seq <= lastSeqRef.current) return;
+            lastSeqRef.current = data.seq;
+          }
 
-          if (data.type === 'echo') {
+          if (data.type === 'echo' || data.type === 'notification') {
+            // Echo replies and operator/admin pushes are shown as bot messages
             const newMessage: Message = {
               id: new Date().getTime().toString(),
               text: data.message || '',
@@ -103,6 +116,28 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
             setMessages(prev => [...prev, newMessage]);
           } else if (data.type === 'system') {
             console.log('System message:', data.message);
+            if (data.resumed) {
+              if (data.replay_gap && streamingMessageIdRef.current) {
+                // Part of the response was lost - the server sends the completion
+                // frame with the full text (v2 included) after a gap
+                setMessages(prev => prev.map(msg =>
+                  msg.id === streamingMessageIdRef.current ? { ...msg, text: '' } : msg
+                ));
+              }
+              setIsThinking(!!data.generating);
+            } else {
+              // New session - anything still streaming from the old one is gone
+              sessionIdRef.current = data.session_id ?? null;
+              lastSeqRef.current = 0;
+              if (streamingMessageIdRef.current) {
+                setMessages(prev => prev.map(msg =>
+                  msg.id === streamingMessageIdRef.current
+                    ? { ...msg, isStreaming: false }
+                    : msg
+                ));
+                streamingMessageIdRef.current = null;
+              }
+            }
           } else if (data.type === 'ping') {
             // Reply with pong
             if (ws.readyState === WebSocket.OPEN) {
@@ -125,29 +160,46 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
               isStreaming: true
             };
             setMessages(prev => [...prev, newMessage]);
+          } else if (data.type === 'status' && data.message === 'cancelled') {
+            // Generation was stopped - keep the partial text as the final message
+            setIsThinking(false);
+            if (streamingMessageIdRef.current) {
+              setMessages(prev => prev.map(msg =>
+                msg.id === streamingMessageIdRef.current
+                  ? { ...msg, isStreaming: false }
+                  : msg
+              ));
+              streamingMessageIdRef.current = null;
+            }
           } else if (data.type === 'token' && data.token && streamingMessageIdRef.current) {
-            // Append token to the current streaming message
+            // Append token(s) to the current streaming message - the server
+            // coalesces several tokens into one frame, `count` says how many
             setMessages(prev => prev.map(msg => 
               msg.id === streamingMessageIdRef.current
                 ? { ...msg, text: msg.text + data.token }
                 : msg
             ));
-          } else if (data.type === 'completion' && data.message) {
+          } else if (data.type === 'completion') {
             // Update the streaming message to final state
             setIsThinking(false);
-            
+            // v1 completions repeat the full text; v2 ones only carry its
+            // length and checksum, so the streamed text is kept as final
+            const finalText = data.message;
+
             if (streamingMessageIdRef.current) {
-              setMessages(prev => prev.map(msg => 
-                msg.id === streamingMessageIdRef.current
-                  ? { ...msg, text: data.message || msg.text, isStreaming: false }
-                  : msg
-              ));
+              setMessages(prev => prev.map(msg => {
+                if (msg.id !== streamingMessageIdRef.current) return msg;
+                if (finalText === undefined && !verifyCompletion(msg.text, data)) {
+                  console.warn('Streamed response does not match its completion frame');
+                }
+                return { ...msg, text: finalText ?? msg.text, isStreaming: false };
+              }));
               streamingMessageIdRef.current = null;
-            } else {
+            } else if (finalText) {
               // If we somehow missed the streaming setup, add the complete message
               const newMessage: Message = {
                 id: new Date().getTime().toString(),
-                text: data.message,
+                text: finalText,
                 isUser: false,
                 timestamp: new Date(),
               };
@@ -155,6 +207,9 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
             }
           } else if (data.type === 'error') {
             console.error('Error from server:', data.message);
+            if (typeof data.retry_after === 'number') {
+              retryAtRef.current = Date.now() + data.retry_after * 1000;
+            }
             // Add error message
             const errorMessage: Message = {
               id: new Date().getTime().toString(),
@@ -163,8 +218,11 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
               timestamp: new Date(),
             };
             setMessages(prev => [...prev, errorMessage]);
-            setIsThinking(false);
-            streamingMessageIdRef.current = null;
+            if (data.code !== 'rate_limited') {
+              // Only the refused prompt failed - a response already streaming carries on
+              setIsThinking(false);
+              streamingMessageIdRef.current = null;
+            }
           }
         } catch (error) {
           console.error('Error parsing message:', error);
@@ -192,8 +250,12 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
         // Attempt to reconnect, but with increased delay to avoid hammering the server
         if (reconnectAttempt < maxReconnectAttempts) {
           const nextAttempt = reconnectAttempt + 1;
-          // Exponential backoff: wait longer between consecutive attempts
-          const delay = reconnectDelay * Math.pow(1.5, nextAttempt - 1);
+          // Exponential backoff: wait longer between consecutive attempts,
+          // and at least as long as a rate-limited server asked
+          const delay = Math.max(
+            reconnectDelay * Math.pow(1.5, nextAttempt - 1),
+            retryAtRef.current - Date.now()
+          );
 
           console.log(`Reconnecting... Attempt ${nextAttempt}/${maxReconnectAttempts} in ${delay}ms`);
           setReconnectAttempt(nextAttempt);
@@ -235,6 +297,18 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
       return;
     }
 
+    const wait = retryAtRef.current - Date.now();
+    if (wait > 0) {
+      // Rate limited - the server would only refuse it
+      setMessages(prev => [...prev, {
+        id: new Date().getTime().toString(),
+        text: `Please wait ${Math.ceil(wait / 1000)}s before sending another message`,
+        isUser: false,
+        timestamp: new Date(),
+      }]);
+      return;
+    }
+
     try {
       // Add user message to local state first
       const userMessage: Message = {
@@ -252,6 +326,22 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
     }
   }, []);
 
+  // Stop the response that is currently being generated
+  const cancelGeneration = useCallback(() => {
+    if (!wsRef.current || wsRef.current.readyState !== WebSocket.OPEN) {
+      return;
+    }
+
+    try {
+      wsRef.current.send(JSON.stringify({
+        type: 'cancel',
+        timestamp: new Date().toISOString()
+      }));
+    } catch (error) {
+      console.error('Error sending cancel:', error);
+    }
+  }, []);
+
   // Manual reconnect function
   const reconnect = useCallback(() => {
     if (!isActive) return;
@@ -328,7 +418,7 @@ const useWebSocket = (widgetKey: string, isActive: boolean = true) => {
     };
   }, [connectWebSocket, isActive]);
 
-  return { messages, sendMessage, isConnected, isThinking, reconnect, reconnectAttempt };
+  return { messages, sendMessage, cancelGeneration, isConnected, isThinking, reconnect, reconnectAttempt };
 };
 
 export default useWebSocket;
@@ -0,0 +1,173 @@
+/**
+ * Wire protocol v2: compact binary MessagePack frames.
+ *
+ * The widget offers the `glazing.v2.msgpack` subprotocol when connecting;
+ * servers that don't support it keep sending v1 JSON text frames. Each v2
+ * frame is an array starting with a short type code, decoded here into the
+ * same shape as a v1 JSON frame so the rest of the widget doesn't care.
+ */
+
+export const PROTOCOL_V2 = 'glazing.v2.msgpack';
+
+export interface ServerFrame {
+  type: string;
+  message?: string;
+  token?: string;
+  count?: number;
+  session_id?: string;
+  timestamp?: string;
+  seq?: number;
+  code?: string;
+  retry_after?: number;
+  // v2 completion frames carry the response's UTF-8 length and CRC-32
+  // instead of its text
+  length?: number;
+  crc32?: number;
+  resumed?: boolean;
+  generating?: boolean;
+  replay_gap?: boolean;
+}
+
+const textDecoder = new TextDecoder();
+const textEncoder = new TextEncoder();
+
+/**
+ * Minimal MessagePack decoder covering the types the server emits
+ * (nil, booleans, integers, floats, strings, binary, arrays and maps).
+ */
+export const decodeMsgpack = (buffer: ArrayBuffer): unknown => {
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  let offset = 0;
+
+  const readString = (length: number): string => {
+    const value = textDecoder.decode(bytes.subarray(offset, offset + length));
+    offset += length;
+    return value;
+  };
+
+  const readBinary = (length: number): Uint8Array => {
+    const value = bytes.slice(offset, offset + length);
+    offset += length;
+    return value;
+  };
+
+  const readArray = (length: number): unknown[] => {
+    const items: unknown[] = [];
+    for (let i = 0; i < length; i++) items.push(read());
+    return items;
+  };
+
+  const readMap = (length: number): Record<string, unknown> => {
+    const map: Record<string, unknown> = {};
+    for (let i = 0; i < length; i++) {
+      const key = String(read());
+      map[key] = read();
+    }
+    return map;
+  };
+
+  const read = (): unknown => {
+    const byte = view.getUint8(offset++);
+
+    if (byte <= 0x7f) return byte; // positive fixint
+    if (byte >= 0xe0) return byte - 0x100; // negative fixint
+    if ((byte & 0xf0) === 0x80) return readMap(byte & 0x0f);
+    if ((byte & 0xf0) === 0x90) return readArray(byte & 0x0f);
+    if ((byte & 0xe0) === 0xa0) return readString(byte & 0x1f);
+
+    let value: unknown;
+    switch (byte) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: { const length = view.getUint8(offset); offset += 1; return readBinary(length); }
+      case 0xc5: { const length = view.getUint16(offset); offset += 2; return readBinary(length); }
+      case 0xc6: { const length = view.getUint32(offset); offset += 4; return readBinary(length); }
+      case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+      case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+      case 0xcc: value = view.getUint8(offset); offset += 1; return value;
+      case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+      case 0xce: value = view.getUint32(offset); offset += 4; return value;
+      case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+      case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+      case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+      case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+      case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+      case 0xd9: { const length = view.getUint8(offset); offset += 1; return readString(length); }
+      case 0xda: { const length = view.getUint16(offset); offset += 2; return readString(length); }
+      case 0xdb: { const length = view.getUint32(offset); offset += 4; return readString(length); }
+      case 0xdc: { const length = view.getUint16(offset); offset += 2; return readArray(length); }
+      case 0xdd: { const length = view.getUint32(offset); offset += 4; return readArray(length); }
+      case 0xde: { const length = view.getUint16(offset); offset += 2; return readMap(length); }
+      case 0xdf: { const length = view.getUint32(offset); offset += 4; return readMap(length); }
+      default:
+        throw new Error(`Unsupported MessagePack type 0x${byte.toString(16)}`);
+    }
+  };
+
+  return read();
+};
+
+/** Decode a v2 binary frame into the v1 frame shape. */
+export const decodeFrame = (buffer: ArrayBuffer): ServerFrame => {
+  const frame = decodeMsgpack(buffer) as unknown[];
+  const code = frame[0] as number;
+
+  switch (code) {
+    case 1:
+      return { type: 'token', seq: frame[1] as number, token: frame[2] as string, count: frame[3] as number };
+    case 2:
+      return { type: 'status', seq: frame[1] as number, message: frame[2] as string };
+    case 3:
+      return {
+        type: 'completion',
+        seq: frame[1] as number,
+        length: frame[2] as number,
+        crc32: frame[3] as number,
+        // Only sent after a resume lost frames
+        message: frame[4] as string | undefined,
+      };
+    case 4:
+      return {
+        type: 'error',
+        seq: frame[1] as number,
+        message: frame[2] as string,
+        code: (frame[3] as string | null) ?? undefined,
+        retry_after: (frame[4] as number | null) ?? undefined,
+      };
+    case 5:
+      return { type: 'ping' };
+    case 6:
+      return { type: 'pong' };
+    case 7:
+      return { type: 'system', ...(frame[1] as Partial<ServerFrame>) };
+    case 8:
+      return { type: 'notification', message: frame[1] as string };
+    default:
+      return frame[1] as ServerFrame;
+  }
+};
+
+let crcTable: Uint32Array | null = null;
+
+/** CRC-32 (IEEE), matching Python's zlib.crc32. */
+export const crc32 = (data: Uint8Array): number => {
+  if (!crcTable) {
+    crcTable = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+      let c = n;
+      for (let k = 0; k < 8; k++) c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+      crcTable[n] = c >>> 0;
+    }
+  }
+  let crc = 0xffffffff;
+  for (let i = 0; i < data.length; i++) crc = crcTable[(crc ^ data[i]) & 0xff] ^ (crc >>> 8);
+  return (crc ^ 0xffffffff) >>> 0;
+};
+
+/** Whether text assembled from token frames matches a v2 completion frame. */
+export const verifyCompletion = (text: string, frame: ServerFrame): boolean => {
+  const data = textEncoder.encode(text);
+  return data.length === frame.length && crc32(data) === frame.crc32;
+};